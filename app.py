@@ -9,31 +9,69 @@ ZOPTYMALIZOWANY GENERATOR OFERT - LibreOffice + PyMuPDF
 """
 
 import os
+import sys
 import json
 import tempfile
 import shutil
 import subprocess
-import base64
 import hashlib
+import io
+import posixpath
 import threading
+import time
+import socket
+import queue
+import atexit
+import re
+import copy
+import multiprocessing
+import uuid
+import zipfile
+import sqlite3
+import unicodedata
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_file, make_response
+from urllib.parse import quote
+from flask import Flask, render_template, request, jsonify, send_file, make_response, g, Response
 from flask_socketio import SocketIO, emit
 from datetime import datetime
 from docx import Document
-import docx.enum.text
 from flask_compress import Compress
 from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsmap
+from docx.opc.constants import RELATIONSHIP_TYPE as RT, CONTENT_TYPE as CT
+from lxml import etree
 
 try:
     import fitz  # PyMuPDF - super szybkie!
     HAS_PYMUPDF = True
+    RENDERER_VERSION = f"pymupdf-{fitz.VersionBind}"
 except ImportError:
     HAS_PYMUPDF = False
+    RENDERER_VERSION = "pdf2image"
     print("[WARNING] PyMuPDF nie zainstalowane - używam pdf2image (wolniejsze)")
     from pdf2image import convert_from_path
 
+try:
+    import fcntl  # blokada rozgrzewania w grupie procesów (Linux / macOS)
+except ImportError:
+    fcntl = None
+
+try:
+    from watchdog.observers import Observer  # opcjonalnie - natychmiastowe wykrywanie zmian plików
+    HAS_WATCHDOG = True
+except ImportError:
+    HAS_WATCHDOG = False
+
+try:
+    from unoserver.client import UnoClient
+    HAS_UNOSERVER_CLIENT = True
+except ImportError:
+    HAS_UNOSERVER_CLIENT = False
+
 # ============================================================
 # KONFIGURACJA
 # ============================================================
@@ -53,68 +91,1076 @@ PRODUKTY_DIR = os.path.join(BASE_DIR, 'produkty')
 SAVED_OFFERS_DIR = os.path.join(BASE_DIR, 'saved_offers')
 GENERATED_OFFERS_DIR = os.path.join(BASE_DIR, 'generated_offers')
 OUT_JPG_DIR = os.path.join(BASE_DIR, 'out_jpg')
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', os.path.join(BASE_DIR, 'render_cache'))
+
+# Parametry renderowania podglądu
+RENDER_DPI = 200
+RENDER_QUALITY = 90
+RENDER_CACHE_VERSION = 5  # podbij przy zmianie formatu cache lub wyniku podstawiania
+
+# Poziomy jakości (wszystkie z jednego parsowania PDF, każdy w cache osobno)
+RENDER_TIERS = {
+    'thumb': {'dpi': 36, 'quality': 60},                    # miniatury
+    'screen': {'dpi': 110, 'quality': 80},                  # podgląd na ekranie
+    'full': {'dpi': RENDER_DPI, 'quality': RENDER_QUALITY},  # pełna jakość - dopiero na zoom
+}
+DEFAULT_TIER = 'screen'
+PREVIEW_TIERS = ('thumb', 'screen')  # renderowane od razu przy podglądzie
+# PDF segmentu: 'pdf' - samodzielna konwersja (eksport), 'pdf_slice' - wycięty z całej oferty single-pass
+# (ukryte znaczniki segmentów, nagłówki / numery stron z kontekstu oferty - tylko do podglądu)
+PDF_TIERS = ('pdf', 'pdf_slice')
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Podgląd: 'single_pass' (jedna konwersja całej oferty) lub 'per_file'
+PREVIEW_DEFAULT_MODE = 'single_pass'
+SEGMENT_MARKER = '@@SEG{:04d}@@'
+SEGMENT_MARKER_RE = re.compile(r'@@SEG(\d{4})@@')
+PLACEHOLDER_RE = re.compile(r'\{\{([^{}]+)\}\}')
+PAGE_HASH_RE = re.compile(r'[0-9a-f]{64}')
+TOC_PLACEHOLDERS = frozenset({'SPIS_TRESCI', 'TOC', 'Spistresci'})
+W_P = qn('w:p')
+W_T = qn('w:t')
+W_PPR = qn('w:pPr')
+W_SECTPR = qn('w:sectPr')
+W_R = qn('w:r')
+W_BR = qn('w:br')
+W_BODY = qn('w:body')
+W_VAL = qn('w:val')
+W_TYPE = qn('w:type')
+W_STYLE = qn('w:style')
+W_STYLE_ID = qn('w:styleId')
+W_DEFAULT = qn('w:default')
+W_NAME = qn('w:name')
+W_PSTYLE = qn('w:pStyle')
+W_NUMBERING = qn('w:numbering')
+W_NUM = qn('w:num')
+W_NUM_ID = qn('w:numId')
+W_ABSTRACT_NUM = qn('w:abstractNum')
+W_ABSTRACT_NUM_ID = qn('w:abstractNumId')
+W_NSID = qn('w:nsid')
+W_NUM_ID_MAC_CLEANUP = qn('w:numIdMacAtCleanup')
+WP_DOCPR = qn('wp:docPr')
+R_ATTRIBUTES = etree.XPath(".//@*[namespace-uri() = '%s']" % nsmap['r'])  # atrybuty r:id / r:embed / ...
+STYLE_REFS = (qn('w:pStyle'), qn('w:rStyle'), qn('w:tblStyle'))
+STYLE_LINKS = frozenset({qn('w:basedOn'), qn('w:next'), qn('w:link')})
+
+# Paczki OOXML (łączenie DOCX na poziomie zip)
+RELS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+CT_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+CT_TYPES = f'{{{CT_NS}}}Types'
+CT_DEFAULT = f'{{{CT_NS}}}Default'
+CT_OVERRIDE = f'{{{CT_NS}}}Override'
+CT_HEADER = CT.WML_HEADER
+CT_FOOTER = CT.WML_FOOTER
+CT_NUMBERING = CT.WML_NUMBERING
+STORED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'jfif', 'gif'})  # już skompresowane - bez deflate
 
 # Utwórz foldery
 os.makedirs(SAVED_OFFERS_DIR, exist_ok=True)
 os.makedirs(GENERATED_OFFERS_DIR, exist_ok=True)
 os.makedirs(OUT_JPG_DIR, exist_ok=True)
 
-# Globalne cache
-libreoffice_lock = threading.Lock()
-conversion_cache = {}  # {file_hash: [list of base64 images]}
+# Pula konwerterów DOCX → PDF
+CONVERTER_WORKERS = int(os.environ.get('CONVERTER_WORKERS', max(1, min(os.cpu_count() or 1, 8))))
+UNOSERVER_BASE_PORT = int(os.environ.get('UNOSERVER_BASE_PORT', 2003))
+UNOSERVER_START_TIMEOUT = 30
+UNOSERVER_HEALTH_INTERVAL = 10
+LO_PROFILES_DIR = os.path.join(tempfile.gettempdir(), 'oferta_lo_profiles')
+
+# Gotowe wyniki całych ofert (identyczne dane → wynik bez ponownego generowania)
+OFFER_CACHE_MAX_ENTRIES = int(os.environ.get('OFFER_CACHE_MAX_ENTRIES', 256))
+OFFER_CACHE_TTL = int(os.environ.get('OFFER_CACHE_TTL', 900))  # sekundy
+
+# Żądanie z tym nagłówkiem dostaje czasy etapów w Server-Timing (zadania: także 'trace' w /api/jobs/<id>)
+DEBUG_TRACE_HEADER = 'X-Debug-Trace'
+
+# Obserwacja zmian produktów / szablonów (sekundy)
+WATCH_INTERVAL = float(os.environ.get('WATCH_INTERVAL', 2))
+WATCH_DEBOUNCE = 0.5
+
+# Sparsowane szablony DOCX w pamięci (liczba plików)
+TEMPLATE_CACHE_MAX_ENTRIES = int(os.environ.get('TEMPLATE_CACHE_MAX_ENTRIES', 64))
+
+# Statystyki użycia plików (kolejność rozgrzewania) - zapis na dysk najwyżej co tyle sekund
+USAGE_FLUSH_INTERVAL = 5
+
+# Plany placeholderów per plik {ścieżka: (file_hash, {'names', 'paragraphs'})} - fingerprinty segmentów i podstawianie
+# Zmiana treści zastępuje wpis pliku; LRU na wypadek znikających ścieżek (np. części podzielonych szablonów)
+PLACEHOLDER_INDEX_MAX_ENTRIES = 256
+placeholder_index = OrderedDict()
+placeholder_index_lock = threading.Lock()
+
+# Szablony single-file: części przed / po markerze wstawienia produktów (pliki DOCX, podział raz na treść)
+TEMPLATE_SPLIT_DIR = os.path.join(RENDER_CACHE_DIR, 'splits')
+template_splits = {}  # {(ścieżka, marker): (file_hash, (ścieżka przed, ścieżka po | None) | None)} - nowa treść zastępuje wpis
+
+# Czasy podglądu per tryb (porównanie single_pass vs per_file vs lazy)
+preview_timings = {'per_file': deque(maxlen=50), 'single_pass': deque(maxlen=50), 'lazy': deque(maxlen=50)}
+preview_timings_lock = threading.Lock()
+
+# Pula procesów do rasteryzacji PDF → JPG
+RASTER_WORKERS = int(os.environ.get('RASTER_WORKERS', max(1, min(os.cpu_count() or 1, 4))))
+raster_pool = None
+raster_pool_lock = threading.Lock()
+
+# Podgląd 'lazy': w zadaniu tylko strony z widoku klienta, pozostałe na żądanie (/api/load-page)
+LAZY_VIEWPORT_PAGES = int(os.environ.get('LAZY_VIEWPORT_PAGES', 2))  # domyślny widok: pierwsze strony
+PAGE_PREFETCH = 2  # sąsiednie strony (z każdej strony widoku) renderowane w tle
+PAGE_LOADER_WORKERS = int(os.environ.get('PAGE_LOADER_WORKERS', max(2, RASTER_WORKERS)))
+PAGE_LOADER_MAX_SEGMENTS = 256  # segmenty znane z podglądów (do konwersji brakującego PDF)
+PAGE_LOAD_TIMEOUT = 120  # sekundy
+
+# Kolejka zadań w tle (generowanie DOCX, podgląd)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 16))  # czekających - powyżej 503
+JOB_RESULT_TTL = 600  # sekundy przechowywania wyniku zakończonego zadania
+
+# Masowe generowanie ofert (API /api/batch + CLI: python app.py batch ...)
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', max(1, min(os.cpu_count() or 1, 4))))
+BATCH_DIR = os.path.join(GENERATED_OFFERS_DIR, 'batches')
+BATCH_ID_RE = re.compile(r'[0-9]{8}_[0-9]{6}_[0-9a-f]{6}')
+batch_pool = None
+batch_pool_lock = threading.Lock()
+
+# Retencja generated_offers/ (oferty i partie): najpierw limit wieku, potem rozmiaru - najstarsze pierwsze
+GENERATED_MAX_BYTES = int(os.environ.get('GENERATED_MAX_BYTES', 256 * 1024 * 1024))
+GENERATED_MAX_AGE = int(os.environ.get('GENERATED_MAX_AGE', 7 * 24 * 3600))  # sekundy
+GENERATED_KEEP_RECENT = JOB_RESULT_TTL  # młodszych nie usuwa limit rozmiaru - wynik zadania wskazuje na plik
+
+# Oferta prosto w odpowiedzi HTTP (/api/generate-offer ze stream) - bez pliku w generated_offers/
+STREAM_SPOOL_MAX = 16 * 1024 * 1024  # bufor w pamięci, większy dokument przelewany do pliku tymczasowego
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_WAIT = 30  # sekundy czekania na wolne miejsce (najwyżej JOB_WORKERS naraz), potem 503
+OFFER_MIMETYPES = {
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'pdf': 'application/pdf',
+}
+
+# WebSocket: zdarzenia tylko do klienta, który zlecił zadanie
+SOCKET_MAX_IN_FLIGHT = 8   # niepotwierdzonych stron na klienta
+SOCKET_ACK_TIMEOUT = 5     # sekundy - potem strona pominięta (klient dociągnie ją przez /api/load-page)
+
+# Sloty dla fallbacku soffice (każdy z własnym profilem LibreOffice w katalogu procesu)
+soffice_profiles_pid = None
+libreoffice_slots = queue.Queue()
+for _slot in range(CONVERTER_WORKERS):
+    libreoffice_slots.put(_slot)
+
 
 # ============================================================
-# KONWERSJA DOCX → JPG (Unoserver + LibreOffice + PyMuPDF)
+# METRYKI WYDAJNOŚCI (Prometheus /metrics + ślad żądania)
 # ============================================================
 
-def check_unoserver_running():
-    """Sprawdź czy unoserver działa"""
-    try:
-        result = subprocess.run(['pgrep', '-f', 'unoserver'], capture_output=True, text=True)
-        return result.returncode == 0
-    except:
-        return False
+class Metrics:
+    """
+    Metryki procesu w pamięci - tekst w formacie Prometheus pod /metrics
+    - liczniki (cache, konwersje), histogramy czasów etapów, wskaźniki liczone przy odczycie
+    - span(etap): czas do histogramu + do śladu bieżącego żądania / zadania (nagłówek X-Debug-Trace)
+    """
 
-        # DOCX → PDF
-        docx_to_pdf_libreoffice(docx_path, pdf_path)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}    # {(nazwa, etykiety): wartość}
+        self.histograms = {}  # {(nazwa, etykiety): [liczniki kubełków, suma, liczba]}
+        self.gauges = {}      # {nazwa: funkcja → wartość lub [(etykiety, wartość)]}
+        self.help = {}        # {nazwa: (typ, opis)}
+        self.local = threading.local()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[0][i] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    def gauge(self, name, text, fn, kind='gauge'):
+        """Wartość liczona przy odczycie /metrics (np. głębokość kolejki)"""
+        self.describe(name, kind, text)
+        self.gauges[name] = fn
+
+    # --- ślad żądania / zadania ---
+
+    def start_trace(self, trace=None):
+        """Zbieraj spany bieżącego wątku do listy (nowej lub podanej - np. śladu zadania)"""
+        self.local.trace = [] if trace is None else trace
+        return self.local.trace
+
+    def stop_trace(self):
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        return trace
+
+    def record(self, stage, seconds, **labels):
+        self.observe('stage_seconds', seconds, stage=stage, **labels)
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace.append({'stage': stage, 'ms': round(seconds * 1000, 2), **labels})
+
+    @contextmanager
+    def span(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def server_timing(trace):
+        """Nagłówek Server-Timing: suma czasu i liczba spanów per etap (w kolejności pierwszego wystąpienia)"""
+        totals = OrderedDict()
+        for span in trace:
+            total = totals.setdefault(span['stage'], [0.0, 0])
+            total[0] += span['ms']
+            total[1] += 1
+        return ', '.join(f'{stage};dur={ms:.1f};desc="{count}x"' for stage, (ms, count) in totals.items())
+
+    # --- eksport ---
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    def render(self):
+        """Wszystkie metryki w formacie tekstowym Prometheus (text/plain; version=0.0.4)"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+
+        series = {}  # {nazwa: [linie]}
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append(f'{self.prefix}_{name}{self._format_labels(labels)} {value}')
+
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            lines = series.setdefault(name, [])
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f'{self.prefix}_{name}_bucket{self._format_labels(labels + (("le", str(bound)),))} '
+                             f'{bucket_count}')
+            lines.append(f'{self.prefix}_{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.prefix}_{name}_sum{self._format_labels(labels)} {total:.6f}')
+            lines.append(f'{self.prefix}_{name}_count{self._format_labels(labels)} {count}')
+
+        for name, fn in self.gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"[METRICS] ⚠️ {name}: {e}")
+                continue
+            values = value if isinstance(value, list) else [({}, value)]
+            series[name] = [f'{self.prefix}_{name}{self._format_labels(self._labels(labels))} {v}'
+                            for labels, v in values]
+
+        out = []
+        for name in sorted(series):
+            kind, text = self.help.get(name, ('untyped', name))
+            out.append(f'# HELP {self.prefix}_{name} {text}')
+            out.append(f'# TYPE {self.prefix}_{name} {kind}')
+            out.extend(series[name])
+        return '\n'.join(out) + '\n'
+
+
+metrics = Metrics('oferta')
+metrics.describe('stage_seconds', 'histogram', 'Czas etapu generowania / podglądu (template_load, placeholder_fill, '
+                                               'merge, docx_to_pdf, rasterize, encode, emit)')
+metrics.describe('http_request_seconds', 'histogram', 'Czas obsługi żądania HTTP')
+metrics.describe('job_seconds', 'histogram', 'Czas wykonania zadania w tle')
+metrics.describe('job_queue_seconds', 'histogram', 'Czas oczekiwania zadania w kolejce')
+metrics.describe('render_cache_lookups_total', 'counter', 'Odczyty wpisów cache renderów')
+metrics.describe('render_cache_evictions_total', 'counter', 'Wpisy usunięte z cache renderów (LRU)')
+metrics.describe('conversions_total', 'counter', 'Konwersje DOCX → PDF')
+metrics.describe('offer_cache_lookups_total', 'counter', 'Odczyty cache gotowych ofert (generowanie / podgląd)')
 
-def start_unoserver():
-    """Uruchom unoserver w daemon mode"""
-    if check_unoserver_running():
-        print("[UNOSERVER] ✓ Już działa")
-        return True
 
-    print("[UNOSERVER] Uruchamiam unoserver --daemon...")
-    try:
-        subprocess.Popen(
-            ['unoserver', '--daemon'],
+# ============================================================
+# CACHE RENDERÓW NA DYSKU (content-addressed + LRU, wspólny dla procesów)
+# ============================================================
+
+class RenderCache:
+    """
+    Trwały cache renderów DOCX → JPG, wspólny dla wszystkich procesów na hoście
+    - klucz: (hash treści, DPI, jakość JPEG, wersja renderera) - osobno per poziom jakości
+    - strony trzymane jako surowe bajty JPEG w blobach adresowanych hashem
+    - PDF segmentu trzymany tak samo (poziom 'pdf') - pełna jakość bez ponownej konwersji;
+      strony wycięte z podglądu single-pass osobno (poziom 'pdf_slice' - tylko do podglądu, nie do eksportu)
+    - indeks wpisów i liczniki referencji blobów w SQLite (WAL) - widoczne od razu w każdym workerze
+    - limit rozmiaru na dysku z usuwaniem najdawniej używanych wpisów (LRU)
+    - fill_lock(): tylko jeden proces / wątek renderuje dany dokument, reszta czeka na wynik
+    """
+
+    TOUCH_INTERVAL = 60  # sekundy - rzadsze zapisy czasu użycia przy odczytach
+    BLOB_GRACE = 600  # sekundy - świeżego bloba nie kasujemy (może go właśnie rejestrować inny proces)
+    SWEEP_INTERVAL = 3600  # sekundy - co tyle sprzątanie blobów bez wpisu w działającym procesie
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.locks_dir = os.path.join(root, 'locks')
+        self.db_path = os.path.join(root, 'index.sqlite3')
+        self.local = threading.local()  # połączenie SQLite per wątek
+        self.fill_stripes = [threading.Lock() for _ in range(64)]  # bez fcntl: blokady w obrębie procesu
+        self.last_sweep = time.time()
+
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+        self._init_db()
+
+    @staticmethod
+    def make_key(content_hash, tier=DEFAULT_TIER):
+        """Klucz wpisu: hash treści + parametry renderowania poziomu ('pdf' / 'pdf_slice' = sam PDF)"""
+        if tier in PDF_TIERS:
+            raw = f"v{RENDER_CACHE_VERSION}|{tier}|{content_hash}"
+        else:
+            settings = RENDER_TIERS[tier]
+            raw = f"v{RENDER_CACHE_VERSION}|{RENDERER_VERSION}|{content_hash}|{settings['dpi']}|{settings['quality']}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.blobs_dir, blob_hash[:2], blob_hash)
+
+    @staticmethod
+    def blob_hash(img_bytes):
+        """Adres bloba = SHA-256 bajtów (JPEG lub PDF)"""
+        return hashlib.sha256(img_bytes).hexdigest()
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """Zapis przez plik tymczasowy + rename (brak połówkowych plików)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _db(self):
+        """Połączenie SQLite bieżącego wątku (sqlite3 nie dzieli połączeń między wątkami)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Transakcja zapisu - BEGIN IMMEDIATE serializuje zapisy wszystkich procesów"""
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _init_db(self):
+        with self._write() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, pages TEXT NOT NULL, created TEXT, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                         'hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)')
+            migrated = self._migrate_json_entries(conn)
+
+        count, total = self._totals()
+        self._sweep_orphans()
+
+        if count:
+            print(f"[CACHE] Wczytano {count} wpisów ({total / 1024 / 1024:.1f} MB)"
+                  + (f", zmigrowano {migrated} z JSON" if migrated else ''))
+
+    def _totals(self):
+        """(liczba wpisów, bajty blobów)"""
+        conn = self._db()
+        count = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        return count, total
+
+    def _migrate_json_entries(self, conn):
+        """Jednorazowo przenieś wpisy z entries/*.json (poprzedni format indeksu) do SQLite"""
+        entries_dir = os.path.join(self.root, 'entries')
+        if not os.path.isdir(entries_dir):
+            return 0
+
+        migrated = 0
+        for filename in os.listdir(entries_dir):
+            path = os.path.join(entries_dir, filename)
+            if filename.endswith('.json'):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        meta = json.load(f)
+                    pages = meta.get('pages', [])
+                    if all(os.path.exists(self.blob_path(h)) for h in pages):
+                        self._insert_entry(conn, filename[:-5], pages, os.stat(path).st_mtime)
+                        migrated += 1
+                except (OSError, ValueError):
+                    pass
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        try:
+            os.rmdir(entries_dir)
+        except OSError:
+            pass
+        return migrated
+
+    def _sweep_orphans(self, max_age=3600):
+        """Usuń bloby bez wpisu (np. przerwany streaming) starsze niż max_age"""
+        now = time.time()
+        known = {row[0] for row in self._db().execute('SELECT hash FROM blobs')}
+        for dirpath, _, filenames in os.walk(self.blobs_dir):
+            for filename in filenames:
+                if filename in known:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    # Stare bloby *.jpg (cache v1) nie mają już wpisów - też znikną
+                    if now - os.stat(path).st_mtime > max_age:
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+    def _insert_entry(self, conn, key, pages, last_used=None):
+        """
+        Dodaj / nadpisz wpis i podbij referencje jego blobów (w otwartej transakcji)
+        Zwraca bloby nadpisanego wpisu, do których nic już się nie odwołuje - do skasowania
+        """
+        released = self._delete_entry(conn, key)
+        conn.execute('INSERT INTO entries (key, pages, created, last_used) VALUES (?, ?, ?, ?)',
+                     (key, json.dumps(pages), datetime.now().isoformat(timespec='seconds'),
+                      last_used if last_used is not None else time.time()))
+        for blob_hash in pages:
+            updated = conn.execute('UPDATE blobs SET refs = refs + 1 WHERE hash = ?', (blob_hash,)).rowcount
+            if not updated:
+                try:
+                    size = os.path.getsize(self.blob_path(blob_hash))
+                except OSError:
+                    size = 0
+                conn.execute('INSERT INTO blobs (hash, size, refs) VALUES (?, ?, 1)', (blob_hash, size))
+        # Blob zwolniony i od razu użyty ponownie przez nowy wpis zostaje
+        return [blob_hash for blob_hash in released if blob_hash not in pages]
+
+    def _delete_entry(self, conn, key):
+        """Usuń wpis i zwróć bloby, do których nic już się nie odwołuje (w otwartej transakcji)"""
+        row = conn.execute('SELECT pages FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return []
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+        released = []
+        for blob_hash in json.loads(row[0]):
+            conn.execute('UPDATE blobs SET refs = refs - 1 WHERE hash = ?', (blob_hash,))
+            if conn.execute('SELECT refs FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()[0] <= 0:
+                conn.execute('DELETE FROM blobs WHERE hash = ?', (blob_hash,))
+                released.append(blob_hash)
+        return released
+
+    def _unlink_blobs(self, blob_hashes):
+        """Skasuj pliki blobów po commicie - świeże zostają (sprząta je _sweep_orphans)"""
+        now = time.time()
+        for blob_hash in blob_hashes:
+            path = self.blob_path(blob_hash)
+            try:
+                if now - os.stat(path).st_mtime > self.BLOB_GRACE:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _drop(self, key):
+        """Usuń wpis i bloby, do których nic już się nie odwołuje"""
+        with self._write() as conn:
+            released = self._delete_entry(conn, key)
+        self._unlink_blobs(released)
+
+    def _evict(self, conn):
+        """Usuń najdawniej używane wpisy ponad limit (w otwartej transakcji) - zwraca bloby do skasowania"""
+        released = []
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute('SELECT key FROM entries ORDER BY last_used LIMIT 2').fetchall()
+            if len(rows) < 2:
+                break
+            key = rows[0][0]
+            released += self._delete_entry(conn, key)
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            metrics.inc('render_cache_evictions_total')
+            print(f"[CACHE] 🗑️ Evicted: {key[:12]}")
+        return released
+
+    def _lookup(self, key, touch=False):
+        """Hashe stron wpisu (None gdy brak) - opcjonalnie odśwież czas użycia (LRU)"""
+        conn = self._db()
+        row = conn.execute('SELECT pages, last_used FROM entries WHERE key = ?', (key,)).fetchone()
+        metrics.inc('render_cache_lookups_total', result='miss' if row is None else 'hit')
+        if row is None:
+            return None
+        now = time.time()
+        if touch and now - row[1] > self.TOUCH_INTERVAL:
+            conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def page_count(self, key):
+        """Liczba stron wpisu bez czytania JPG (None gdy brak)"""
+        pages = self._lookup(key)
+        return len(pages) if pages is not None else None
+
+    def get_page_hashes(self, key):
+        """Hashe stron wpisu (adresy blobów) bez czytania JPG - None gdy brak"""
+        return self._lookup(key, touch=True)
+
+    def read_blob(self, blob_hash):
+        """Bajty bloba lub None gdy zniknął z dysku"""
+        try:
+            with open(self.blob_path(blob_hash), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def copy_blob(self, blob_hash, dest_path):
+        """Skopiuj blob do pliku (np. PDF do rasteryzacji) - False gdy brak"""
+        try:
+            shutil.copyfile(self.blob_path(blob_hash), dest_path)
+            return True
+        except OSError:
+            return False
+
+    def get_pages(self, key):
+        """Zwróć listę bajtów (JPEG / PDF) dla wpisu lub None"""
+        pages = self._lookup(key, touch=True)
+        if pages is None:
+            return None
+
+        images = []
+        for blob_hash in pages:
+            img_bytes = self.read_blob(blob_hash)
+            if img_bytes is None:
+                # Blob zniknął z dysku - wpis nieważny
+                self._drop(key)
+                return None
+            images.append(img_bytes)
+        return images
+
+    def put_blob(self, img_bytes):
+        """Zapisz pojedynczą stronę (od razu dostępna pod URL) - zwraca jej hash"""
+        blob_hash = self.blob_hash(img_bytes)
+        blob_path = self.blob_path(blob_hash)
+        try:
+            # Już jest (np. od innego procesu) - odśwież mtime, żeby nie zniknął przed rejestracją wpisu
+            os.utime(blob_path)
+        except OSError:
+            self._write_atomic(blob_path, img_bytes)
+        return blob_hash
+
+    def put_entry(self, key, pages):
+        """Zarejestruj wpis z już zapisanych blobów (hashe stron) - atomowo, widoczny dla wszystkich procesów"""
+        with self._write() as conn:
+            released = self._insert_entry(conn, key, pages)
+            released += self._evict(conn)
+        self._unlink_blobs(released)
+
+        if time.time() - self.last_sweep > self.SWEEP_INTERVAL:
+            self.last_sweep = time.time()
+            self._sweep_orphans()
+        return pages
+
+    def put_pages(self, key, images):
+        """Zapisz strony (bajty JPEG) pod kluczem - zwraca hashe stron"""
+        return self.put_entry(key, [self.put_blob(img_bytes) for img_bytes in images])
+
+    @contextmanager
+    def fill_lock(self, name):
+        """
+        Single-flight: wyłączność na wypełnienie wpisu `name` (np. hash treści) w całej grupie procesów
+        Pozostali czekają, potem sprawdzają cache ponownie - zamiast renderować to samo
+        """
+        if fcntl is None:
+            with self.fill_stripes[hash(name) % len(self.fill_stripes)]:
+                yield
+            return
+
+        path = os.path.join(self.locks_dir, f'{name}.lock')
+        while True:
+            lock_file = open(path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Poprzedni właściciel mógł skasować plik zanim go zablokowaliśmy - wtedy od nowa
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except OSError:
+                pass
+            lock_file.close()
+
+        try:
+            yield
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            lock_file.close()
+
+
+render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES)
+
+
+class PageCountIndex:
+    """
+    Liczba stron per treść (fingerprint wypełnionego segmentu) - trwała, w indeksie SQLite cache
+    (wspólna dla workerów). Wypełniana przy każdej konwersji do PDF - spis treści nie wymaga renderowania JPG
+    """
+
+    def __init__(self, cache, max_entries=100000):
+        self.cache = cache
+        self.max_entries = max_entries
+        with cache._write() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS page_counts ('
+                         'content_hash TEXT PRIMARY KEY, version INTEGER NOT NULL, pages INTEGER NOT NULL, '
+                         'updated REAL NOT NULL)')
+            # Inna wersja renderowania = inne łamanie stron
+            conn.execute('DELETE FROM page_counts WHERE version != ?', (RENDER_CACHE_VERSION,))
+            self._migrate_json(conn, os.path.join(cache.root, 'page_counts.json'))
+
+    def _migrate_json(self, conn, path):
+        """Jednorazowo przenieś page_counts.json (poprzedni format) do SQLite"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == RENDER_CACHE_VERSION:
+                now = time.time()
+                conn.executemany('INSERT OR IGNORE INTO page_counts VALUES (?, ?, ?, ?)',
+                                 [(h, RENDER_CACHE_VERSION, n, now) for h, n in data.get('counts', {}).items()])
+            os.unlink(path)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, content_hash):
+        row = self.cache._db().execute('SELECT pages FROM page_counts WHERE content_hash = ?',
+                                       (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, content_hash, pages):
+        if self.get(content_hash) == pages:
+            return
+        with self.cache._write() as conn:
+            conn.execute('INSERT OR REPLACE INTO page_counts VALUES (?, ?, ?, ?)',
+                         (content_hash, RENDER_CACHE_VERSION, pages, time.time()))
+            conn.execute('DELETE FROM page_counts WHERE content_hash IN '
+                         '(SELECT content_hash FROM page_counts ORDER BY updated DESC LIMIT -1 OFFSET ?)',
+                         (self.max_entries,))
+
+
+page_count_index = PageCountIndex(render_cache)
+
+
+def pdf_page_count(pdf_bytes):
+    """Liczba stron PDF bez rasteryzacji"""
+    if HAS_PYMUPDF:
+        with fitz.open(stream=pdf_bytes, filetype='pdf') as doc:
+            return doc.page_count
+
+    from pdf2image import pdfinfo_from_bytes
+    return int(pdfinfo_from_bytes(pdf_bytes)['Pages'])
+
+# ============================================================
+# FINGERPRINTY PLIKÓW (hash treści memoizowany po stat)
+# ============================================================
+
+class FileFingerprints:
+    """
+    Hash treści plików bez ponownego czytania niezmienionych plików
+    - memo po (ścieżka, rozmiar, mtime_ns, inode) - gorące żądanie kosztuje jeden stat()
+    - nowa treść hashowana strumieniowo (BLAKE2b, 128 bit) w blokach - bez wczytywania całego pliku
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    RACY_NS = 2 * 10 ** 9  # plik zmieniony przed chwilą - nie zapamiętuj (kolejny zapis w tym samym ticku mtime)
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {ścieżka: (stat, hash)}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def hash_file(cls, path):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, path):
+        """Hash treści pliku (hex) lub None gdy pliku nie da się odczytać"""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+
+        try:
+            file_hash = self.hash_file(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            self.misses += 1
+            if time.time_ns() - st.st_mtime_ns > self.RACY_NS:
+                self.entries[path] = (stat, file_hash)
+                self.entries.move_to_end(path)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return file_hash
+
+    def invalidate(self, path=None):
+        """Zapomnij hash pliku (lub wszystkich) - np. po zmianie wykrytej przez obserwatora katalogów"""
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(path), None)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+file_fingerprints = FileFingerprints()
+
+
+# ============================================================
+# CACHE SPARSOWANYCH SZABLONÓW DOCX (w pamięci)
+# ============================================================
+
+class TemplateCache:
+    """
+    Sparsowane dokumenty DOCX w pamięci - bez ponownego rozpakowania i parsowania XML
+    - ważność: (mtime_ns, rozmiar) pliku, przy zmianie porównanie hasha treści
+    - każde żądanie dostaje głęboką kopię drzewa (oryginał nigdy nie jest modyfikowany)
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {path: {'stat', 'hash', 'doc'}}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.parse_time = 0.0
+        self.clones = 0  # kopie w load() - także po chybieniu, a parsed() bywa wołane bez kopii
+        self.clone_time = 0.0
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def parsed(self, path):
+        """Wspólny sparsowany dokument - TYLKO DO ODCZYTU"""
+        path = os.path.abspath(path)
+        stat = self._stat(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['stat'] == stat:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry['doc']
+
+        file_hash = get_file_hash(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['hash'] == file_hash:
+                # Zmieniony mtime (np. touch / kopia), ta sama treść
+                entry['stat'] = stat
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry['doc']
+
+        start = time.perf_counter()
+        doc = Document(path)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.parse_time += elapsed
+            self.entries[path] = {'stat': stat, 'hash': file_hash, 'doc': doc}
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return doc
+
+    def load(self, path):
+        """Prywatna kopia dokumentu do modyfikacji (zamiast Document(path))"""
+        with metrics.span('template_load'):
+            doc = self.parsed(path)
+            start = time.perf_counter()
+            clone = copy.deepcopy(doc)
+        with self.lock:
+            self.clones += 1
+            self.clone_time += time.perf_counter() - start
+        return clone
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'avg_parse_ms': round(1000 * self.parse_time / self.misses, 2) if self.misses else None,
+                'avg_clone_ms': round(1000 * self.clone_time / self.clones, 2) if self.clones else None,
+            }
+
+
+template_cache = TemplateCache(TEMPLATE_CACHE_MAX_ENTRIES)
+
+
+# ============================================================
+# KONWERSJA DOCX → JPG (Unoserver + LibreOffice + PyMuPDF)
+# ============================================================
+
+class UnoserverWorker:
+    """Jeden długo żyjący proces unoserver (własny port i profil LibreOffice)"""
+
+    def __init__(self, index, port, uno_port, profile_dir):
+        self.index = index
+        self.port = port
+        self.uno_port = uno_port
+        self.profile_dir = profile_dir
+        self.process = None
+        self.active = 0  # konwersje w toku
+        self.healthy = False
+        self.restarts = 0
+        self.failures = 0  # nieudane starty z rzędu (backoff restartów)
+        self.next_retry = 0.0
+
+    @property
+    def name(self):
+        return f"worker-{self.index}@{self.port}"
+
+    def start(self):
+        """Uruchom unoserver i poczekaj aż zacznie przyjmować połączenia"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        cmd = [
+            'unoserver',
+            '--interface', '127.0.0.1',
+            '--port', str(self.port),
+            '--uno-port', str(self.uno_port),
+            '--user-installation', Path(self.profile_dir).as_uri(),
+        ]
+        self.process = subprocess.Popen(
+            cmd,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             start_new_session=True
         )
 
-        import time
-        time.sleep(2)
+        deadline = time.time() + UNOSERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            if self._port_open():
+                self.healthy = True
+                return True
+            time.sleep(0.25)
 
-        if check_unoserver_running():
-            print("[UNOSERVER] ✓ Uruchomiony pomyślnie")
-            return True
-        else:
-            print("[UNOSERVER] ❌ Nie udało się uruchomić")
-            return False
-    except FileNotFoundError:
-        print("[UNOSERVER] ❌ Nie znaleziono unoserver (pip install unoserver)")
-        return False
-    except Exception as e:
-        print(f"[UNOSERVER] ❌ Błąd: {e}")
+        self.stop()
         return False
 
-    # Zapisz w cache
-    if use_cache:
-        file_hash = get_file_hash(docx_path)
-        if file_hash:
-            conversion_cache[file_hash] = images
-            print(f"[CACHE] ✓ Saved: {os.path.basename(docx_path)}")
+    def stop(self):
+        self.healthy = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def _port_open(self):
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=0.5):
+                return True
+        except OSError:
+            return False
+
+    def check_health(self):
+        """Proces żyje i port odpowiada"""
+        self.healthy = bool(self.process and self.process.poll() is None and self._port_open())
+        return self.healthy
+
+    def convert(self, docx_path, out_pdf_path):
+        """DOCX → PDF przez ten worker"""
+        if HAS_UNOSERVER_CLIENT:
+            # Klient XML-RPC w procesie - bez forka unoconvert na każdy plik
+            client = UnoClient(server='127.0.0.1', port=str(self.port))
+            client.convert(inpath=docx_path, outpath=out_pdf_path, convert_to='pdf')
+        else:
+            docx_to_pdf_unoconvert(docx_path, out_pdf_path, port=self.port)
+
+        if not os.path.exists(out_pdf_path) or os.path.getsize(out_pdf_path) == 0:
+            raise RuntimeError("unoserver nie wygenerował PDF")
+
+
+class ConverterPool:
+    """
+    Pula N ciepłych instancji unoserver
+    - osobne porty i profile użytkownika LibreOffice
+    - health check w tle + restart padniętych workerów
+    - konwersje przydzielane do najmniej obciążonego workera
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.workers = [
+            UnoserverWorker(
+                index=i,
+                port=UNOSERVER_BASE_PORT + 2 * i,
+                uno_port=UNOSERVER_BASE_PORT - 1 + 2 * i,
+                profile_dir=os.path.join(LO_PROFILES_DIR, f'unoserver_{i}')
+            )
+            for i in range(size)
+        ]
+        self.lock = threading.Lock()
+        self.available = shutil.which('unoserver') is not None
+        self.started = False
+
+    def start(self):
+        """Uruchom wszystkich workerów równolegle + wątek health check"""
+        if self.started:
+            return
+        self.started = True
+
+        if not self.available:
+            print("[POOL] ❌ Nie znaleziono unoserver (pip install unoserver) - używam LibreOffice headless")
+            return
+
+        threads = [threading.Thread(target=self._start_worker, args=(w,), daemon=True) for w in self.workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        print(f"[POOL] ✓ Gotowe {self.healthy_count()}/{self.size} workerów unoserver")
+
+        threading.Thread(target=self._health_loop, daemon=True).start()
+        atexit.register(self.stop)
+
+    def _start_worker(self, worker):
+        try:
+            started = worker.start()
+        except Exception as e:
+            print(f"[POOL] ❌ {worker.name}: {e}")
+            started = False
+
+        if started:
+            worker.failures = 0
+            print(f"[POOL] ✓ {worker.name} uruchomiony")
+        else:
+            # Backoff: 5s, 10s, 20s... max 5 min
+            worker.failures += 1
+            worker.next_retry = time.time() + min(300, 5 * 2 ** (worker.failures - 1))
+            print(f"[POOL] ❌ {worker.name} nie wystartował")
+
+    def _health_loop(self):
+        while True:
+            time.sleep(UNOSERVER_HEALTH_INTERVAL)
+            for worker in self.workers:
+                # Nie przerywaj trwającej konwersji - sprawdzaj tylko wolnych
+                if worker.active > 0:
+                    continue
+                if worker.check_health() or time.time() < worker.next_retry:
+                    continue
+                print(f"[POOL] ⚠️ {worker.name} nie odpowiada - restart")
+                worker.stop()
+                worker.restarts += 1
+                self._start_worker(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def healthy_count(self):
+        return sum(1 for w in self.workers if w.healthy)
+
+    def _acquire(self):
+        with self.lock:
+            candidates = [w for w in self.workers if w.healthy]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda w: w.active)
+            worker.active += 1
+            return worker
+
+    def _release(self, worker):
+        with self.lock:
+            worker.active -= 1
+
+    def convert(self, docx_path, out_pdf_path):
+        """DOCX → PDF na najmniej obciążonym workerze"""
+        worker = self._acquire()
+        if worker is None:
+            raise RuntimeError("Brak sprawnych workerów unoserver")
+
+        try:
+            worker.convert(docx_path, out_pdf_path)
+        except Exception:
+            # Oznacz do restartu przez health check
+            if not worker.check_health():
+                print(f"[POOL] ⚠️ {worker.name} padł w trakcie konwersji")
+            raise
+        finally:
+            self._release(worker)
+
+    def status(self):
+        return [
+            {
+                'worker': w.name,
+                'healthy': w.healthy,
+                'active': w.active,
+                'restarts': w.restarts
+            }
+            for w in self.workers
+        ]
+
 
 def find_libreoffice():
     """Znajdź soffice w systemie"""
@@ -130,14 +1176,16 @@ def find_libreoffice():
     return None
 
 
-def docx_to_pdf_unoconvert(docx_path, out_pdf_path):
-    """Konwertuj DOCX → PDF używając unoconvert (SUPER FAST!)"""
+def docx_to_pdf_unoconvert(docx_path, out_pdf_path, port=UNOSERVER_BASE_PORT):
+    """Konwertuj DOCX → PDF używając CLI unoconvert (gdy brak klienta w Pythonie)"""
     if not shutil.which('unoconvert'):
         raise RuntimeError("unoconvert nie znalezione")
 
     try:
         cmd = [
             'unoconvert',
+            '--host', '127.0.0.1',
+            '--port', str(port),
             '--convert-to', 'pdf',
             docx_path,
             out_pdf_path
@@ -156,6 +1204,16 @@ def docx_to_pdf_unoconvert(docx_path, out_pdf_path):
         raise RuntimeError(f"unoconvert failed: {e}")
 
 
+def soffice_profiles_root():
+    """Katalog profili soffice tego procesu (usuwany przy wyjściu)"""
+    global soffice_profiles_pid
+    root = os.path.join(LO_PROFILES_DIR, f'soffice_{os.getpid()}')
+    if soffice_profiles_pid != os.getpid():
+        soffice_profiles_pid = os.getpid()
+        atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
 def docx_to_pdf_libreoffice(docx_path, out_pdf_path):
     """Konwertuj DOCX → PDF używając LibreOffice (fallback)"""
     soffice = find_libreoffice()
@@ -164,10 +1222,14 @@ def docx_to_pdf_libreoffice(docx_path, out_pdf_path):
 
     outdir = os.path.dirname(out_pdf_path)
 
-    # Mutex - tylko jedna konwersja LibreOffice naraz
-    with libreoffice_lock:
+    # Każdy slot ma własny profil - kilka soffice może działać równolegle; sloty są per proces
+    # (np. procesy partii), więc profil też - inaczej dwa procesy dzielą katalog i soffice się blokuje
+    slot = libreoffice_slots.get()
+    try:
+        profile_dir = os.path.join(soffice_profiles_root(), f'slot_{slot}')
         cmd = [
             soffice,
+            f'-env:UserInstallation={Path(profile_dir).as_uri()}',
             '--headless',
             '--nologo',
             '--nodefault',
@@ -197,31 +1259,41 @@ def docx_to_pdf_libreoffice(docx_path, out_pdf_path):
         # Przenieś do oczekiwanej lokalizacji
         if str(candidate) != out_pdf_path:
             shutil.move(str(candidate), out_pdf_path)
+    finally:
+        libreoffice_slots.put(slot)
 
 
-def pdf_to_jpg_pymupdf(pdf_path, dpi=200, quality=90):
-    """Konwertuj PDF → JPG używając PyMuPDF (SUPER FAST!)"""
-    if not HAS_PYMUPDF:
-        raise RuntimeError("PyMuPDF nie zainstalowane! pip install pymupdf")
-
-    zoom = dpi / 72.0
-    mat = fitz.Matrix(zoom, zoom)
-    images = []
+def docx_to_pdf(docx_path, out_pdf_path):
+    """DOCX → PDF: pula unoserver (SZYBKA!), fallback do LibreOffice headless"""
+    if converter_pool.healthy_count() > 0:
+        start = time.perf_counter()
+        try:
+            converter_pool.convert(docx_path, out_pdf_path)
+            metrics.record('docx_to_pdf', time.perf_counter() - start, converter='unoconvert')
+            metrics.inc('conversions_total', converter='unoconvert', result='ok')
+            return
+        except Exception as e:
+            metrics.inc('conversions_total', converter='unoconvert', result='error')
+            print(f"[CONVERT] ⚠️ unoserver failed: {e}, fallback do LibreOffice...")
 
-    with fitz.open(pdf_path) as doc:
-        for page in doc:
-            pix = page.get_pixmap(matrix=mat, alpha=False)
+    print(f"[CONVERT] Używam LibreOffice headless")
+    start = time.perf_counter()
+    try:
+        docx_to_pdf_libreoffice(docx_path, out_pdf_path)
+    except Exception:
+        metrics.inc('conversions_total', converter='soffice', result='error')
+        raise
+    metrics.record('docx_to_pdf', time.perf_counter() - start, converter='soffice')
+    metrics.inc('conversions_total', converter='soffice', result='ok')
 
-            # Zapisz do bytes
-            img_bytes = pix.tobytes("jpeg", jpg_quality=quality)
-            img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-            images.append(f"data:image/jpeg;base64,{img_base64}")
 
-    return images
+def pdf_to_jpg_pymupdf(pdf_path, dpi=RENDER_DPI, quality=RENDER_QUALITY):
+    """Konwertuj PDF → JPG używając PyMuPDF (SUPER FAST!) - zwraca bajty JPEG"""
+    return [images[0] for images in iter_pdf_pages(pdf_path, ((dpi, quality),))]
 
 
-def pdf_to_jpg_pdf2image(pdf_path, dpi=200):
-    """Fallback: Konwertuj PDF → JPG używając pdf2image"""
+def pdf_to_jpg_pdf2image(pdf_path, dpi=RENDER_DPI, quality=RENDER_QUALITY):
+    """Fallback: Konwertuj PDF → JPG używając pdf2image - zwraca bajty JPEG"""
     from PIL import Image
     import io
 
@@ -235,365 +1307,2940 @@ def pdf_to_jpg_pdf2image(pdf_path, dpi=200):
             bg.paste(page, mask=page.split()[3])
             page = bg
 
-        # Zapisz jako JPEG
-        buffered = io.BytesIO()
-        page.save(buffered, format="JPEG", quality=85, optimize=True)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        images.append(f"data:image/jpeg;base64,{img_base64}")
+        # Zapisz jako JPEG
+        buffered = io.BytesIO()
+        page.save(buffered, format="JPEG", quality=quality, optimize=True)
+        images.append(buffered.getvalue())
+
+    return images
+
+
+def rasterize_pdf_page(pdf_path, page_no, settings):
+    """
+    Jedna strona PDF → bajty JPEG dla każdego (dpi, quality) z settings
+    Strona wczytana raz - kolejne rozdzielczości to tylko kolejny pixmap
+    (uruchamiane też w procesach puli - czasy wracają do procesu głównego)
+    Zwraca (lista bajtów JPEG, sekundy rasteryzacji, sekundy kodowania JPEG)
+    """
+    images = []
+    raster_time = encode_time = 0.0
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_no]
+        for dpi, quality in settings:
+            zoom = dpi / 72.0
+            start = time.perf_counter()
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            raster_time += time.perf_counter() - start
+            start = time.perf_counter()
+            images.append(pix.tobytes("jpeg", jpg_quality=quality))
+            encode_time += time.perf_counter() - start
+    return images, raster_time, encode_time
+
+
+def record_page_timing(result):
+    """Czasy strony z rasterize_pdf_page do metryk / śladu - zwraca same obrazy"""
+    images, raster_time, encode_time = result
+    metrics.record('rasterize', raster_time)
+    metrics.record('encode', encode_time)
+    return images
+
+
+def get_raster_pool():
+    """
+    Pula procesów do rasteryzacji (tworzona leniwie)
+    PyMuPDF nie jest thread-safe i trzyma GIL - równolegle tylko w osobnych procesach
+    """
+    global raster_pool
+    if RASTER_WORKERS <= 1 or not HAS_PYMUPDF:
+        return None
+
+    with raster_pool_lock:
+        if raster_pool is None:
+            raster_pool = ProcessPoolExecutor(
+                max_workers=RASTER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return raster_pool
+
+
+def reset_raster_pool():
+    """Porzuć zepsutą pulę (np. po crashu procesu) - następna zostanie utworzona od nowa"""
+    global raster_pool
+    with raster_pool_lock:
+        if raster_pool is not None:
+            raster_pool.shutdown(wait=False, cancel_futures=True)
+        raster_pool = None
+
+
+def iter_pdf_pages(pdf_path, settings=((RENDER_DPI, RENDER_QUALITY),)):
+    """
+    Generator: dla kolejnych stron PDF lista bajtów JPEG (po jednym na (dpi, quality))
+    Strony rysowane równolegle w puli procesów, oddawane w kolejności
+    - pierwsza strona wychodzi zanim narysuje się ostatnia
+    """
+    settings = tuple(settings)
+
+    if not HAS_PYMUPDF:
+        # pdf2image nie umie stron pojedynczo - całość naraz, osobno dla każdej rozdzielczości
+        with metrics.span('rasterize', backend='pdf2image'):
+            rendered = [pdf_to_jpg_pdf2image(pdf_path, dpi=dpi, quality=quality) for dpi, quality in settings]
+        yield from (list(images) for images in zip(*rendered))
+        return
+
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+
+    pool = get_raster_pool() if page_count > 1 else None
+    next_page = 0
+
+    if pool is not None:
+        futures = [pool.submit(rasterize_pdf_page, pdf_path, n, settings) for n in range(page_count)]
+        try:
+            for future in futures:
+                yield record_page_timing(future.result())
+                next_page += 1
+        except BrokenProcessPool:
+            print("[RASTER] ⚠️ Pula procesów padła - dokończę w wątku")
+            reset_raster_pool()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    # Sekwencyjnie w bieżącym procesie (brak puli / pojedyncza strona / fallback)
+    for n in range(next_page, page_count):
+        yield record_page_timing(rasterize_pdf_page(pdf_path, n, settings))
+
+
+def iter_tier_pages(pdf_path, tiers):
+    """Generator: {poziom: bajty JPEG} dla kolejnych stron PDF (wszystkie poziomy z jednego wczytania)"""
+    settings = [(RENDER_TIERS[tier]['dpi'], RENDER_TIERS[tier]['quality']) for tier in tiers]
+    for images in iter_pdf_pages(pdf_path, settings):
+        yield dict(zip(tiers, images))
+
+
+def get_cached_page_hashes(content_hash, tiers):
+    """[{poziom: hash}] dla stron z cache - None gdy któregoś poziomu brakuje"""
+    per_tier = {}
+    for tier in tiers:
+        hashes = render_cache.get_page_hashes(RenderCache.make_key(content_hash, tier))
+        if hashes is None:
+            return None
+        per_tier[tier] = hashes
+
+    if len({len(hashes) for hashes in per_tier.values()}) > 1:
+        return None
+    return [dict(zip(per_tier, page)) for page in zip(*per_tier.values())]
+
+
+def read_cached_pages(content_hash, tiers):
+    """[{poziom: bajty JPEG}] wszystkich stron z cache - None gdy czegoś brakuje"""
+    cached = get_cached_page_hashes(content_hash, tiers)
+    if cached is None:
+        return None
+
+    pages = []
+    for page in cached:
+        images = {tier: render_cache.read_blob(blob_hash) for tier, blob_hash in page.items()}
+        if any(img_bytes is None for img_bytes in images.values()):
+            return None
+        pages.append(images)
+    return pages
+
+
+def iter_rendered_pages(content_hash, write_docx, tiers=PREVIEW_TIERS, progress_callback=None, label=''):
+    """
+    Strumieniowo: {poziom: bajty JPEG} kolejnych stron treści o danym hashu
+    1. Wszystkie poziomy w cache → odczyt blobów
+    2. PDF w cache → tylko rasteryzacja (np. pełna jakość na zoom)
+    3. write_docx(tmpdir) → DOCX → PDF (pula unoserver / LibreOffice), PDF trafia do cache
+    Komplet stron każdego poziomu trafia do cache po ostatniej stronie
+    Renderuje jeden proces naraz (fill_lock) - pozostałe czekają i czytają wynik z cache
+    """
+    tiers = tuple(tiers)
+    pages = read_cached_pages(content_hash, tiers)
+    if pages is not None:
+        print(f"[CACHE] ⚡ Hit: {label}")
+        page_count_index.put(content_hash, len(pages))
+        yield from pages
+        return
+
+    with render_cache.fill_lock(content_hash):
+        # Inny worker mógł właśnie skończyć ten sam dokument
+        pages = read_cached_pages(content_hash, tiers)
+        if pages is not None:
+            print(f"[CACHE] ⚡ Hit (po oczekiwaniu): {label}")
+            page_count_index.put(content_hash, len(pages))
+            yield from pages
+            return
+
+        pages = []
+
+        # Tymczasowy PDF
+        with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+            pdf_path = os.path.join(tmpdir, 'out.pdf')
+            pdf_key = RenderCache.make_key(content_hash, 'pdf')
+            pdf_hashes = render_cache.get_page_hashes(pdf_key)
+
+            if pdf_hashes and render_cache.copy_blob(pdf_hashes[0], pdf_path):
+                print(f"[CACHE] ⚡ PDF hit: {label}")
+            else:
+                if write_docx is None:
+                    raise LookupError(f'Brak PDF w cache: {label}')
+
+                print(f"[CONVERT] Start: {label}")
+                if progress_callback:
+                    progress_callback("Konwersja DOCX → PDF...", 20)
+
+                # DOCX → PDF
+                docx_to_pdf(write_docx(tmpdir), pdf_path)
+                with open(pdf_path, 'rb') as f:
+                    render_cache.put_pages(pdf_key, [f.read()])
+
+            if progress_callback:
+                progress_callback("Konwersja PDF → JPG...", 50)
+
+            # PDF → JPG
+            for images in iter_tier_pages(pdf_path, tiers):
+                pages.append(images)
+                yield images
+
+        # Zapisz w cache (każdy poziom osobno)
+        for tier in tiers:
+            render_cache.put_pages(RenderCache.make_key(content_hash, tier), [page[tier] for page in pages])
+        page_count_index.put(content_hash, len(pages))
+    print(f"[CONVERT] ✓ Done: {label} ({len(pages)} stron)")
+
+
+def iter_docx_pages(docx_path, use_cache=True, progress_callback=None, content_hash=None, tiers=PREVIEW_TIERS):
+    """
+    Strumieniowo: DOCX → {poziom: bajty JPEG} kolejnych stron
+    Klucz cache z hasha pliku lub podany content_hash
+    """
+    if content_hash is None:
+        content_hash = get_file_hash(docx_path) if use_cache else None
+
+    if not content_hash:
+        # Bez cache - jednorazowa konwersja
+        with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+            pdf_path = os.path.join(tmpdir, 'out.pdf')
+            if progress_callback:
+                progress_callback("Konwersja DOCX → PDF...", 20)
+            docx_to_pdf(docx_path, pdf_path)
+            if progress_callback:
+                progress_callback("Konwersja PDF → JPG...", 50)
+            yield from iter_tier_pages(pdf_path, tuple(tiers))
+        return
+
+    yield from iter_rendered_pages(content_hash, lambda tmpdir: docx_path, tiers=tiers,
+                                   progress_callback=progress_callback, label=os.path.basename(docx_path))
+
+
+def convert_docx_to_images(docx_path, use_cache=True, progress_callback=None, content_hash=None, tier='full'):
+    """Główna funkcja: DOCX → lista bajtów JPEG (komplet stron jednego poziomu)"""
+    return [page[tier] for page in iter_docx_pages(docx_path, use_cache=use_cache, progress_callback=progress_callback,
+                                                    content_hash=content_hash, tiers=(tier,))]
+
+
+def warm_docx(docx_path, tiers=PREVIEW_TIERS):
+    """Wygrzej cache podglądu pliku (PDF + poziomy podglądu) - zwraca liczbę stron"""
+    pages = 0
+    for _ in iter_docx_pages(docx_path, tiers=tiers):
+        pages += 1
+    return pages
+
+
+def get_file_hash(filepath):
+    """Hash pliku dla cache (memoizowany - niezmieniony plik nie jest ponownie czytany)"""
+    return file_fingerprints.get(filepath)
+
+
+converter_pool = ConverterPool(CONVERTER_WORKERS)
+
+
+# ============================================================
+# ROZGRZEWANIE CACHE NA STARCIE
+# ============================================================
+
+class UsageStats:
+    """
+    Jak często pliki trafiają do ofert - kolejność rozgrzewania po restarcie (trwałe)
+    Zapis na dysk odroczony (flush_interval) i przy wyjściu - bez I/O w ścieżce żądania
+    """
+
+    def __init__(self, path, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.timer = None  # zaplanowany zapis (None = brak zmian do zapisania)
+        atexit.register(self.flush)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.counts = json.load(f)
+        except (OSError, ValueError):
+            self.counts = {}
+
+    @staticmethod
+    def item_id(path):
+        return os.path.relpath(path, BASE_DIR)
+
+    def record_offer(self, template_data, selected_products):
+        """Zlicz pliki szablonu i produkty jednej oferty"""
+        paths = [os.path.join(PRODUKTY_DIR, f'{product_id}.docx') for product_id in selected_products]
+        paths += template_source_paths(template_data)
+
+        with self.lock:
+            for path in paths:
+                item = self.item_id(path)
+                self.counts[item] = self.counts.get(item, 0) + 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Zapisz liczniki, jeśli zmieniły się od ostatniego zapisu"""
+        with self.lock:
+            if self.timer is None:
+                return
+            self.timer.cancel()
+            self.timer = None
+            data = json.dumps(self.counts).encode('utf-8')
+            RenderCache._write_atomic(self.path, data)
+
+    def get(self, path):
+        with self.lock:
+            return self.counts.get(self.item_id(path), 0)
+
+
+usage_stats = UsageStats(os.path.join(RENDER_CACHE_DIR, 'usage.json'))
+
+
+def warm_template(filepath):
+    """Rozgrzej plik szablonu: poziomy podglądu + pełna jakość, statyczne JPG w out_jpg/ - zwraca liczbę stron"""
+    out_folder = os.path.join(OUT_JPG_DIR, os.path.splitext(os.path.basename(filepath))[0])
+    os.makedirs(out_folder, exist_ok=True)
+
+    # Poziomy podglądu + pełna jakość z jednego parsowania PDF (cache - ciepły restart pomija LibreOffice)
+    pages = 0
+    for pages, page in enumerate(iter_docx_pages(filepath, tiers=PREVIEW_TIERS + ('full',)), 1):
+        with open(os.path.join(out_folder, f'page_{pages:04d}.jpg'), 'wb') as f:
+            f.write(page['full'])
+    return pages
+
+
+def warm_single_file_template(filepath):
+    """Rozgrzej części szablonu single-file (podział przy markerze) - zwraca liczbę stron"""
+    for template in load_templates():
+        if template.get('type') == 'single_file' and filepath in template_source_paths(template):
+            return sum(warm_docx(part['path']) for part in template_parts(template))
+    return warm_docx(filepath)
+
+
+class WarmupScheduler:
+    """
+    Rozgrzewanie cache na starcie
+    - równolegle (tyle wątków co workerów konwertera)
+    - najczęściej używane pliki najpierw
+    - jedno rozgrzewanie na grupę procesów (flock) - pozostałe procesy tylko sprawdzają cache
+    """
+
+    def __init__(self, lock_path, workers):
+        self.lock_path = lock_path
+        self.workers = workers
+        self.items = []
+        self.lock = threading.Lock()
+        self.leader = False
+        self.lock_file = None
+        self.started = None
+        self.finished = None
+
+    def collect_items(self):
+        """Pliki do rozgrzania: szablony (single-file - części z podziału) + produkty, posortowane wg użycia"""
+        items = []
+        for template in load_templates():
+            if template.get('type') == 'single_file':
+                try:
+                    parts = template_parts(template)
+                except Exception as e:
+                    print(f"[WARMUP] ⚠️ Podział szablonu {template.get('id')}: {e}")
+                    continue
+                source = template_source_paths(template)[0]
+                items += [{'kind': 'part', 'path': part['path'], 'source': source}
+                          for part in parts if os.path.exists(part['path'])]
+                continue
+            for path in template_source_paths(template):
+                if os.path.exists(path):
+                    items.append({'kind': 'template', 'path': path})
+
+        if os.path.exists(PRODUKTY_DIR):
+            for filename in sorted(os.listdir(PRODUKTY_DIR)):
+                if filename.endswith('.docx') and not filename.startswith('~$'):
+                    items.append({'kind': 'product', 'path': os.path.join(PRODUKTY_DIR, filename)})
+
+        for order, item in enumerate(items):
+            item.update(id=UsageStats.item_id(item['path']), status='pending',
+                        usage=usage_stats.get(item.get('source', item['path'])),
+                        order=order)
+        # Stabilnie: użycie malejąco, przy remisie kolejność domyślna (szablony przed produktami)
+        items.sort(key=lambda item: (-item['usage'], item['order']))
+        return items
+
+    def _acquire_leadership(self):
+        """Tylko jeden proces w grupie rozgrzewa (reloader, kilka workerów) - blokada pliku"""
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        self.lock_file = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        self.lock_file.write(str(os.getpid()))
+        self.lock_file.flush()
+        return True
+
+    def _warm(self, item):
+        with self.lock:
+            item['status'] = 'running'
+        start = time.time()
+        try:
+            if item['kind'] == 'template':
+                item['pages'] = warm_template(item['path'])
+            else:
+                item['pages'] = warm_docx(item['path'])
+            status = 'ready'
+        except Exception as e:
+            item['error'] = str(e)
+            status = 'failed'
+        with self.lock:
+            item['status'] = status
+            item['time'] = round(time.time() - start, 2)
+        print(f"[WARMUP] {'✓' if status == 'ready' else '✗'} {item['id']} ({item['time']}s)")
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='warmup') as executor:
+            list(executor.map(self._warm, self.items))
+        self.finished = time.time()
+        done = sum(1 for item in self.items if item['status'] == 'ready')
+        print(f"[WARMUP] ✅ {done}/{len(self.items)} plików w {self.finished - self.started:.1f}s")
+
+    def start(self):
+        """Rozgrzewanie w tle (lider) lub tylko śledzenie cache (pozostałe procesy)"""
+        self.started = time.time()
+        self.items = self.collect_items()
+        self.leader = self._acquire_leadership()
+
+        if not self.leader:
+            print("[WARMUP] Rozgrzewa inny proces - czekam na wspólny cache")
+            return
+
+        print(f"[WARMUP] 🚀 {len(self.items)} plików, {self.workers} równolegle")
+        threading.Thread(target=self._run, daemon=True, name='warmup').start()
+
+    def _refresh_from_cache(self):
+        """Proces nie-lider: plik gotowy gdy jego strony są w cache na dysku"""
+        for item in self.items:
+            if item['status'] != 'ready':
+                file_hash = get_file_hash(item['path'])
+                pages = get_cached_page_hashes(file_hash, PREVIEW_TIERS) if file_hash else None
+                if pages is not None:
+                    item.update(status='ready', pages=len(pages))
+
+    def status(self):
+        with self.lock:
+            if not self.leader:
+                self._refresh_from_cache()
+            items = [{key: value for key, value in item.items() if key not in ('path', 'order')} for item in self.items]
+
+        counts = {}
+        for item in items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        return {
+            'ready': self.started is not None and not any(item['status'] in ('pending', 'running') for item in items),
+            'leader': self.leader,
+            'elapsed': f"{(self.finished or time.time()) - self.started:.1f}s" if self.started else None,
+            'counts': counts,
+            'items': items,
+        }
+
+
+warmup = WarmupScheduler(os.path.join(RENDER_CACHE_DIR, 'warmup.lock'), CONVERTER_WORKERS)
+
+
+class TemplateWatcher:
+    """
+    Obserwator plików produktów i szablonów - zmiany widoczne bez restartu
+    - wykrywa dodane / zmienione / usunięte DOCX (+ konfiguracje JSON szablonów) porównując migawki stat
+    - watchdog (inotify) gdy zainstalowany - skan od razu po zdarzeniu; zawsze także odpytywanie co WATCH_INTERVAL
+    - przerenderowuje w tle tylko zmienione pliki, potem zdarzenie 'templates_changed' do wszystkich klientów
+    """
+
+    def __init__(self, roots, interval, workers):
+        self.roots = roots
+        self.interval = interval
+        self.workers = workers
+        self.wake = threading.Event()
+        self.snapshot = {}
+        self.observer = None
+
+    @staticmethod
+    def is_watched(filename):
+        if filename.startswith('~$'):
+            return False
+        return filename.endswith('.docx') or filename.endswith('.json')
+
+    def scan(self):
+        """{ścieżka: (rozmiar, mtime_ns, inode)} obserwowanych plików"""
+        files = {}
+        for root in self.roots:
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    if not self.is_watched(filename):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return files
+
+    def diff(self, files):
+        added = sorted(path for path in files if path not in self.snapshot)
+        removed = sorted(path for path in self.snapshot if path not in files)
+        changed = sorted(path for path in files if path in self.snapshot and files[path] != self.snapshot[path])
+        return added, changed, removed
+
+    @staticmethod
+    def render_for(path):
+        """Funkcja rozgrzewająca cache pliku (None = tylko powiadomienie, np. konfiguracja JSON)"""
+        if not path.endswith('.docx'):
+            return None
+        if os.path.dirname(path) == PRODUKTY_DIR:
+            return warm_docx
+        if any(template.get('type') == 'single_file' and path in template_source_paths(template)
+               for template in load_templates()):
+            return warm_single_file_template
+        if os.path.dirname(os.path.dirname(path)) == TEMPLATES_DIR:
+            return warm_template
+        return warm_docx
+
+    def handle(self, added, changed, removed):
+        for path in added + changed + removed:
+            file_fingerprints.invalidate(path)
+
+        # Gotowe oferty z tych plików nieaktualne; zmiana konfiguracji JSON - wszystkie
+        if any(path.endswith('.json') for path in added + changed + removed):
+            dropped = offer_cache.invalidate()
+        else:
+            dropped = offer_cache.invalidate(added + changed + removed)
+        if dropped:
+            print(f"[WATCH] 🗑️ Unieważniono gotowych ofert: {dropped}")
+
+        # Przerenderuj tylko nowe i zmienione pliki (nowy hash = nowe wpisy cache, stare wygasną w LRU)
+        to_render = [(path, self.render_for(path)) for path in added + changed]
+        to_render = [(path, render) for path, render in to_render if render is not None]
+        failed = []
+
+        def rerender(item):
+            path, render = item
+            try:
+                render(path)
+                print(f"[WATCH] ✓ Przerenderowano: {os.path.relpath(path, BASE_DIR)}")
+            except Exception as e:
+                failed.append(os.path.relpath(path, BASE_DIR))
+                print(f"[WATCH] ✗ {os.path.relpath(path, BASE_DIR)}: {e}")
+
+        if to_render:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='watch') as executor:
+                list(executor.map(rerender, to_render))
+
+        def relpaths(paths):
+            return [os.path.relpath(path, BASE_DIR).replace(os.sep, '/') for path in paths]
+
+        affected = added + changed + removed
+        payload = {
+            'added': relpaths(added),
+            'changed': relpaths(changed),
+            'removed': relpaths(removed),
+            'products': sorted(os.path.splitext(os.path.basename(path))[0] for path in affected
+                               if os.path.dirname(path) == PRODUKTY_DIR and path.endswith('.docx')),
+            'failed': failed,
+        }
+        socketio.emit('templates_changed', payload)
+        print(f"[WATCH] 📣 templates_changed: +{len(added)} ~{len(changed)} -{len(removed)}")
+
+    def _start_observer(self):
+        """watchdog (inotify / FSEvents) - tylko budzi pętlę skanującą"""
+        if not HAS_WATCHDOG:
+            return
+        watcher = self
+
+        class Handler:
+            def dispatch(self, event):
+                if watcher.is_watched(os.path.basename(getattr(event, 'dest_path', '') or event.src_path)):
+                    watcher.wake.set()
+
+        try:
+            self.observer = Observer()
+            for root in self.roots:
+                self.observer.schedule(Handler(), root, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+        except Exception as e:
+            print(f"[WATCH] watchdog niedostępny ({e}) - tylko odpytywanie")
+            self.observer = None
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            if self.wake.is_set():
+                # Edytor zapisuje plik w kilku krokach - odczekaj aż skończy
+                time.sleep(WATCH_DEBOUNCE)
+                self.wake.clear()
+
+            files = self.scan()
+            added, changed, removed = self.diff(files)
+            self.snapshot = files
+            if added or changed or removed:
+                try:
+                    self.handle(added, changed, removed)
+                except Exception as e:
+                    print(f"[WATCH] ✗ Błąd obsługi zmian: {e}")
+
+    def start(self):
+        self.snapshot = self.scan()
+        self._start_observer()
+        threading.Thread(target=self._run, daemon=True, name='template-watcher').start()
+        mode = 'watchdog + odpytywanie' if self.observer else 'odpytywanie'
+        print(f"[WATCH] 👀 Obserwuję {len(self.snapshot)} plików ({mode} co {self.interval}s)")
+
+
+template_watcher = TemplateWatcher([PRODUKTY_DIR, TEMPLATES_DIR], WATCH_INTERVAL, CONVERTER_WORKERS)
+
+
+# ============================================================
+# POMOCNICZE FUNKCJE
+# ============================================================
+
+class ClientChannel:
+    """
+    Kanał WebSocket do jednego klienta (sid) z ograniczeniem niepotwierdzonych zdarzeń
+    Wolny klient nie powoduje buforowania bez końca - progress jest pomijany od razu,
+    strona czeka na miejsce najwyżej SOCKET_ACK_TIMEOUT
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.in_flight = deque()  # czasy wysłania niepotwierdzonych zdarzeń
+        self.cond = threading.Condition()
+        self.connected = True
+        self.dropped = 0
+
+    def _has_room(self):
+        # Brak potwierdzenia po SOCKET_ACK_TIMEOUT = zdarzenie uznane za utracone
+        deadline = time.time() - SOCKET_ACK_TIMEOUT
+        while self.in_flight and self.in_flight[0] < deadline:
+            self.in_flight.popleft()
+        return not self.connected or len(self.in_flight) < SOCKET_MAX_IN_FLIGHT
+
+    def _ack(self, *args):
+        with self.cond:
+            if self.in_flight:
+                self.in_flight.popleft()
+            self.cond.notify()
+
+    def send(self, event, data, wait=True):
+        """Wyślij zdarzenie z potwierdzeniem - False gdy pominięte (kanał pełny / klient rozłączony)"""
+        with self.cond:
+            if wait:
+                self.cond.wait_for(self._has_room, timeout=SOCKET_ACK_TIMEOUT)
+            if not self.connected or not self._has_room():
+                self.dropped += 1
+                return False
+            self.in_flight.append(time.time())
+
+        try:
+            socketio.emit(event, data, to=self.sid, callback=self._ack)
+            return True
+        except Exception:
+            self._ack()
+            return False
+
+    def close(self):
+        with self.cond:
+            self.connected = False
+            self.cond.notify_all()
+
+
+client_channels = {}  # {sid: ClientChannel}
+client_channels_lock = threading.Lock()
+
+
+def job_channels():
+    """Kanały klientów zainteresowanych bieżącym zadaniem (pusto poza kolejką)"""
+    job = job_manager.current()
+    if job is None:
+        return []
+    with client_channels_lock:
+        return [client_channels[sid] for sid in list(job.clients) if sid in client_channels]
+
+
+def send_progress(message, percent):
+    """Wyślij progress do klientów zadania (i zapisz w bieżącym zadaniu) - stratnie"""
+    job = job_manager.current()
+    if job is not None:
+        job.check_cancelled()
+        job.message = message
+        job.percent = percent
+
+    for channel in job_channels():
+        # Nowszy progress i tak zastąpi ten - przy pełnym kanale pomiń
+        channel.send('conversion_progress', {'message': message, 'percent': percent}, wait=False)
+
+
+def send_job_event(event, data, wait=True):
+    """Wyślij zdarzenie do klientów bieżącego zadania - zwraca sid klientów, dla których pominięto"""
+    job = job_manager.current()
+    if job is not None:
+        job.check_cancelled()
+        data = {**data, 'job_id': job.id}
+
+    return [channel.sid for channel in job_channels() if not channel.send(event, data, wait=wait)]
+
+
+def send_page_ready(page_data):
+    """Wyślij gotową stronę do klientów zadania (z ograniczeniem niepotwierdzonych)"""
+    with metrics.span('emit'):
+        skipped = send_job_event('page_ready', page_data)
+    for sid in skipped:
+        print(f"[WebSocket] ⚠️ Pominięto stronę {page_data['number']} dla {sid} (wolny klient)")
+
+
+def iter_text_parts(doc):
+    """Części dokumentu z tekstem: treść (z polami tekstowymi) + nagłówki i stopki - (nazwa części, element)"""
+    yield str(doc.part.partname), doc.part.element
+    for rel in doc.part.rels.values():
+        if not rel.is_external and rel.reltype in (RT.HEADER, RT.FOOTER):
+            yield str(rel.target_part.partname), rel.target_part.element
+
+
+def paragraph_text_nodes(paragraph):
+    """Elementy w:t należące do paragrafu (bez paragrafów zagnieżdżonych w polach tekstowych)"""
+    nodes = []
+    for node in paragraph.iter(W_T):
+        parent = node.getparent()
+        while parent is not None and parent.tag != W_P:
+            parent = parent.getparent()
+        if parent is paragraph:
+            nodes.append(node)
+    return nodes
+
+
+def compile_placeholder_plan(doc):
+    """
+    Jednorazowy skan dokumentu: które paragrafy (w kolejności w części) mają placeholdery
+    Plan: {'names': frozenset(nazw), 'paragraphs': {nazwa części: [numery paragrafów]}}
+    Placeholder może być pocięty na kilka runów (np. przez sprawdzanie pisowni)
+    """
+    names = set()
+    paragraphs = {}
+    for part_name, root in iter_text_parts(doc):
+        ordinals = []
+        for ordinal, paragraph in enumerate(root.iter(W_P)):
+            text = ''.join(node.text or '' for node in paragraph_text_nodes(paragraph))
+            found = PLACEHOLDER_RE.findall(text) if '{{' in text else None
+            if found:
+                names.update(found)
+                ordinals.append(ordinal)
+        if ordinals:
+            paragraphs[part_name] = ordinals
+    return {'names': frozenset(names), 'paragraphs': paragraphs}
+
+
+def set_text_node(node, text):
+    """Ustaw tekst w:t - tabulatory i nowe linie jako w:tab / w:br w tym samym runie"""
+    chunks = re.split(r'(\t|\n)', text)
+    node.text = chunks[0]
+    node.set(qn('xml:space'), 'preserve')
+
+    anchor = node
+    for chunk in chunks[1:]:
+        if chunk == '\t':
+            element = OxmlElement('w:tab')
+        elif chunk == '\n':
+            element = OxmlElement('w:br')
+        elif chunk:
+            element = OxmlElement('w:t')
+            element.text = chunk
+            element.set(qn('xml:space'), 'preserve')
+        else:
+            continue
+        anchor.addnext(element)
+        anchor = element
+
+
+def fill_paragraph(paragraph, values):
+    """
+    Podmień placeholdery w paragrafie na poziomie runów
+    Wartość trafia do runu, w którym placeholder się zaczyna (zachowuje jego formatowanie),
+    reszta placeholdera jest wycinana z kolejnych runów
+    """
+    nodes = paragraph_text_nodes(paragraph)
+    texts = [node.text or '' for node in nodes]
+    full = ''.join(texts)
+
+    starts = []
+    pos = 0
+    for text in texts:
+        starts.append(pos)
+        pos += len(text)
+    lengths = [len(text) for text in texts]
+
+    matches = [m for m in PLACEHOLDER_RE.finditer(full) if m.group(1) in values]
+    changed = set()
+    # Od końca - wcześniejsze pozycje pozostają ważne
+    for match in reversed(matches):
+        begin, end = match.span()
+        inserted = False
+        for i in range(len(nodes)):
+            node_start, node_end = starts[i], starts[i] + lengths[i]
+            if node_end <= begin or node_start >= end or not lengths[i]:
+                continue
+            lo, hi = max(begin, node_start) - node_start, min(end, node_end) - node_start
+            replacement = '' if inserted else values[match.group(1)]
+            texts[i] = texts[i][:lo] + replacement + texts[i][hi:]
+            inserted = True
+            changed.add(i)
+
+    for i in sorted(changed, reverse=True):
+        set_text_node(nodes[i], texts[i])
+    return len(matches)
+
+
+def fill_placeholders(doc, plan, data):
+    """Wypełnij wszystkie wartości w jednym przejściu po paragrafach z planu - zachowuje formatowanie"""
+    with metrics.span('placeholder_fill'):
+        values = {key: str(value) for key, value in data.items() if key != 'produkty'}
+        if not plan['names'] & values.keys():
+            return doc
+
+        for part_name, root in iter_text_parts(doc):
+            ordinals = plan['paragraphs'].get(part_name)
+            if not ordinals:
+                continue
+            wanted = set(ordinals)
+            last = ordinals[-1]
+            for ordinal, paragraph in enumerate(root.iter(W_P)):
+                if ordinal in wanted:
+                    fill_paragraph(paragraph, values)
+                if ordinal >= last:
+                    break
+        return doc
+
+
+def replace_placeholders(doc, data):
+    """Zamień {{placeholders}} w dokumencie (treść, tabele, pola tekstowe, nagłówki, stopki)"""
+    return fill_placeholders(doc, compile_placeholder_plan(doc), data)
+
+
+def style_signature(style):
+    """Definicja stylu do porównania (bez deklaracji przestrzeni nazw dokumentu)"""
+    return etree.tostring(style, method='c14n', exclusive=True)
+
+
+class OoxmlPackage:
+    """Paczka DOCX (zip) do odczytu: typy zawartości, relacje części, główny dokument"""
+
+    def __init__(self, source):
+        self.zip = zipfile.ZipFile(source)
+        self.names = set(self.zip.namelist())
+        types = etree.fromstring(self.zip.read('[Content_Types].xml'))
+        self.defaults = {el.get('Extension').lower(): el.get('ContentType') for el in types.iter(CT_DEFAULT)}
+        self.overrides = {el.get('PartName'): el.get('ContentType') for el in types.iter(CT_OVERRIDE)}
+        self.rels_cache = {}
+        self.main = next(rel['target'] for rel in self.rels('').values() if rel['type'] == RT.OFFICE_DOCUMENT)
+        self.copied = {}  # {część źródła: część wyniku} - każda część kopiowana raz
+
+    @staticmethod
+    def rels_name(partname):
+        """word/document.xml → word/_rels/document.xml.rels ('' = relacje paczki)"""
+        directory, filename = posixpath.split(partname)
+        return posixpath.join(directory, '_rels', f'{filename}.rels')
+
+    @staticmethod
+    def resolve(partname, target):
+        """Cel relacji względem katalogu części (lub bezwzględny '/...') → nazwa w zipie"""
+        if target.startswith('/'):
+            return target[1:]
+        return posixpath.normpath(posixpath.join(posixpath.dirname(partname), target))
+
+    def content_type(self, partname):
+        return self.overrides.get(f'/{partname}') or self.defaults.get(posixpath.splitext(partname)[1][1:].lower())
+
+    def xml(self, partname):
+        return etree.fromstring(self.zip.read(partname)) if partname in self.names else None
+
+    def rels(self, partname):
+        """{rId: {'type', 'target', 'external'}} - cele wewnętrzne jako nazwy części w zipie"""
+        if partname in self.rels_cache:
+            return self.rels_cache[partname]
+        root = self.xml(self.rels_name(partname))
+        rels = {}
+        for rel in root if root is not None else ():
+            external = rel.get('TargetMode') == 'External'
+            target = rel.get('Target')
+            rels[rel.get('Id')] = {
+                'type': rel.get('Type'),
+                'target': target if external else self.resolve(partname, target),
+                'external': external
+            }
+        self.rels_cache[partname] = rels
+        return rels
+
+    def part_by_type(self, reltype):
+        """Część głównego dokumentu o danym typie relacji (style, numeracja) - None gdy brak"""
+        return next((rel['target'] for rel in self.rels(self.main).values()
+                     if rel['type'] == reltype and not rel['external']), None)
+
+    def close(self):
+        self.zip.close()
+
+
+class DocxPackageMerger:
+    """
+    Łączenie DOCX na poziomie paczek OOXML - bez python-docx i bez trzymania drzew źródeł w pamięci
+    - części binarne (obrazy) kopiowane strumieniowo, bez dekodowania; te same bajty zapisane raz
+    - relacje dołączanej treści przenumerowane (rId), nagłówki / stopki / wykresy kopiowane z własnymi relacjami
+    - style: brakujące dopisane, różniące się pod tą samą nazwą przemianowane; numeracje z nowymi numId
+    - każdy dokument jako osobna sekcja (własne marginesy, nagłówki), od nowej strony
+    - wynik zapisywany strumieniowo do pliku (lub obiektu plikowego)
+    Źródła: ścieżki lub obiekty plikowe; pierwsze jest bazą (ustawienia, motyw, czcionki)
+    """
+
+    REWRITTEN_TYPES = (RT.STYLES, RT.NUMBERING)
+
+    def __init__(self, base_source, output):
+        self.out = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        self.written = {}     # {część wyniku: (crc, rozmiar)}
+        self.by_content = {}  # {(crc, rozmiar, typ): część wyniku} - deduplikacja części binarnych
+        self.appended = 0
+        self.style_variants = {}  # {(styleId, definition): styleId w wyniku} - ten sam styl z kolejnych źródeł raz
+
+        base = OoxmlPackage(base_source)
+        self.main = base.main
+        self.defaults = dict(base.defaults)
+        self.overrides = dict(base.overrides)
+        self.document = base.xml(base.main)
+        self.body = self.document.find(W_BODY)
+        self.rels = base.xml(base.rels_name(base.main))
+        if self.rels is None:
+            self.rels = etree.Element(f'{{{RELS_NS}}}Relationships', nsmap={None: RELS_NS})
+        self.rel_ids = {rel.get('Id') for rel in self.rels}
+
+        self.styles_part = base.part_by_type(RT.STYLES)
+        self.styles = base.xml(self.styles_part) if self.styles_part else None
+        self.numbering_part = base.part_by_type(RT.NUMBERING)
+        self.numbering = base.xml(self.numbering_part) if self.numbering_part else None
+        self.docpr_id = max((int(el.get('id', 0)) for el in self.body.iter(WP_DOCPR) if el.get('id', '').isdigit()),
+                            default=0)
+
+        # Pozostałe części bazy bez zmian (zmieniane zapisuje save(), nazwy zajęte od razu)
+        rewritten = {'[Content_Types].xml', base.main, base.rels_name(base.main), self.styles_part, self.numbering_part}
+        self.written.update(dict.fromkeys(name for name in rewritten if name))
+        for info in base.zip.infolist():
+            if info.filename not in rewritten:
+                self._copy_stream(base, info, info.filename)
+        base.close()
+
+    # --- zapis części ---
+
+    def _copy_stream(self, pkg, info, partname):
+        """Część źródła → wynik strumieniowo (obrazy bez ponownej kompresji)"""
+        extension = posixpath.splitext(partname)[1][1:].lower()
+        target = zipfile.ZipInfo(partname, date_time=info.date_time)
+        target.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        with pkg.zip.open(info) as src, self.out.open(target, 'w', force_zip64=info.file_size > 0x7FFFFFFF) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        self.written[partname] = (info.CRC, info.file_size)
+        self.by_content.setdefault((info.CRC, info.file_size, pkg.content_type(info.filename)), partname)
+
+    def _write_xml(self, partname, root):
+        self.out.writestr(partname, etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True))
+        self.written[partname] = None
+
+    def _new_partname(self, partname):
+        """word/media/image1.png → word/media/image1_2.png (wolna nazwa w wyniku)"""
+        stem, extension = posixpath.splitext(partname)
+        candidate = f'{stem}_{self.appended}{extension}'
+        n = 1
+        while candidate in self.written:
+            n += 1
+            candidate = f'{stem}_{self.appended}_{n}{extension}'
+        return candidate
+
+    def _register_type(self, partname, content_type):
+        if not content_type:
+            return
+        extension = posixpath.splitext(partname)[1][1:].lower()
+        if self.defaults.get(extension) == content_type:
+            return
+        if extension not in self.defaults and not content_type.endswith('xml'):
+            self.defaults[extension] = content_type
+        else:
+            self.overrides[f'/{partname}'] = content_type
+
+    def _copy_part(self, pkg, partname, transform=None):
+        """
+        Skopiuj część źródła (z jej relacjami, rekurencyjnie) - zwraca nazwę w wyniku
+        Identyczna część binarna już w wyniku (np. to samo logo) nie jest kopiowana drugi raz
+        """
+        if partname in pkg.copied:
+            return pkg.copied[partname]
+        if partname not in pkg.names:
+            return partname
+
+        info = pkg.zip.getinfo(partname)
+        content_type = pkg.content_type(partname)
+        rels = pkg.rels(partname)
+        if not rels and not (content_type or '').endswith('xml'):
+            existing = self.by_content.get((info.CRC, info.file_size, content_type))
+            if existing is not None:
+                pkg.copied[partname] = existing
+                return existing
+
+        new_name = self._new_partname(partname)
+        pkg.copied[partname] = new_name
+
+        if transform is not None and content_type in transform:
+            root = pkg.xml(partname)
+            transform[content_type](root)
+            self._write_xml(new_name, root)
+        else:
+            self._copy_stream(pkg, info, new_name)
+        self._register_type(new_name, content_type)
+
+        if rels:
+            root = etree.Element(f'{{{RELS_NS}}}Relationships', nsmap={None: RELS_NS})
+            for rid, rel in rels.items():
+                target = rel['target']
+                if not rel['external']:
+                    target = posixpath.relpath(self._copy_part(pkg, target, transform), posixpath.dirname(new_name))
+                attrs = {'Id': rid, 'Type': rel['type'], 'Target': target}
+                if rel['external']:
+                    attrs['TargetMode'] = 'External'
+                etree.SubElement(root, f'{{{RELS_NS}}}Relationship', attrs)
+            self._write_xml(OoxmlPackage.rels_name(new_name), root)
+        return new_name
+
+    def _add_rel(self, reltype, target, external=False):
+        """Nowa relacja głównego dokumentu - zwraca jej rId"""
+        n = len(self.rel_ids) + 1
+        while f'rId{n}' in self.rel_ids:
+            n += 1
+        rid = f'rId{n}'
+        self.rel_ids.add(rid)
+        attrs = {'Id': rid, 'Type': reltype,
+                 'Target': target if external else posixpath.relpath(target, posixpath.dirname(self.main))}
+        if external:
+            attrs['TargetMode'] = 'External'
+        etree.SubElement(self.rels, f'{{{RELS_NS}}}Relationship', attrs)
+        return rid
+
+    # --- style i numeracja ---
+
+    def _merge_styles(self, pkg, roots):
+        """Dopisz style używane przez dołączaną treść - zwraca {stary styleId: nowy} dla kolizji nazw"""
+        source_part = pkg.part_by_type(RT.STYLES)
+        source = pkg.xml(source_part) if source_part else None
+        if source is None or self.styles is None:
+            return {}, None, []
+
+        source_styles = {style.get(W_STYLE_ID): style for style in source.iter(W_STYLE)}
+        base_styles = {style.get(W_STYLE_ID): style for style in self.styles.iter(W_STYLE)}
+        source_default = next((sid for sid, style in source_styles.items()
+                               if style.get(W_TYPE) == 'paragraph' and style.get(W_DEFAULT) in ('1', 'true')), None)
+        base_default = next((sid for sid, style in base_styles.items()
+                             if style.get(W_TYPE) == 'paragraph' and style.get(W_DEFAULT) in ('1', 'true')), None)
+
+        # Użyte style + łańcuchy basedOn / next / link
+        wanted = [el.get(W_VAL) for root in roots for el in root.iter(*STYLE_REFS)]
+        if source_default:
+            wanted.append(source_default)
+        needed = []
+        while wanted:
+            sid = wanted.pop()
+            if sid in needed or sid not in source_styles:
+                continue
+            needed.append(sid)
+            wanted += [el.get(W_VAL) for el in source_styles[sid] if el.tag in STYLE_LINKS]
+
+        renames = {}
+        added = []
+        for sid in needed:
+            base_style = base_styles.get(sid)
+            variant = self.style_variants.get((sid, style_signature(source_styles[sid])))
+            if base_style is None:
+                added.append(sid)
+            elif variant is not None:
+                renames[sid] = variant
+            elif style_signature(base_style) != style_signature(source_styles[sid]):
+                n = 1
+                while f'{sid}{n}' in base_styles or f'{sid}{n}' in source_styles:
+                    n += 1
+                renames[sid] = f'{sid}{n}'
+                added.append(sid)
+
+        copies = []
+        for sid in added:
+            self.style_variants[(sid, style_signature(source_styles[sid]))] = renames.get(sid, sid)
+            style = copy.deepcopy(source_styles[sid])
+            style.set(W_STYLE_ID, renames.get(sid, sid))
+            style.attrib.pop(W_DEFAULT, None)
+            name = style.find(W_NAME)
+            if sid in renames and name is not None:
+                name.set(W_VAL, f"{name.get(W_VAL)} ({renames[sid]})")
+            for el in style:
+                if el.tag in STYLE_LINKS and el.get(W_VAL) in renames:
+                    el.set(W_VAL, renames[el.get(W_VAL)])
+            self.styles.append(style)
+            base_styles[style.get(W_STYLE_ID)] = style
+            copies.append(style)
+
+        # Akapity bez stylu w źródle miały jego styl domyślny - w wyniku domyślny jest styl bazy
+        default = renames.get(source_default, source_default)
+        return renames, (default if default != base_default else None), copies
+
+    def _ensure_numbering(self):
+        if self.numbering is None:
+            self.numbering = etree.Element(W_NUMBERING, nsmap={'w': nsmap['w']})
+            self.numbering_part = posixpath.join(posixpath.dirname(self.main), 'numbering.xml')
+            if self.numbering_part in self.written:
+                self.numbering_part = self._new_partname(self.numbering_part)
+            self.written[self.numbering_part] = None
+            self.overrides[f'/{self.numbering_part}'] = CT_NUMBERING
+            self._add_rel(RT.NUMBERING, self.numbering_part)
+
+    def _merge_numbering(self, pkg, roots):
+        """Listy dołączanej treści jako nowe definicje (numId / abstractNumId bez kolizji) - zwraca mapę numId"""
+        used = {el.get(W_VAL) for root in roots for el in root.iter(W_NUM_ID)} - {'0', None}
+        source_part = pkg.part_by_type(RT.NUMBERING) if used else None
+        source = pkg.xml(source_part) if source_part else None
+        if source is None:
+            return {}
+
+        self._ensure_numbering()
+        nums = {num.get(W_NUM_ID): num for num in source.iter(W_NUM)}
+        abstracts = {el.get(W_ABSTRACT_NUM_ID): el for el in source.iter(W_ABSTRACT_NUM)}
+        next_num = max((int(num.get(W_NUM_ID)) for num in self.numbering.iter(W_NUM)), default=0) + 1
+        next_abstract = max((int(el.get(W_ABSTRACT_NUM_ID)) for el in self.numbering.iter(W_ABSTRACT_NUM)),
+                            default=-1) + 1
+        first_num = self.numbering.find(W_NUM)
+        cleanup = self.numbering.find(W_NUM_ID_MAC_CLEANUP)
+
+        abstract_map = {}
+        num_map = {}
+        for num_id in sorted(used, key=lambda v: int(v) if v.isdigit() else 0):
+            num = nums.get(num_id)
+            link = num.find(W_ABSTRACT_NUM_ID) if num is not None else None
+            if link is None or link.get(W_VAL) not in abstracts:
+                continue
+
+            abstract_id = link.get(W_VAL)
+            if abstract_id not in abstract_map:
+                abstract = copy.deepcopy(abstracts[abstract_id])
+                abstract.set(W_ABSTRACT_NUM_ID, str(next_abstract))
+                nsid = abstract.find(W_NSID)
+                if nsid is not None:
+                    # nsid identyfikuje listę w Wordzie - ta sama wartość skleja listy różnych dokumentów
+                    nsid.set(W_VAL, uuid.uuid4().hex[:8].upper())
+                if first_num is not None:
+                    first_num.addprevious(abstract)
+                else:
+                    self.numbering.append(abstract)
+                abstract_map[abstract_id] = str(next_abstract)
+                next_abstract += 1
+
+            new_num = copy.deepcopy(num)
+            new_num.set(W_NUM_ID, str(next_num))
+            new_num.find(W_ABSTRACT_NUM_ID).set(W_VAL, abstract_map[abstract_id])
+            if cleanup is not None:
+                cleanup.addprevious(new_num)
+            else:
+                self.numbering.append(new_num)
+            num_map[num_id] = str(next_num)
+            next_num += 1
+
+        for root in roots:
+            for el in root.iter(W_NUM_ID):
+                if el.get(W_VAL) in num_map:
+                    el.set(W_VAL, num_map[el.get(W_VAL)])
+        return num_map
+
+    # --- treść ---
+
+    def _restyle(self, root, renames):
+        for el in root.iter(*STYLE_REFS):
+            if el.get(W_VAL) in renames:
+                el.set(W_VAL, renames[el.get(W_VAL)])
+
+    def _renumber_drawings(self, root):
+        """Unikalne id obiektów rysunkowych (wp:docPr) w całym dokumencie"""
+        for el in root.iter(WP_DOCPR):
+            self.docpr_id += 1
+            el.set('id', str(self.docpr_id))
+
+    def _close_section(self):
+        """Końcowa sekcja dokumentu → podział sekcji (akapit z sectPr) przed dołączaną treścią - zwraca sectPr"""
+        section = self.body.find(W_SECTPR)
+        paragraph = etree.SubElement(self.body, W_P)
+        if section is None:
+            # Dokument bez właściwości sekcji - zwykły podział strony
+            etree.SubElement(etree.SubElement(paragraph, W_R), W_BR, {W_TYPE: 'page'})
+            return None
+        self.body.remove(section)
+        etree.SubElement(paragraph, W_PPR).append(section)
+        return section
+
+    def append(self, source, marker=None):
+        """Dołącz dokument jako nową sekcję od nowej strony (marker - niewidoczny tekst na jego pierwszej stronie)"""
+        self.appended += 1
+        pkg = OoxmlPackage(source)
+        try:
+            body = pkg.xml(pkg.main).find(W_BODY)
+            content = [el for el in body if el.tag != W_SECTPR]
+            final = body.find(W_SECTPR)
+
+            # Style i numeracja treści oraz nagłówków / stopek
+            renames, default_style, style_copies = self._merge_styles(pkg, [body])
+            self._restyle(body, renames)
+            if default_style:
+                for paragraph in body.iter(W_P):
+                    ppr = paragraph.find(W_PPR)
+                    if ppr is None:
+                        ppr = etree.Element(W_PPR)
+                        paragraph.insert(0, ppr)
+                    if ppr.find(W_PSTYLE) is None:
+                        ppr.insert(0, etree.Element(W_PSTYLE, {W_VAL: default_style}))
+            num_map = self._merge_numbering(pkg, [body] + style_copies)
+            self._renumber_drawings(body)
+
+            def transform_story(root):
+                self._restyle(root, renames)
+                for el in root.iter(W_NUM_ID):
+                    if el.get(W_VAL) in num_map:
+                        el.set(W_VAL, num_map[el.get(W_VAL)])
+                self._renumber_drawings(root)
+            transform = {CT_HEADER: transform_story, CT_FOOTER: transform_story}
+
+            # Relacje treści (obrazy, linki, nagłówki z sectPr) - nowe rId w dokumencie bazowym
+            rels = pkg.rels(pkg.main)
+            rid_map = {}
+            for attr in R_ATTRIBUTES(body):
+                value = str(attr)
+                if value not in rels:
+                    continue
+                if value not in rid_map:
+                    rel = rels[value]
+                    target = rel['target'] if rel['external'] else self._copy_part(pkg, rel['target'], transform)
+                    rid_map[value] = self._add_rel(rel['type'], target, rel['external'])
+                attr.getparent().set(attr.attrname, rid_map[value])
+
+            # Nowa strona: sekcja dołączanego dokumentu nie może zaczynać się "ciągłym" podziałem
+            first_section = next((el for el in body.iter(W_SECTPR)), None)
+            section_type = first_section.find(W_TYPE) if first_section is not None else None
+            if section_type is not None and section_type.get(W_VAL) == 'continuous':
+                section_type.set(W_VAL, 'nextPage')
+
+            if marker:
+                first_paragraph = next((el for item in content for el in item.iter(W_P)), None)
+                if first_paragraph is not None:
+                    run = etree.fromstring(
+                        f'<w:r xmlns:w="{nsmap["w"]}"><w:rPr><w:color w:val="FFFFFF"/><w:sz w:val="2"/>'
+                        f'</w:rPr><w:t>{marker}</w:t></w:r>')
+                    ppr = first_paragraph.find(W_PPR)
+                    first_paragraph.insert(1 if ppr is not None and first_paragraph[0] is ppr else 0, run)
+
+            previous = self._close_section()
+            for el in content:
+                self.body.append(el)
+            if final is None and previous is not None:
+                final = copy.deepcopy(previous)
+            if final is not None:
+                self.body.append(final)
+        finally:
+            pkg.close()
+
+    def save(self):
+        """Dopisz zmienione części (dokument, relacje, style, numeracja, typy) i zamknij zip"""
+        self._write_xml(self.main, self.document)
+        self._write_xml(OoxmlPackage.rels_name(self.main), self.rels)
+        if self.styles is not None:
+            self._write_xml(self.styles_part, self.styles)
+        if self.numbering is not None:
+            self._write_xml(self.numbering_part, self.numbering)
+
+        types = etree.Element(CT_TYPES, nsmap={None: CT_NS})
+        for extension, content_type in sorted(self.defaults.items()):
+            etree.SubElement(types, CT_DEFAULT, {'Extension': extension, 'ContentType': content_type})
+        for partname, content_type in sorted(self.overrides.items()):
+            if partname[1:] in self.written:
+                etree.SubElement(types, CT_OVERRIDE, {'PartName': partname, 'ContentType': content_type})
+        self._write_xml('[Content_Types].xml', types)
+        self.out.close()
+
+
+def merge_docx_packages(sources, output, segment_markers=False):
+    """
+    Sklej paczki DOCX (ścieżki / obiekty plikowe) w jeden plik output - pierwsza jest bazą
+    sources może być generatorem - każde źródło potrzebne tylko na czas dołączania
+    segment_markers=True wstawia na pierwszej stronie każdego dołączonego dokumentu znacznik segmentu (single-pass)
+    """
+    with metrics.span('merge'):
+        sources = iter(sources)
+        base = next(sources, None)
+        if base is None:
+            Document().save(output)
+            return output
+
+        merger = DocxPackageMerger(base, output)
+        for idx, source in enumerate(sources, 1):
+            merger.append(source, SEGMENT_MARKER.format(idx) if segment_markers else None)
+        merger.save()
+    return output
+
+
+def generate_table_of_contents(selected_products, product_custom_fields, start_page=5, product_segments=None):
+    """
+    Generuj spis treści dla WolfTax
+    Liczby stron z indeksu po fingerprincie wypełnionego produktu (własne pola zmieniają łamanie)
+    """
+    if product_segments is None:
+        product_segments = [make_product_segment(product_id, product_custom_fields) for product_id in selected_products]
+    segments_by_id = {segment['product_id']: segment for segment in product_segments if segment}
+    page_counts = dict(zip(segments_by_id, segment_page_counts(list(segments_by_id.values()))))
+
+    toc_lines = []
+    current_page = start_page
+
+    for idx, product_id in enumerate(selected_products, 1):
+        product_data = product_custom_fields.get(product_id, {})
+        title = product_data.get('title') or product_data.get('nazwa') or f'Produkt {product_id}'
+
+        base_text = f"Usługa {idx} – {title}"
+        dots_count = max(60 - len(base_text), 10)
+        dots = '…' * dots_count
+
+        line = f"§\t{base_text} {dots}  {current_page:02d}"
+        toc_lines.append(line)
+
+        # Strony produktu (brak pliku / nieudana konwersja = 1)
+        current_page += page_counts.get(product_id) or 1
+
+    return '\n'.join(toc_lines)
+
+
+def inject_toc_into_doc(doc, toc_text, plan=None):
+    """Wstaw spis treści w miejsce placeholdera (także w polu tekstowym) lub na koniec dokumentu"""
+    plan = plan or compile_placeholder_plan(doc)
+    names = plan['names'] & TOC_PLACEHOLDERS
+
+    if names:
+        fill_placeholders(doc, plan, {name: toc_text for name in names})
+    else:
+        doc.add_paragraph(toc_text)
+
+    return doc
+
+
+# ============================================================
+# GENEROWANIE OFERTY DOCX
+# ============================================================
+
+def get_placeholder_plan(docx_path, file_hash=None):
+    """Plan placeholderów pliku - skan raz na treść (memo po ścieżce, ważny dla hasha treści)"""
+    path = os.path.abspath(docx_path)
+    file_hash = file_hash or get_file_hash(path)
+    with placeholder_index_lock:
+        entry = placeholder_index.get(path)
+        if entry is not None and entry[0] == file_hash:
+            placeholder_index.move_to_end(path)
+            return entry[1]
+
+    plan = compile_placeholder_plan(template_cache.parsed(path))
+    if file_hash:
+        with placeholder_index_lock:
+            placeholder_index[path] = (file_hash, plan)
+            placeholder_index.move_to_end(path)
+            while len(placeholder_index) > PLACEHOLDER_INDEX_MAX_ENTRIES:
+                placeholder_index.popitem(last=False)
+    return plan
+
+
+def get_docx_placeholders(docx_path, file_hash=None):
+    """Zbiór nazw {{placeholderów}} w pliku (treść, pola tekstowe, nagłówki, stopki)"""
+    return get_placeholder_plan(docx_path, file_hash)['names']
+
+
+def segment_fingerprint(file_hash, values=None, toc_text=None):
+    """
+    Fingerprint segmentu: hash pliku + tylko używane przez niego wartości
+    Segment bez wartości i spisu treści = sam plik (wspólny cache z pre-renderingiem)
+    """
+    if not values and toc_text is None:
+        return file_hash
+    raw = json.dumps({'file': file_hash, 'values': values, 'toc': toc_text}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def make_segment(seg_type, path, data, toc_text=None, **meta):
+    """Opis segmentu (bez parsowania DOCX) z fingerprintem"""
+    file_hash = get_file_hash(path)
+    used = get_docx_placeholders(path, file_hash)
+    values = {key: str(data[key]) for key in sorted(used) if key in data and key != 'produkty'}
+
+    segment = {
+        'type': seg_type,
+        'path': path,
+        'file_hash': file_hash,
+        'data': values,
+        'toc_text': toc_text,
+        'fingerprint': segment_fingerprint(file_hash, values, toc_text),
+        'doc': None
+    }
+    segment.update(meta)
+    return segment
+
+
+def load_segment_document(segment):
+    """Wczytaj DOCX segmentu i wypełnij placeholders / spis treści (leniwie)"""
+    if segment['doc'] is None:
+        doc = template_cache.load(segment['path'])
+        plan = get_placeholder_plan(segment['path'], segment['file_hash'])
+        if segment['data']:
+            doc = fill_placeholders(doc, plan, segment['data'])
+        if segment['toc_text'] is not None:
+            doc = inject_toc_into_doc(doc, segment['toc_text'], plan)
+        segment['doc'] = doc
+    return segment['doc']
+
+
+def find_marker_element(elements, marker):
+    """Indeks elementu treści (paragraf / tabela) zawierającego marker - porównanie bez białych znaków (tabulatory)"""
+    wanted = ''.join(marker.split())
+    for index, element in enumerate(elements):
+        for paragraph in element.iter(W_P):
+            text = ''.join(t.text or '' for t in paragraph.iter(W_T))
+            if wanted in ''.join(text.split()):
+                return index
+    return None
+
+
+def split_docx_at_marker(path, marker, pre_path, post_path):
+    """
+    Podziel DOCX za elementem z markerem na dwa pliki: przed (z markerem) i po
+    Każda część to pełna kopia paczki (style, nagłówki, obrazy) z przyciętą treścią
+    Zwraca (przed, po | None) lub None gdy marker nie występuje
+    """
+    doc = Document(path)
+    body = doc.element.body
+    content = [element for element in body if element.tag != W_SECTPR]
+    index = find_marker_element(content, marker)
+    if index is None:
+        return None
+
+    # Sekcja z markerem kończy się na pierwszym sectPr w paragrafie (brak - sekcja końcowa dokumentu)
+    section = None
+    for element in content[index:]:
+        section = element.find(f'{W_PPR}/{W_SECTPR}')
+        if section is not None:
+            break
+
+    for element in content[index + 1:]:
+        body.remove(element)
+    if section is not None:
+        final = copy.deepcopy(section)
+        if section.getparent().getparent() is content[index]:
+            section.getparent().remove(section)
+        old = body.find(W_SECTPR)
+        if old is not None:
+            body.replace(old, final)
+        else:
+            body.append(final)
+    doc.save(pre_path)
+
+    if index + 1 == len(content):
+        return pre_path, None
+
+    doc = Document(path)
+    body = doc.element.body
+    for element in [element for element in body if element.tag != W_SECTPR][:index + 1]:
+        body.remove(element)
+    doc.save(post_path)
+    return pre_path, post_path
+
+
+def split_single_file_template(path, marker):
+    """
+    Części szablonu single-file (przed markerem, po markerze | None) - None gdy brak pliku lub markera
+    Podział raz na treść pliku: pliki w render_cache/splits przetrwają restart, a jako zwykłe pliki
+    mają własny hash - fingerprinty, cache renderów i podgląd jak pliki WolfTax
+    """
+    path = os.path.abspath(path)
+    file_hash = get_file_hash(path)
+    memo_key = (path, marker)
+    if file_hash is None:
+        # Plik usunięty - jego części też
+        entry = template_splits.pop(memo_key, None)
+        for part in (entry[1] or ()) if entry else ():
+            if part is not None and os.path.exists(part):
+                os.remove(part)
+        return None
+    entry = template_splits.get(memo_key)
+    if entry is not None and entry[0] == file_hash:
+        return entry[1]
+
+    marker_hash = hashlib.sha256(marker.encode('utf-8')).hexdigest()[:8]
+    prefix = f"{os.path.splitext(os.path.basename(path))[0]}_{marker_hash}_"
+    base = os.path.join(TEMPLATE_SPLIT_DIR, f'{prefix}{file_hash[:16]}')
+    pre_path, post_path = f'{base}_pre.docx', f'{base}_post.docx'
+
+    with render_cache.fill_lock(f'split_{marker_hash}_{file_hash}'):
+        if os.path.exists(pre_path):
+            parts = (pre_path, post_path if os.path.exists(post_path) else None)
+        else:
+            os.makedirs(TEMPLATE_SPLIT_DIR, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=TEMPLATE_SPLIT_DIR) as tmpdir:
+                parts = split_docx_at_marker(path, marker, os.path.join(tmpdir, 'pre.docx'),
+                                             os.path.join(tmpdir, 'post.docx'))
+                if parts is not None:
+                    # 'po' przed 'przed' - istniejący plik 'przed' oznacza kompletny podział
+                    if parts[1] is not None:
+                        os.replace(parts[1], post_path)
+                    os.replace(parts[0], pre_path)
+                    parts = (pre_path, post_path if parts[1] is not None else None)
+
+            # Części poprzednich wersji pliku
+            for filename in os.listdir(TEMPLATE_SPLIT_DIR):
+                if filename.startswith(prefix) and not filename.startswith(os.path.basename(base)):
+                    try:
+                        os.remove(os.path.join(TEMPLATE_SPLIT_DIR, filename))
+                    except OSError:
+                        pass
+
+            if parts is None:
+                print(f"[SPLIT] ⚠️ Brak markera {marker!r} w {os.path.basename(path)} - produkty na końcu szablonu")
+            else:
+                print(f"[SPLIT] ✓ {os.path.basename(path)}: {'2 części' if parts[1] else '1 część'}")
+
+    template_splits[memo_key] = (file_hash, parts)
+    return parts
+
+
+def template_parts(template_data):
+    """
+    Pliki szablonu w kolejności oferty: [{'path', 'name', 'source_file', 'is_toc', 'products_after'}]
+    multi_file - pliki z listy 'files' (produkty po pliku injection_point.after)
+    single_file - main_file podzielony przy markerze (produkty między częściami)
+    """
+    template_folder = os.path.normpath(os.path.join(TEMPLATES_DIR, template_data.get('folder', '.')))
+    injection_point = template_data.get('injection_point', {})
+
+    if template_data.get('type') == 'single_file':
+        main_file = template_data['main_file']
+        path = os.path.join(template_folder, main_file)
+        marker = injection_point.get('marker')
+        parts = split_single_file_template(path, marker) if marker else None
+        if parts is None:
+            return [{'path': path, 'name': main_file, 'source_file': main_file, 'is_toc': False, 'products_after': True}]
+        names = ('Część przed produktami', 'Część po produktach')
+        return [
+            {'path': part, 'name': name, 'source_file': main_file, 'is_toc': False, 'products_after': idx == 0}
+            for idx, (part, name) in enumerate(zip(parts, names)) if part is not None
+        ]
+
+    inject_after = injection_point.get('after') if injection_point.get('type') == 'between_files' else None
+    return [
+        {
+            'path': os.path.join(template_folder, file_info['file']),
+            'name': file_info.get('name', file_info['file']),
+            'source_file': file_info['file'],
+            'is_toc': bool(file_info.get('is_toc')),
+            'products_after': file_info['file'] == inject_after
+        }
+        for file_info in sorted(template_data.get('files', []), key=lambda x: x['order'])
+    ]
+
+
+def template_source_paths(template_data):
+    """Pliki źródłowe szablonu w kolejności (multi_file: 'files', single_file: main_file)"""
+    template_data = template_data or {}
+    folder = os.path.normpath(os.path.join(TEMPLATES_DIR, template_data.get('folder', '.')))
+    files = [f['file'] for f in sorted(template_data.get('files', []), key=lambda x: x.get('order', 0))]
+    if not files and template_data.get('main_file'):
+        files = [template_data['main_file']]
+    return [os.path.join(folder, filename) for filename in files]
+
+
+def build_offer_segments(data, selected_products, template_data):
+    """
+    Zbuduj segmenty oferty (pliki szablonu + produkty) w docelowej kolejności
+    Segment: {'type', 'name', 'path', 'file_hash', 'data', 'toc_text', 'fingerprint', 'doc', 'source_file' | 'product_id'}
+    Dokument DOCX ładowany dopiero przez load_segment_document()
+    """
+    form_data = data.get('formData', data)
+    product_custom_fields = data.get('productCustomFields', {})
+
+    # Segmenty produktów najpierw - ich liczby stron potrzebne są do spisu treści
+    product_segments = [make_product_segment(product_id, product_custom_fields) for product_id in selected_products]
+
+    segments = []
+
+    # Przetwórz wszystkie pliki
+    for part in template_parts(template_data):
+        if not os.path.exists(part['path']):
+            continue
+
+        # Spis treści
+        toc_text = None
+        if part['is_toc'] and len(selected_products) > 0:
+            toc_config = template_data.get('toc', {})
+            start_page = toc_config.get('start_page', 5)
+            toc_text = generate_table_of_contents(selected_products, product_custom_fields, start_page, product_segments)
+
+        segments.append(make_segment(
+            'template', part['path'], form_data, toc_text,
+            name=part['name'],
+            source_file=part['source_file']
+        ))
+
+        # Injection point - produkty
+        if part['products_after']:
+            segments += [segment for segment in product_segments if segment is not None]
+
+    return segments
+
+
+def make_product_segment(product_id, product_custom_fields):
+    """Segment produktu z jego własnymi polami (None gdy brak pliku)"""
+    product_path = os.path.join(PRODUKTY_DIR, f'{product_id}.docx')
+    if not os.path.exists(product_path):
+        return None
+
+    return make_segment(
+        'product', product_path, product_custom_fields.get(product_id) or {},
+        name=f'Produkt {product_id}',
+        product_id=product_id
+    )
+
+
+def sanitize_filename_part(value):
+    """Fragment nazwy pliku - tylko litery, cyfry, spacje, '-' i '_'"""
+    return "".join(c for c in value if c.isalnum() or c in (' ', '-', '_')).strip()
+
+
+def offer_filename(form_data, extension, template_data=None):
+    """
+    Oferta_<szablon>_<klient>_<data>.<ext>
+    Szablon: początek nazwy z templates.json ("AIDROPS - Szablon klasyczny" → AIDROPS), inaczej id; domyślnie WolfTax
+    """
+    template_data = template_data or {}
+    template_name = sanitize_filename_part((template_data.get('name') or '').split(' - ')[0])
+    template_name = template_name or sanitize_filename_part(template_data.get('id') or '') or 'WolfTax'
+
+    client_name = form_data.get('NazwaFirmyKlienta') or form_data.get('klient') or 'Klient'
+    client_name = sanitize_filename_part(client_name)
+    return f"Oferta_{template_name}_{client_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+
+def generate_offer_docx(data, selected_products, template_data, output_dir=GENERATED_OFFERS_DIR, output_filename=None):
+    """Generuj ofertę DOCX - multi-file (WolfTax) lub single-file podzielony przy markerze (AIDROPS)"""
+    output_filename = output_filename or offer_filename(data.get('formData', data), 'docx', template_data)
+    output_path = os.path.join(output_dir, output_filename)
+
+    write_offer_docx(data, selected_products, template_data, output_path)
+    print(f"[DOCX] ✓ Zapisano: {output_filename}")
+
+    return output_path, output_filename
+
+
+def write_offer_docx(data, selected_products, template_data, output):
+    """Złóż DOCX oferty do output (ścieżka lub obiekt plikowy z seek) - zwraca liczbę segmentów"""
+    print(f"[DOCX] Generuję ofertę {template_data.get('id')} ({template_data.get('type', 'multi_file')})")
+
+    segments = build_offer_segments(data, selected_products, template_data)
+    print(f"[DOCX] Segmentów: {len(segments)} (produkty: {sum(1 for s in segments if s['type'] == 'product')})")
+
+    # Połącz paczki segmentów prosto do wyniku
+    merge_docx_packages((segment_package(segment) for segment in segments), output)
+    return len(segments)
+
+
+def segment_package(segment):
+    """Paczka DOCX segmentu do sklejenia - niezmieniony plik bez parsowania, inaczej wypełniony dokument w pamięci"""
+    if not segment['data'] and segment['toc_text'] is None:
+        return segment['path']
+
+    buffer = io.BytesIO()
+    load_segment_document(segment).save(buffer)
+    segment['doc'] = None
+    buffer.seek(0)
+    return buffer
+
+
+def segment_docx_writer(segment):
+    """write_docx(tmpdir) dla segmentu - niezmieniony plik bez kopiowania, inaczej zapis wypełnionego DOCX"""
+    if not segment['data'] and segment['toc_text'] is None:
+        # Niezmieniony plik - fingerprint == hash pliku
+        return lambda tmpdir: segment['path']
+
+    def write_docx(tmpdir):
+        docx_path = os.path.join(tmpdir, 'segment.docx')
+        load_segment_document(segment).save(docx_path)
+        return docx_path
+    return write_docx
+
+
+def read_segment_pdf(segment):
+    """PDF segmentu z cache (None gdy brak) - przy okazji uzupełnia indeks liczby stron"""
+    pdf_hashes = render_cache.get_page_hashes(RenderCache.make_key(segment['fingerprint'], 'pdf'))
+    pdf_bytes = render_cache.read_blob(pdf_hashes[0]) if pdf_hashes else None
+    if pdf_bytes is not None and page_count_index.get(segment['fingerprint']) is None:
+        page_count_index.put(segment['fingerprint'], pdf_page_count(pdf_bytes))
+    return pdf_bytes
+
+
+def ensure_segment_pdf(segment):
+    """PDF segmentu z cache (zapisany przez podgląd) lub świeża konwersja samego segmentu - (bajty, z_cache)"""
+    pdf_bytes = read_segment_pdf(segment)
+    if pdf_bytes is not None:
+        return pdf_bytes, True
 
-    return images
+    with render_cache.fill_lock(segment['fingerprint']):
+        # Ten sam segment mógł właśnie skonwertować inny worker
+        pdf_bytes = read_segment_pdf(segment)
+        if pdf_bytes is not None:
+            return pdf_bytes, True
 
-    if not os.path.exists(PRODUKTY_DIR):
-        print("[STARTUP] Folder produktów nie istnieje")
-        return
+        with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+            pdf_path = os.path.join(tmpdir, 'segment.pdf')
+            docx_to_pdf(segment_docx_writer(segment)(tmpdir), pdf_path)
+            with open(pdf_path, 'rb') as f:
+                pdf_bytes = f.read()
 
-def convert_docx_to_images(docx_path, use_cache=True, progress_callback=None):
+        render_cache.put_pages(RenderCache.make_key(segment['fingerprint'], 'pdf'), [pdf_bytes])
+        page_count_index.put(segment['fingerprint'], pdf_page_count(pdf_bytes))
+    return pdf_bytes, False
+
+
+def segment_page_count(segment):
     """
-    Główna funkcja: DOCX → JPG
-    1. Sprawdź cache
-    2. DOCX → PDF (unoconvert SZYBKIE! lub LibreOffice fallback)
-    3. PDF → JPG (PyMuPDF lub pdf2image)
+    Liczba stron wypełnionego segmentu: indeks → wpis JPG w cache → sama konwersja do PDF
+    (bez rasteryzacji) - wynik trafia do indeksu; nieudana konwersja = None (spis treści liczy 1)
     """
-    # Cache
-    if use_cache:
-        file_hash = get_file_hash(docx_path)
-        if file_hash and file_hash in conversion_cache:
-            print(f"[CACHE] ⚡ Hit: {os.path.basename(docx_path)}")
-            return conversion_cache[file_hash]
+    pages = page_count_index.get(segment['fingerprint'])
+    if pages is not None:
+        return pages
 
-    print(f"[CONVERT] Start: {os.path.basename(docx_path)}")
+    page_hashes = render_cache.get_page_hashes(RenderCache.make_key(segment['fingerprint'], DEFAULT_TIER))
+    if page_hashes is not None:
+        page_count_index.put(segment['fingerprint'], len(page_hashes))
+        return len(page_hashes)
 
-    if progress_callback:
-        progress_callback("Konwersja DOCX → PDF...", 20)
+    try:
+        ensure_segment_pdf(segment)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"[PAGES] ⚠️ Brak liczby stron {os.path.basename(segment['path'])}: {e}")
+        return None
+    return page_count_index.get(segment['fingerprint'])
 
-    # Tymczasowy PDF
-    with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
-        pdf_path = os.path.join(tmpdir, 'out.pdf')
 
-        # DOCX → PDF: Spróbuj unoconvert (SZYBKI!), fallback do LibreOffice
-        pdf_converted = False
+def segment_page_counts(segments):
+    """
+    Liczby stron segmentów (None = nie udało się policzyć) - każdy fingerprint liczony raz,
+    brakujące w indeksie konwertowane równolegle
+    """
+    unique = list({segment['fingerprint']: segment for segment in segments}.values())
+    counts = {}
+    missing = []
+    for segment in unique:
+        pages = page_count_index.get(segment['fingerprint'])
+        if pages is None:
+            missing.append(segment)
+        else:
+            counts[segment['fingerprint']] = pages
 
-        # Strategia 1: unoconvert (jeśli unoserver działa)
-        if check_unoserver_running():
-            try:
-                print(f"[CONVERT] 🚀 Używam unoconvert (SUPER FAST)")
-                docx_to_pdf_unoconvert(docx_path, pdf_path)
-                pdf_converted = True
-            except Exception as e:
-                print(f"[CONVERT] ⚠️ unoconvert failed: {e}, fallback do LibreOffice...")
+    if len(missing) > 1:
+        workers = max(1, min(CONVERTER_WORKERS, len(missing)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='page-count') as executor:
+            counts.update(zip((segment['fingerprint'] for segment in missing), executor.map(segment_page_count, missing)))
+    elif missing:
+        counts[missing[0]['fingerprint']] = segment_page_count(missing[0])
+    return [counts[segment['fingerprint']] for segment in segments]
 
-        # Strategia 2: LibreOffice headless (fallback)
-        if not pdf_converted:
-            print(f"[CONVERT] Używam LibreOffice headless")
-            docx_to_pdf_libreoffice(docx_path, pdf_path)
 
-        if progress_callback:
-            progress_callback("Konwersja PDF → JPG...", 50)
+def generate_offer_pdf(data, selected_products, template_data, output_dir=GENERATED_OFFERS_DIR, output_filename=None):
+    """
+    Generuj ofertę PDF ze sklejenia PDF-ów segmentów (PyMuPDF)
+    Segmenty po podglądzie są w cache - brakujące konwertowane równolegle pojedynczo,
+    bez konwersji całej oferty w LibreOffice. Bez PyMuPDF: konwersja scalonego DOCX
+    Zwraca (ścieżka, nazwa pliku, liczba segmentów z cache, liczba segmentów)
+    """
+    output_filename = output_filename or offer_filename(data.get('formData', data), 'pdf', template_data)
+    output_path = os.path.join(output_dir, output_filename)
 
-        # PDF → JPG
-        if HAS_PYMUPDF:
-            images = pdf_to_jpg_pymupdf(pdf_path, dpi=200, quality=90)
-        else:
-            images = pdf_to_jpg_pdf2image(pdf_path, dpi=200)
+    cached, total = write_offer_pdf(data, selected_products, template_data, output_path)
+    print(f"[PDF] ✓ Zapisano: {output_filename} (segmenty z cache: {cached}/{total})")
+    return output_path, output_filename, cached, total
 
-    # Zapisz w cache
-    if use_cache:
-        file_hash = get_file_hash(docx_path)
-        if file_hash:
-            conversion_cache[file_hash] = images
-            print(f"[CACHE] ✓ Saved: {os.path.basename(docx_path)}")
 
-    print(f"[CONVERT] ✓ Done: {len(images)} stron")
-    return images
+def write_offer_pdf(data, selected_products, template_data, output):
+    """Złóż PDF oferty do output (ścieżka lub obiekt plikowy) - zwraca (liczba segmentów z cache, liczba segmentów)"""
+    segments = build_offer_segments(data, selected_products, template_data)
 
+    if not HAS_PYMUPDF:
+        with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+            docx_path = os.path.join(tmpdir, 'offer.docx')
+            merge_docx_packages((segment_package(segment) for segment in segments), docx_path)
+            if isinstance(output, str):
+                docx_to_pdf(docx_path, output)
+            else:
+                # Konwerter pisze tylko do pliku
+                pdf_path = os.path.join(tmpdir, 'offer.pdf')
+                docx_to_pdf(docx_path, pdf_path)
+                with open(pdf_path, 'rb') as f:
+                    shutil.copyfileobj(f, output)
+        return 0, len(segments)
+
+    # Każdy fingerprint raz (ten sam produkt dwa razy = jeden PDF)
+    unique = list({segment['fingerprint']: segment for segment in segments}.values())
+    workers = max(1, min(CONVERTER_WORKERS, len(unique)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='segment-pdf') as executor:
+        results = dict(zip((segment['fingerprint'] for segment in unique), executor.map(ensure_segment_pdf, unique)))
+
+    with fitz.open() as merged:
+        for segment in segments:
+            with fitz.open(stream=results[segment['fingerprint']][0], filetype='pdf') as part:
+                merged.insert_pdf(part)
+        if isinstance(output, str):
+            merged.save(output, garbage=3, deflate=True)
+        else:
+            output.write(merged.tobytes(garbage=3, deflate=True))
 
-def get_file_hash(filepath):
-    """Hash pliku dla cache"""
-    try:
-        with open(filepath, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
-    except:
-        return None
+    return sum(1 for segment in segments if results[segment['fingerprint']][1]), len(segments)
 
 
 # ============================================================
-# PRE-RENDERING NA STARCIE
+# PODGLĄD OFERTY
 # ============================================================
 
-def preload_all_products():
-    """Pre-renderuj wszystkie produkty przy starcie"""
-    print("\n" + "="*80)
-    print("[STARTUP] 🚀 Pre-rendering produktów...")
-    print("="*80)
-
-    if not os.path.exists(PRODUKTY_DIR):
-        print("[STARTUP] Folder produktów nie istnieje")
+def iter_segment_pages(segment, tiers=PREVIEW_TIERS):
+    """
+    Strumieniowo renderuj pojedynczy segment (osobna konwersja DOCX → PDF → JPG)
+    Każda strona od razu zapisana jako blob (URL działa) - generator zwraca {poziom: hash}
+    Komplet trafia do cache pod fingerprintem segmentu
+    """
+    cached = get_segment_page_hashes(segment, tiers)
+    if cached is not None:
+        yield from cached
         return
 
-    product_files = [f for f in os.listdir(PRODUKTY_DIR) if f.endswith('.docx') and not f.startswith('~$')]
-    total = len(product_files)
+    write_docx = segment_docx_writer(segment)
+    for images in iter_rendered_pages(segment['fingerprint'], write_docx, tiers=tiers, label=segment['name']):
+        yield {tier: render_cache.put_blob(img_bytes) for tier, img_bytes in images.items()}
 
-    print(f"[STARTUP] Znaleziono {total} produktów")
 
-    for idx, filename in enumerate(product_files, 1):
-        product_path = os.path.join(PRODUKTY_DIR, filename)
-        print(f"[STARTUP] [{idx}/{total}] {filename}...", end=' ')
+def get_segment_page_hashes(segment, tiers=PREVIEW_TIERS):
+    """Hashe stron segmentu z cache (None gdy trzeba renderować)"""
+    return get_cached_page_hashes(segment['fingerprint'], tiers)
 
-        try:
-            convert_docx_to_images(product_path, use_cache=True)
-            print("✓")
-        except Exception as e:
-            print(f"✗ {e}")
 
-    print(f"[STARTUP] ✅ Cache: {len(conversion_cache)} produktów")
-    print("="*80 + "\n")
+def preview_tiers(tier):
+    """Poziomy renderowane od razu: miniatura + wybrany poziom podglądu"""
+    return tuple(dict.fromkeys(('thumb', tier)))
 
-def preload_templates():
-    """Pre-renderuj JPG szablonów WolfTax na starcie"""
-    print("\n" + "="*80)
-    print("[STARTUP] 🎨 Pre-rendering szablonów WolfTax...")
-    print("="*80)
 
-def preload_templates():
-    """Pre-renderuj JPG szablonów WolfTax na starcie"""
-    print("\n" + "="*80)
-    print("[STARTUP] 🎨 Pre-rendering szablonów WolfTax...")
-    print("="*80)
+def page_url(page_hash):
+    """URL strony podglądu (content-addressed)"""
+    return f'/api/page/{page_hash}.jpg'
 
-    wolftax_folder = os.path.join(TEMPLATES_DIR, 'wolftax-oferta')
-    if not os.path.exists(wolftax_folder):
-        print("[STARTUP] Folder wolftax-oferta nie istnieje")
-        return
 
-    files = ['Dok1.docx', 'Doc2.docx', 'doc3.docx', 'doc4.docx', 'Dok5.docx', 'Dok6.docx']
+class PageLoader:
+    """
+    Pojedyncze strony podglądu na żądanie: (fingerprint segmentu, numer strony, poziomy) → {poziom: hash}
+    - kolejka priorytetowa: strony z widoku klienta przed prefetchem sąsiednich
+    - ta sama strona w toku = ta sama przyszłość (prefetch podniesiony do widoku nie czeka w kolejce)
+    - segment bez PDF w cache konwertowany raz (ensure_segment_pdf), potem rasteryzacja tylko jednej strony
+    - każda strona w cache osobno; komplet stron poziomu składa się we wpis segmentu (następny podgląd = hit)
+    """
 
-    for filename in files:
-        filepath = os.path.join(wolftax_folder, filename)
-        if not os.path.exists(filepath):
-            continue
+    VIEWPORT = 0
+    PREFETCH = 1
+
+    def __init__(self, workers, max_segments):
+        self.workers = workers
+        self.max_segments = max_segments
+        self.segments = OrderedDict()  # {fingerprint: segment} - do konwersji, gdy PDF nie ma w cache
+        self.queue = queue.PriorityQueue()
+        self.pending = {}  # {(fingerprint, page_index, tiers): Future}
+        self.running = set()
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.threads = []
+
+    @staticmethod
+    def page_key(fingerprint, page_index, tier):
+        """Klucz wpisu pojedynczej strony segmentu"""
+        return RenderCache.make_key(f'{fingerprint}#{page_index}', tier)
+
+    def register(self, segments):
+        """Zapamiętaj segmenty podglądu (bez wczytanych dokumentów) - strony można potem dociągać po fingerprincie"""
+        with self.lock:
+            for segment in segments:
+                self.segments[segment['fingerprint']] = {**segment, 'doc': None}
+                self.segments.move_to_end(segment['fingerprint'])
+            while len(self.segments) > self.max_segments:
+                self.segments.popitem(last=False)
+
+    def request(self, fingerprint, page_index, tiers, priority=VIEWPORT):
+        """Future z {poziom: hash} strony - wyższy priorytet (mniejsza liczba) wyprzedza kolejkę"""
+        key = (fingerprint, page_index, tuple(tiers))
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = Future()
+                future.priority = priority
+                self.pending[key] = future
+            elif priority < future.priority and key not in self.running:
+                # Prefetch stał się widokiem - drugi wpis w kolejce, stary zostanie pominięty
+                future.priority = priority
+            else:
+                return future
+            self.seq += 1
+            self.queue.put((priority, self.seq, key))
+            self._ensure_workers()
+        metrics.inc('page_loader_requests_total', kind='viewport' if priority == self.VIEWPORT else 'prefetch')
+        return future
+
+    def prefetch(self, fingerprint, page_index, tiers, distance=PAGE_PREFETCH):
+        """Sąsiednie strony tego samego segmentu w tle (bliższe najpierw)"""
+        page_count = page_count_index.get(fingerprint)
+        for offset in range(1, distance + 1):
+            for neighbour in (page_index + offset, page_index - offset):
+                if 0 <= neighbour and (page_count is None or neighbour < page_count):
+                    self.request(fingerprint, neighbour, tiers, self.PREFETCH + offset)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _ensure_workers(self):
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'page-loader-{len(self.threads)}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            _, _, key = self.queue.get()
+            with self.lock:
+                future = self.pending.get(key)
+                if future is None or key in self.running:
+                    continue
+                self.running.add(key)
 
-        print(f"[STARTUP] Renderuję {filename}...", end=' ')
+            try:
+                result = self._load(*key)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self.lock:
+                    self.running.discard(key)
+                    self.pending.pop(key, None)
+
+    def _cached(self, fingerprint, page_index, tier):
+        """Hash strony z wpisu całego segmentu lub wpisu pojedynczej strony (None gdy brak)"""
+        pages = render_cache.get_page_hashes(RenderCache.make_key(fingerprint, tier))
+        if pages is not None:
+            if page_index >= len(pages):
+                raise IndexError(f'Segment ma {len(pages)} stron')
+            return pages[page_index]
+        hashes = render_cache.get_page_hashes(self.page_key(fingerprint, page_index, tier))
+        return hashes[0] if hashes else None
+
+    def _segment_pdf(self, fingerprint):
+        """
+        PDF segmentu z cache (samodzielny lub wycięty z podglądu single-pass - ten sam układ co JPG podglądu)
+        albo konwersja zapamiętanego segmentu (LookupError gdy nieznany)
+        """
+        for tier in PDF_TIERS:
+            pdf_hashes = render_cache.get_page_hashes(RenderCache.make_key(fingerprint, tier))
+            pdf_bytes = render_cache.read_blob(pdf_hashes[0]) if pdf_hashes else None
+            if pdf_bytes is not None:
+                return pdf_bytes
+
+        with self.lock:
+            segment = self.segments.get(fingerprint)
+        if segment is None:
+            raise LookupError(f'Brak PDF w cache: {fingerprint[:12]}')
 
         try:
-            # Renderuj do OUT_JPG_DIR jako statyczne JPG
-            out_folder = os.path.join(OUT_JPG_DIR, filename.replace('.docx', ''))
-            os.makedirs(out_folder, exist_ok=True)
+            return ensure_segment_pdf(segment)[0]
+        finally:
+            segment['doc'] = None
+
+    def _load(self, fingerprint, page_index, tiers):
+        result = {tier: self._cached(fingerprint, page_index, tier) for tier in tiers}
+        missing = tuple(tier for tier, page_hash in result.items() if page_hash is None)
+        if not missing:
+            metrics.inc('page_loads_total', source='cache')
+            return result
+
+        pdf_bytes = self._segment_pdf(fingerprint)
+        page_count = pdf_page_count(pdf_bytes)
+        if page_index >= page_count:
+            raise IndexError(f'Segment ma {page_count} stron')
+
+        settings = [(RENDER_TIERS[tier]['dpi'], RENDER_TIERS[tier]['quality']) for tier in missing]
+        with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+            pdf_path = os.path.join(tmpdir, 'segment.pdf')
+            with open(pdf_path, 'wb') as f:
+                f.write(pdf_bytes)
+            images = self._rasterize(pdf_path, page_index, settings)
+
+        for tier, img_bytes in zip(missing, images):
+            result[tier] = render_cache.put_blob(img_bytes)
+            render_cache.put_entry(self.page_key(fingerprint, page_index, tier), [result[tier]])
+            self._complete(fingerprint, tier, page_count)
+        metrics.inc('page_loads_total', source='render')
+        return result
+
+    @staticmethod
+    def _rasterize(pdf_path, page_index, settings):
+        """Jedna strona - w puli procesów (PyMuPDF trzyma GIL), bez puli / po awarii w wątku"""
+        if not HAS_PYMUPDF:
+            with metrics.span('rasterize', backend='pdf2image'):
+                return [pdf_to_jpg_pdf2image(pdf_path, dpi=dpi, quality=quality)[page_index] for dpi, quality in settings]
+
+        pool = get_raster_pool()
+        if pool is not None:
+            try:
+                return record_page_timing(pool.submit(rasterize_pdf_page, pdf_path, page_index, settings).result())
+            except BrokenProcessPool:
+                print("[RASTER] ⚠️ Pula procesów padła - strona w wątku")
+                reset_raster_pool()
+        return record_page_timing(rasterize_pdf_page(pdf_path, page_index, settings))
+
+    def _complete(self, fingerprint, tier, page_count):
+        """Wszystkie strony poziomu już osobno w cache → wpis całego segmentu"""
+        hashes = []
+        for page_index in range(page_count):
+            page_hashes = render_cache.get_page_hashes(self.page_key(fingerprint, page_index, tier))
+            if not page_hashes:
+                return
+            hashes.append(page_hashes[0])
+        render_cache.put_entry(RenderCache.make_key(fingerprint, tier), hashes)
+        page_count_index.put(fingerprint, page_count)
+
+
+page_loader = PageLoader(PAGE_LOADER_WORKERS, PAGE_LOADER_MAX_SEGMENTS)
+
+
+def find_segment_starts(pdf_path, segment_count):
+    """Znajdź stronę startową każdego segmentu po znacznikach w tekście PDF"""
+    starts = [0] + [None] * (segment_count - 1)
+
+    with fitz.open(pdf_path) as pdf:
+        for page_no, page in enumerate(pdf):
+            for match in SEGMENT_MARKER_RE.finditer(page.get_text()):
+                idx = int(match.group(1))
+                if 0 < idx < segment_count and starts[idx] is None:
+                    starts[idx] = page_no
+
+    if None in starts or starts != sorted(starts):
+        return None
+    return starts
 
-            # Konwertuj
-            images = convert_docx_to_images(filepath, use_cache=False)
 
-            # Zapisz JPG na dysk
-            for i, img_data in enumerate(images, 1):
-                # Wyciągnij base64
-                if img_data.startswith('data:image/jpeg;base64,'):
-                    img_b64 = img_data.split(',', 1)[1]
-                    img_bytes = base64.b64decode(img_b64)
+class SinglePassUnavailable(RuntimeError):
+    """Nie da się pociąć PDF całej oferty na segmenty - trzeba renderować per plik"""
 
-                    jpg_path = os.path.join(out_folder, f'page_{i:04d}.jpg')
-                    with open(jpg_path, 'wb') as f:
-                        f.write(img_bytes)
 
-            print(f"✓ {len(images)} stron")
+def iter_offer_single_pass(segments, tiers=PREVIEW_TIERS):
+    """
+    Render w jednym przebiegu: merge_docx_packages → jedna konwersja DOCX → PDF → JPG
+    Strony PDF są cięte z powrotem na segmenty po niewidocznych znacznikach
+    Generator: (segment, page_index, {poziom: hash}) strona po stronie, w kolejności
+    Każdy kompletny segment (JPG + wycięty PDF) trafia do cache pod swoim fingerprintem
+    """
+    if not HAS_PYMUPDF or not segments:
+        raise SinglePassUnavailable("Brak PyMuPDF")
+
+    with tempfile.TemporaryDirectory(dir=OUT_JPG_DIR) as tmpdir:
+        docx_path = os.path.join(tmpdir, 'offer.docx')
+        pdf_path = os.path.join(tmpdir, 'offer.pdf')
+        merge_docx_packages((segment_package(segment) for segment in segments), docx_path, segment_markers=True)
+
+        try:
+            docx_to_pdf(docx_path, pdf_path)
         except Exception as e:
-            print(f"✗ {e}")
+            raise SinglePassUnavailable(f"Konwersja całej oferty: {e}") from e
+
+        starts = find_segment_starts(pdf_path, len(segments))
+        if starts is None:
+            raise SinglePassUnavailable("Nie znaleziono znaczników segmentów w PDF")
+
+        # PDF każdego segmentu osobno do cache (pełna jakość podglądu) - ze znacznikami, więc nie do eksportu
+        with fitz.open(pdf_path) as pdf:
+            bounds = starts + [pdf.page_count]
+            for i, segment in enumerate(segments):
+                with fitz.open() as part:
+                    part.insert_pdf(pdf, from_page=bounds[i], to_page=bounds[i + 1] - 1)
+                    render_cache.put_pages(RenderCache.make_key(segment['fingerprint'], 'pdf_slice'), [part.tobytes()])
+                    page_count_index.put(segment['fingerprint'], part.page_count)
+
+        def store_segment(segment, pages):
+            for tier in tiers:
+                render_cache.put_entry(RenderCache.make_key(segment['fingerprint'], tier), [p[tier] for p in pages])
+
+        seg_idx = 0
+        pages = []
+        for page_no, images in enumerate(iter_tier_pages(pdf_path, tiers)):
+            while seg_idx + 1 < len(segments) and page_no >= starts[seg_idx + 1]:
+                # Poprzedni segment kompletny
+                store_segment(segments[seg_idx], pages)
+                seg_idx += 1
+                pages = []
+
+            page_hashes = {tier: render_cache.put_blob(img_bytes) for tier, img_bytes in images.items()}
+            pages.append(page_hashes)
+            yield segments[seg_idx], len(pages) - 1, page_hashes
+
+        store_segment(segments[seg_idx], pages)
+
+
+def page_metadata(segment, page_index, number, page_hashes=None, tier=DEFAULT_TIER):
+    """Metadane strony podglądu - bez hashy strona jest do dociągnięcia na żądanie (/api/load-page)"""
+    page_data = {
+        'type': segment['type'],
+        'number': number,
+        'tier': tier,
+        'has_image': True,
+        'page_index': page_index,
+        'status': 'ready',
+        'fingerprint': segment['fingerprint']
+    }
+    if page_hashes is not None:
+        page_data.update(
+            image=page_url(page_hashes[tier]),
+            image_hash=page_hashes[tier],
+            thumbnail=page_url(page_hashes['thumb'])
+        )
+    if segment['type'] == 'product':
+        page_data['product_id'] = segment['product_id']
+    else:
+        page_data['source_file'] = segment['source_file']
+    return page_data
+
 
-    print("[STARTUP] ✅ Szablony JPG gotowe!")
-    print("="*80 + "\n")
+def emit_page(segment, page_index, page_hashes, pages_metadata, tier=DEFAULT_TIER):
+    """Wyślij metadane strony przez WebSocket (obraz i miniatura jako URL) i dopisz do listy"""
+    page_data = page_metadata(segment, page_index, len(pages_metadata) + 1, page_hashes, tier)
+    pages_metadata.append(page_data)
+    send_page_ready(page_data)
 
 
-def preload_async():
-    """Uruchom pre-rendering w tle"""
-    thread = threading.Thread(target=lambda: (preload_all_products(), preload_templates()), daemon=True)
-    thread.start()
+def emit_segment_pages(segment, pages, pages_metadata, tier=DEFAULT_TIER):
+    """Wyślij wszystkie strony segmentu"""
+    for idx, page_hashes in enumerate(pages):
+        emit_page(segment, idx, page_hashes, pages_metadata, tier)
+
+
+def stream_single_pass(segments, pos, batch, rendered, pages_metadata, tier=DEFAULT_TIER):
+    """
+    Wyślij strony z iter_offer_single_pass(batch) w kolejności oferty
+    Segmenty z cache leżące pomiędzy zmienionymi wysyłane są gdy przyjdzie ich kolej
+    Zwraca pozycję pierwszego niewysłanego segmentu
+    """
+    pages = iter_offer_single_pass(batch, preview_tiers(tier))
+    current_fp = None
+    current_hashes = []
+
+    for segment, page_index, page_hashes in pages:
+        if segment['fingerprint'] != current_fp:
+            if current_fp is not None:
+                # Poprzedni segment kompletny → wyślij następne z cache
+                rendered[current_fp] = current_hashes
+                pos += 1
+                while pos < len(segments) and segments[pos]['fingerprint'] in rendered:
+                    emit_segment_pages(segments[pos], rendered[segments[pos]['fingerprint']], pages_metadata, tier)
+                    pos += 1
+            current_fp = segment['fingerprint']
+            current_hashes = []
+
+        current_hashes.append(page_hashes)
+        emit_page(segments[pos], page_index, page_hashes, pages_metadata, tier)
+
+    if current_fp is not None:
+        rendered[current_fp] = current_hashes
+        pos += 1
+    return pos
+
+
+def stream_lazy(segments, pages_metadata, tier=DEFAULT_TIER, viewport=None):
+    """
+    Podgląd 'lazy': liczby stron segmentów (PDF-y równolegle, bez rasteryzacji), a renderowane i wysyłane
+    tylko strony z widoku klienta - sąsiednie w tle, pozostałe dopiero na żądanie przez /api/load-page
+    viewport: [pierwsza, ostatnia] strona oferty (od 0)
+    """
+    tiers = preview_tiers(tier)
+    first, last = viewport or (0, LAZY_VIEWPORT_PAGES - 1)
+    page_loader.register(segments)
+
+    unique = list({segment['fingerprint']: segment for segment in segments}.values())
+    workers = max(1, min(CONVERTER_WORKERS, len(unique)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='page-count') as executor:
+        counts = {segment['fingerprint']: executor.submit(segment_page_count, segment) for segment in unique}
+
+        for segment in segments:
+            page_count = counts[segment['fingerprint']].result() or 0
+            segment['doc'] = None
+            start = len(pages_metadata)
+
+            # Strony widoku zlecone razem (równoległa rasteryzacja), wysyłane w kolejności
+            visible = {idx: page_loader.request(segment['fingerprint'], idx, tiers)
+                       for idx in range(page_count) if first <= start + idx <= last}
+            for idx in range(page_count):
+                number = start + idx
+                if idx in visible:
+                    emit_page(segment, idx, visible[idx].result(timeout=PAGE_LOAD_TIMEOUT), pages_metadata, tier)
+                    continue
+                pages_metadata.append(page_metadata(segment, idx, number + 1, tier=tier))
+                distance = first - number if number < first else number - last
+                if distance <= PAGE_PREFETCH:
+                    page_loader.request(segment['fingerprint'], idx, tiers, PageLoader.PREFETCH + distance)
+
+
+def record_preview_timing(mode, elapsed):
+    """Zapamiętaj czas podglądu dla porównania trybów"""
+    with preview_timings_lock:
+        preview_timings[mode].append(elapsed)
+
+
+def preview_timing_summary():
+    """Średnie czasy podglądu per tryb (ostatnie pomiary)"""
+    with preview_timings_lock:
+        return {
+            mode: {
+                'count': len(values),
+                'last': round(values[-1], 3) if values else None,
+                'avg': round(sum(values) / len(values), 3) if values else None
+            }
+            for mode, values in preview_timings.items()
+        }
 
 
 # ============================================================
-# POMOCNICZE FUNKCJE
+# KOLEJKA ZADAŃ (generowanie / podgląd w tle)
 # ============================================================
 
-def send_progress(message, percent):
-    """Wyślij progress przez WebSocket"""
-    try:
-        socketio.emit('conversion_progress', {'message': message, 'percent': percent})
-    except:
-        pass
-
+class JobCancelled(Exception):
+    """Zadanie anulowane przez użytkownika - przerwij pracę"""
+
+
+class JobQueueFull(RuntimeError):
+    """Kolejka pełna - odrzuć nowe zadanie (503)"""
+
+
+class Job:
+    """Pojedyncze zadanie w tle: stan, postęp i wynik"""
+
+    def __init__(self, kind, payload_key):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload_key = payload_key
+        self.status = 'queued'  # queued → running → done / failed / cancelled
+        self.message = ''
+        self.percent = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.clients = set()  # sid klientów WebSocket, którym wysyłamy postęp i strony
+        self.trace = []  # spany etapów (metrics.span) - GET /api/jobs/<id> z nagłówkiem X-Debug-Trace
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def check_cancelled(self):
+        """Punkt kontrolny - rzuca JobCancelled gdy anulowano"""
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.id)
+
+    def to_dict(self):
+        info = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'message': self.message,
+            'percent': self.percent,
+            'created': datetime.fromtimestamp(self.created).isoformat(timespec='seconds'),
+        }
+        if self.started:
+            info['queue_time'] = f"{self.started - self.created:.2f}s"
+        if self.finished and self.started:
+            info['run_time'] = f"{self.finished - self.started:.2f}s"
+        if self.status == 'done':
+            info['result'] = self.result
+        if self.status == 'failed':
+            info['error'] = self.error
+        return info
+
+
+class JobManager:
+    """
+    Ograniczona pula wątków dla długich zadań
+    - POST zwraca job_id od razu, praca w tle
+    - limit kolejki (nadmiar odrzucany zamiast czekać w nieskończoność)
+    - ten sam payload w toku → to samo zadanie (deduplikacja)
+    """
 
-def send_page_ready(page_data):
-    """Wyślij gotową stronę przez WebSocket"""
+    def __init__(self, workers, max_queue, result_ttl):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.jobs = {}      # {job_id: Job}
+        self.inflight = {}  # {payload_key: job_id}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def payload_key(kind, payload):
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(f"{kind}|{raw}".encode('utf-8')).hexdigest()
+
+    def current(self):
+        """Zadanie wykonywane w bieżącym wątku (None poza kolejką)"""
+        return getattr(self.local, 'job', None)
+
+    def queue_depth(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status == 'queued')
+
+    def _prune(self):
+        """Usuń zakończone zadania starsze niż result_ttl"""
+        now = time.time()
+        for job_id in [j.id for j in self.jobs.values() if j.finished and now - j.finished > self.result_ttl]:
+            del self.jobs[job_id]
+
+    def submit(self, kind, payload, fn, client=None):
+        """
+        Zleć fn(payload) w tle - zwraca (job, czy_nowe)
+        client (sid WebSocket) dostaje zdarzenia zadania - także gdy dołącza do trwającego
+        JobQueueFull gdy w kolejce czeka już max_queue zadań
+        """
+        key = self.payload_key(kind, payload)
+        with self.lock:
+            self._prune()
+
+            job_id = self.inflight.get(key)
+            if job_id is not None and self.jobs[job_id].active:
+                if client:
+                    self.jobs[job_id].clients.add(client)
+                return self.jobs[job_id], False
+
+            queued = sum(1 for job in self.jobs.values() if job.status == 'queued')
+            if queued >= self.max_queue:
+                raise JobQueueFull(f"Kolejka pełna ({queued} zadań)")
+
+            job = Job(kind, key)
+            if client:
+                job.clients.add(client)
+            self.jobs[job.id] = job
+            self.inflight[key] = job.id
+            job.future = self.executor.submit(self._run, job, fn, payload)
+            return job, True
+
+    def _finish(self, job, status):
+        with self.lock:
+            job.status = status
+            job.finished = time.time()
+            if self.inflight.get(job.payload_key) == job.id:
+                del self.inflight[job.payload_key]
+
+    def _run(self, job, fn, payload):
+        with self.lock:
+            if job.status != 'queued':
+                return
+            job.status = 'running'
+            job.started = time.time()
+
+        self.local.job = job
+        metrics.start_trace(job.trace)
+        metrics.observe('job_queue_seconds', job.started - job.created, kind=job.kind)
+        try:
+            job.check_cancelled()
+            job.result = fn(payload)
+            self._finish(job, 'done')
+        except JobCancelled:
+            print(f"[JOB] ⏹️ Anulowano: {job.kind} {job.id[:8]}")
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            print(f"[JOB] ❌ {job.kind} {job.id[:8]}: {e}")
+            job.error = str(e)
+            self._finish(job, 'failed')
+        finally:
+            self.local.job = None
+            metrics.stop_trace()
+            metrics.observe('job_seconds', job.finished - job.started, kind=job.kind, status=job.status)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Anuluj zadanie - czekające od razu, trwające w najbliższym punkcie kontrolnym"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or not job.active:
+                return job
+            job.cancel_event.set()
+            queued = job.status == 'queued'
+
+        if queued and job.future.cancel():
+            self._finish(job, 'cancelled')
+        return job
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {'workers': self.executor._max_workers, 'max_queue': self.max_queue, 'jobs': counts}
+
+
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_RESULT_TTL)
+
+
+def submit_job(kind, payload, fn):
+    """
+    Zleć zadanie i zwróć odpowiedź HTTP (202 z job_id lub 503 przy przeciążeniu)
+    clientId (socket.id) nie wchodzi do klucza deduplikacji - wskazuje tylko odbiorcę zdarzeń
+    """
+    client = payload.pop('clientId', None)
     try:
-        socketio.emit('page_ready', page_data)
-    except:
-        pass
+        job, created = job_manager.submit(kind, payload, fn, client=client)
+    except JobQueueFull as e:
+        response = jsonify({'success': False, 'error': f'Serwer przeciążony: {e}'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    print(f"[JOB] {'➕ Nowe' if created else '♻️ W toku'}: {kind} {job.id[:8]}")
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'deduplicated': not created,
+        'status_url': f'/api/jobs/{job.id}'
+    }), 202
 
 
-def replace_placeholders(doc, data):
-    """Zamień {{placeholders}} w dokumencie"""
-    for paragraph in doc.paragraphs:
-        for key, value in data.items():
-            if key != 'produkty':
-                placeholder = '{{' + key + '}}'
-                if placeholder in paragraph.text:
-                    paragraph.text = paragraph.text.replace(placeholder, str(value))
-
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for key, value in data.items():
-                    if key != 'produkty':
-                        placeholder = '{{' + key + '}}'
-                        if placeholder in cell.text:
-                            cell.text = cell.text.replace(placeholder, str(value))
+class OfferResultCache:
+    """
+    Gotowe wyniki całych ofert (pliki DOCX / PDF, manifest stron podglądu) dla identycznych danych
+    - klucz: kanoniczny hash (rodzaj, szablon + hashe jego plików, formData, produkty w kolejności + ich hashe,
+      pola własne wybranych produktów, opcje wyniku) - zmiana treści pliku = inny klucz
+    - LRU (max_entries) + TTL; wpisy zależne od zmienionego pliku usuwa obserwator plików
+    """
 
-    return doc
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {klucz: {'result', 'deps', 'created'}}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def dependencies(data):
+        """Pliki, od których zależy wynik: pliki szablonu (w kolejności) + produkty (w kolejności)"""
+        paths = template_source_paths(data.get('templateData'))
+        paths += [os.path.join(PRODUKTY_DIR, f'{product_id}.docx') for product_id in data.get('selectedProducts', [])]
+        return paths
+
+    def key(self, kind, data):
+        """(klucz, zależności) - (None, None) gdy któregoś pliku brak (wynik i tak się nie uda)"""
+        paths = self.dependencies(data)
+        hashes = [get_file_hash(path) for path in paths]
+        if None in hashes:
+            return None, None
+
+        selected = [str(product_id) for product_id in data.get('selectedProducts', [])]
+        custom = {
+            product_id: {field: str(value) for field, value in fields.items()}
+            for product_id, fields in (data.get('productCustomFields') or {}).items()
+            if product_id in selected and fields
+        }
+        if kind == 'generate':
+            options = {'format': data.get('format', 'docx')}
+        else:
+            options = {'mode': data.get('previewMode', PREVIEW_DEFAULT_MODE), 'tier': data.get('tier', DEFAULT_TIER)}
+
+        canonical = json.dumps({
+            'kind': kind,
+            'version': RENDER_CACHE_VERSION,
+            'template': (data.get('templateData') or {}).get('id'),
+            'files': [[os.path.relpath(path, BASE_DIR), file_hash] for path, file_hash in zip(paths, hashes)],
+            'form': {field: str(value) for field, value in (data.get('formData') or {}).items()},
+            'products': selected,
+            'custom': custom,
+            'options': options,
+        }, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest(), set(paths)
+
+    # Statystyki konkretnego przebiegu - w trafieniu byłyby nieaktualne, więc nie trafiają do cache
+    RUN_STATS = frozenset({'generation_time', 'render_time', 'timings', 'template_cache', 'file_hashes'})
+
+    @staticmethod
+    def _files_exist(result):
+        """
+        Wygenerowane pliki (retencja) i bloby stron podglądu (LRU cache renderów)
+        mogły zostać usunięte - wtedy wynik nieważny
+        """
+        names = [result.get(field) for field in ('filename', 'pdf_filename') if result.get(field)]
+        if not all(os.path.exists(os.path.join(GENERATED_OFFERS_DIR, name)) for name in names):
+            return False
+        page_hashes = {meta['image_hash'] for meta in result.get('pages_metadata', ()) if meta.get('image_hash')}
+        return all(os.path.exists(render_cache.blob_path(page_hash)) for page_hash in page_hashes)
+
+    def get(self, kind, data):
+        """Kopia zapamiętanego wyniku lub None"""
+        key, _ = self.key(kind, data)
+        result = None
+        if key is not None:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and time.time() - entry['created'] > self.ttl:
+                    del self.entries[key]
+                    entry = None
+                if entry is not None and not self._files_exist(entry['result']):
+                    del self.entries[key]
+                    entry = None
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    result = {**entry['result'], 'cached': True,
+                              'cached_at': datetime.fromtimestamp(entry['created']).isoformat(timespec='seconds')}
+
+        metrics.inc('offer_cache_lookups_total', kind=kind, result='hit' if result else 'miss')
+        return result
+
+    def put(self, key, deps, result):
+        if key is None or not result.get('success'):
+            return
+        result = {field: value for field, value in result.items() if field not in self.RUN_STATS}
+        with self.lock:
+            self.entries[key] = {'result': result, 'deps': deps, 'created': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, paths=None):
+        """Usuń wpisy zależne od plików (None = wszystkie) - zwraca liczbę usuniętych"""
+        with self.lock:
+            if paths is None:
+                dropped = list(self.entries)
+            else:
+                paths = {os.path.abspath(path) for path in paths}
+                dropped = [key for key, entry in self.entries.items() if entry['deps'] & paths]
+            for key in dropped:
+                del self.entries[key]
+        return len(dropped)
 
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
 
-def add_page_break_to_doc(doc):
-    """Dodaj page break na końcu dokumentu"""
-    paragraph = doc.add_paragraph()
-    run = paragraph.add_run()
-    run.add_break(docx.enum.text.WD_BREAK.PAGE)
-    return doc
+
+offer_cache = OfferResultCache(OFFER_CACHE_MAX_ENTRIES, OFFER_CACHE_TTL)
 
 
-def merge_documents(docs):
+class GeneratedRetention:
     """
-    Prosta funkcja do łączenia wielu dokumentów DOCX
-    Zwraca połączony dokument
+    Retencja wygenerowanych ofert - katalog nie rośnie bez końca
+    - jednostka: plik w katalogu ofert albo partia (katalog + archiwum ZIP o tym samym id)
+    - starsze niż max_age usuwane zawsze, potem najstarsze aż suma <= max_bytes
+      (młodszych niż keep_recent limit rozmiaru nie rusza)
+    - sprzątanie na starcie i po każdym zapisie - kilkaset plików to tani skan
     """
-    if not docs:
-        return Document()
 
-    # Pierwszy dokument jako baza
-    merged = docs[0]
+    def __init__(self, directory, batch_dir, max_bytes, max_age, keep_recent):
+        self.directory = directory
+        self.batch_dir = batch_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep_recent = keep_recent
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _tree_stat(path):
+        """(rozmiar, najnowszy mtime) katalogu z zawartością"""
+        size, mtime = 0, os.stat(path).st_mtime
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+        return size, mtime
 
-    # Dodaj pozostałe dokumenty
-    for doc in docs[1:]:
-        # Dodaj page break
-        merged = add_page_break_to_doc(merged)
+    def _units(self):
+        """[(mtime, rozmiar, [ścieżki])] - od najstarszych"""
+        units = {}
 
-        # Skopiuj wszystkie elementy z doc do merged
-        for element in doc.element.body:
-            merged.element.body.append(element)
+        def add(key, path, size, mtime):
+            unit = units.setdefault(key, [0, 0, []])
+            unit[0] = max(unit[0], mtime)
+            unit[1] += size
+            unit[2].append(path)
 
-    return merged
+        for directory, is_batch in ((self.directory, False), (self.batch_dir, True)):
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not is_batch:
+                            continue  # katalog partii
+                        size, mtime = self._tree_stat(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        size, mtime = st.st_size, st.st_mtime
+                except OSError:
+                    continue
+                key = ('batch', entry.name.removesuffix('.zip')) if is_batch else ('offer', entry.name)
+                add(key, entry.path, size, mtime)
+        return sorted(tuple(unit) for unit in units.values())
+
+    def usage(self):
+        """Łączny rozmiar wygenerowanych plików (bajty)"""
+        return sum(size for _, size, _ in self._units())
+
+    def prune(self):
+        """Usuń pliki ponad limit wieku / rozmiaru - zwraca (liczba jednostek, zwolnione bajty)"""
+        with self.lock:
+            units = self._units()
+            total = sum(size for _, size, _ in units)
+            now = time.time()
+            removed = freed = 0
+
+            for mtime, size, paths in units:
+                age = now - mtime
+                expired = age > self.max_age
+                if not expired and (total <= self.max_bytes or age < self.keep_recent):
+                    continue
+                for path in paths:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                total -= size
+                removed += 1
+                freed += size
+                metrics.inc('generated_offers_pruned_total', reason='age' if expired else 'quota')
 
+        if removed:
+            print(f"[RETENTION] 🗑️ Usunięto {removed} ({freed / 1024 / 1024:.1f} MB), zostało {total / 1024 / 1024:.1f} MB")
+        return removed, freed
 
-def generate_table_of_contents(selected_products, product_custom_fields, start_page=5):
-    """Generuj spis treści dla WolfTax"""
-    toc_lines = []
-    current_page = start_page
 
-    for idx, product_id in enumerate(selected_products, 1):
-        product_data = product_custom_fields.get(product_id, {})
-        title = product_data.get('title') or product_data.get('nazwa') or f'Produkt {product_id}'
+generated_retention = GeneratedRetention(GENERATED_OFFERS_DIR, BATCH_DIR, GENERATED_MAX_BYTES,
+                                         GENERATED_MAX_AGE, GENERATED_KEEP_RECENT)
+stream_slots = threading.BoundedSemaphore(JOB_WORKERS)  # równoległe generowanie strumieniowe
 
-        base_text = f"Usługa {idx} – {title}"
-        dots_count = max(60 - len(base_text), 10)
-        dots = '…' * dots_count
 
-        line = f"§\t{base_text} {dots}  {current_page:02d}"
-        toc_lines.append(line)
+def submit_offer_job(kind, data, fn):
+    """Identyczna oferta już policzona → wynik od razu (200, status 'done'); inaczej zadanie w tle"""
+    result = offer_cache.get(kind, data)
+    if result is None:
+        return submit_job(kind, data, fn)
 
-        # Policz strony produktu
-        product_path = os.path.join(PRODUKTY_DIR, f'{product_id}.docx')
-        file_hash = get_file_hash(product_path)
-        if file_hash and file_hash in conversion_cache:
-            product_pages = len(conversion_cache[file_hash])
-        else:
-            product_pages = 1
+    usage_stats.record_offer(data.get('templateData'), data.get('selectedProducts', []))
+    print(f"[OFFER CACHE] ⚡ Hit: {kind}")
+    return jsonify({'success': True, 'status': 'done', 'cached': True, 'result': result})
 
-        current_page += product_pages
 
-    return '\n'.join(toc_lines)
+# ============================================================
+# MASOWE GENEROWANIE OFERT (BATCH)
+# ============================================================
 
+def load_templates():
+    """Szablony z templates.json (pusta lista gdy brak pliku lub błędny JSON)"""
+    templates_path = os.path.join(TEMPLATES_DIR, 'templates.json')
+    try:
+        with open(templates_path, 'r', encoding='utf-8') as f:
+            return json.load(f)['templates']
+    except (OSError, ValueError, KeyError):
+        return []
 
-def inject_toc_into_doc(doc, toc_text):
-    """Wstaw spis treści do dokumentu"""
-    injected = False
 
-    for para in doc.paragraphs:
-        if '{{SPIS_TRESCI}}' in para.text or '{{TOC}}' in para.text:
-            para.text = para.text.replace('{{SPIS_TRESCI}}', toc_text)
-            para.text = para.text.replace('{{TOC}}', toc_text)
-            injected = True
-            break
+def find_template(template_id):
+    """Konfiguracja szablonu z templates.json (None gdy brak)"""
+    for template in load_templates():
+        if template['id'] == template_id:
+            return template
+    return None
 
-    if not injected:
-        doc.add_paragraph(toc_text)
 
-    return doc
+def parse_product_list(value):
+    """'1;2, 7' → ['1', '2', '7'] (kolumna CSV)"""
+    return [item for item in re.split(r'[;,\s]+', value or '') if item]
 
 
-# ============================================================
-# GENEROWANIE OFERTY DOCX
-# ============================================================
+def iter_batch_payloads(source, fmt=None):
+    """
+    Strumień ofert do wygenerowania (format jak saved_offers/*.json)
+    source: ścieżka do pliku JSONL / JSON (lista) / CSV, katalog z plikami *.json
+    lub tekst (fmt: 'jsonl' / 'json' / 'csv')
+    CSV: kolumny templateId, selectedProducts (np. "1;2;7"), offer_name - reszta trafia do formData
+    """
+    if fmt is None and os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if filename.endswith('.json'):
+                with open(os.path.join(source, filename), 'r', encoding='utf-8') as f:
+                    payload = json.load(f)
+                payload.setdefault('offer_name', filename[:-len('.json')])
+                yield payload
+        return
 
-def generate_offer_docx(data, selected_products, template_data):
-    """Generuj ofertę DOCX - multi-file (WolfTax)"""
-    print(f"[DOCX] Generuję ofertę WolfTax z {len(template_data['files'])} plików")
+    if fmt is None:
+        fmt = os.path.splitext(source)[1].lstrip('.').lower() or 'jsonl'
+        with open(source, 'r', encoding='utf-8-sig') as f:
+            text = f.read()
+    else:
+        text = source
+
+    if fmt == 'csv':
+        import csv
+        import io
+        for row in csv.DictReader(io.StringIO(text)):
+            payload = {
+                'templateId': row.pop('templateId', None) or None,
+                'selectedProducts': parse_product_list(row.pop('selectedProducts', '')),
+                'offer_name': row.pop('offer_name', None) or None,
+            }
+            payload['formData'] = {key: value for key, value in row.items() if key}
+            yield {key: value for key, value in payload.items() if value is not None}
+    elif fmt == 'json':
+        data = json.loads(text)
+        yield from (data['offers'] if isinstance(data, dict) else data)
+    else:
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def batch_generate_one(index, payload, out_dir, default_template_id):
+    """
+    Jedna oferta z partii - uruchamiane w procesie puli
+    Szablony parsowane raz na proces (template_cache) i klonowane dla kolejnych ofert
+    """
+    start = time.time()
+    item = {'index': index, 'offer_name': payload.get('offer_name'), 'status': 'failed'}
+    try:
+        template_data = payload.get('templateData') or find_template(payload.get('templateId') or default_template_id)
+        if template_data is None:
+            raise ValueError(f"Nieznany szablon: {payload.get('templateId') or default_template_id}")
+
+        selected_products = payload.get('selectedProducts', [])
+        form_data = payload.get('formData', {})
+        name = payload.get('offer_name') or form_data.get('NazwaFirmyKlienta') or form_data.get('klient') or 'Oferta'
+        name = "".join(c for c in str(name) if c.isalnum() or c in (' ', '-', '_')).strip() or 'Oferta'
+
+        output_path, output_filename = generate_offer_docx(
+            payload, selected_products, template_data,
+            output_dir=out_dir, output_filename=f"{index:04d}_{name}.docx"
+        )
+        item.update(status='ok', docx=output_filename)
+    except Exception as e:
+        item['error'] = str(e)
+    item['time'] = round(time.time() - start, 3)
+    return item
 
-    form_data = data.get('formData', data)
-    product_custom_fields = data.get('productCustomFields', {})
 
-    template_folder = os.path.join(TEMPLATES_DIR, template_data['folder'])
-    files = sorted(template_data['files'], key=lambda x: x['order'])
-    injection_point = template_data.get('injection_point', {})
+def get_batch_pool():
+    """Pula procesów do generowania partii (tworzona leniwie, szablony zostają w pamięci procesów)"""
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            batch_pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return batch_pool
 
-    # Lista wszystkich dokumentów do połączenia
-    docs_to_merge = []
 
-    # Przetwórz wszystkie pliki
-    for file_info in files:
-        file_path = os.path.join(template_folder, file_info['file'])
+def reset_batch_pool():
+    """Porzuć zepsutą pulę partii"""
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is not None:
+            batch_pool.shutdown(wait=False, cancel_futures=True)
+        batch_pool = None
 
-        if not os.path.exists(file_path):
-            continue
 
-        doc = Document(file_path)
-        doc = replace_placeholders(doc, form_data)
+def batch_convert_pdf(out_dir, item, payload, template_id):
+    """
+    PDF pozycji partii (w procesie głównym) - sklejenie PDF-ów segmentów z cache
+    Produkty wspólne dla wielu ofert konwertowane są tylko raz
+    """
+    if item['status'] != 'ok':
+        return item
+    pdf_filename = item['docx'][:-len('.docx')] + '.pdf'
+    try:
+        template_data = payload.get('templateData') or find_template(payload.get('templateId') or template_id)
+        generate_offer_pdf(payload, payload.get('selectedProducts', []), template_data,
+                           output_dir=out_dir, output_filename=pdf_filename)
+        item['pdf'] = pdf_filename
+    except Exception as e:
+        item['pdf_error'] = str(e)
+    return item
 
-        # Spis treści
-        if file_info.get('is_toc') and len(selected_products) > 0:
-            toc_config = template_data.get('toc', {})
-            start_page = toc_config.get('start_page', 5)
-            toc_text = generate_table_of_contents(selected_products, product_custom_fields, start_page)
-            doc = inject_toc_into_doc(doc, toc_text)
-            print(f"[DOCX] Spis treści dodany")
 
-        docs_to_merge.append(doc)
+def run_batch(payloads, pdf=False, template_id='wolftax', progress_callback=None, batch_id=None):
+    """
+    Wygeneruj partię ofert równolegle w puli procesów
+    Wynik w GENERATED_OFFERS_DIR/batches/<batch_id>/: pliki DOCX (i PDF), manifest.json, archiwum ZIP
+    progress_callback(done, total, item) po każdej gotowej ofercie
+    """
+    start_time = time.time()
+    payloads = list(payloads)
+    batch_id = batch_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    out_dir = os.path.join(BATCH_DIR, batch_id)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"[BATCH] {batch_id}: {len(payloads)} ofert, {BATCH_WORKERS} procesów, PDF: {'TAK' if pdf else 'NIE'}")
+
+    pool = get_batch_pool()
+    futures = [pool.submit(batch_generate_one, i, payload, out_dir, template_id) for i, payload in enumerate(payloads, 1)]
+    pdf_pool = ThreadPoolExecutor(max_workers=max(1, CONVERTER_WORKERS), thread_name_prefix='batch-pdf') if pdf else None
+    items = []
+
+    def finished(item):
+        items.append(item)
+        if progress_callback:
+            progress_callback(len(items), len(payloads), item)
+
+    try:
+        pdf_futures = []
+        for future in as_completed(futures):
+            try:
+                item = future.result()
+            except BrokenProcessPool as e:
+                reset_batch_pool()
+                raise RuntimeError(f"Pula procesów partii padła: {e}") from e
 
-        # Injection point - produkty
-        if (injection_point.get('type') == 'between_files' and
-            file_info['file'] == injection_point.get('after')):
+            if pdf_pool is not None and item['status'] == 'ok':
+                pdf_futures.append(pdf_pool.submit(batch_convert_pdf, out_dir, item, payloads[item['index'] - 1], template_id))
+            else:
+                finished(item)
+
+        for future in as_completed(pdf_futures):
+            finished(future.result())
+    finally:
+        for future in futures:
+            future.cancel()
+        if pdf_pool is not None:
+            pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+    items.sort(key=lambda item: item['index'])
+    manifest = {
+        'batch_id': batch_id,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'total': len(items),
+        'succeeded': sum(1 for item in items if item['status'] == 'ok'),
+        'failed': sum(1 for item in items if item['status'] != 'ok'),
+        'pdf': pdf,
+        'elapsed': f"{time.time() - start_time:.2f}s",
+        'items': items,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # Archiwum ZIP obok katalogu partii
+    zip_path = os.path.join(BATCH_DIR, f'{batch_id}.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(os.path.join(out_dir, 'manifest.json'), 'manifest.json')
+        for item in items:
+            for key in ('docx', 'pdf'):
+                if item.get(key):
+                    zf.write(os.path.join(out_dir, item[key]), item[key])
+    manifest['zip'] = zip_path
+
+    print(f"[BATCH] ✓ {batch_id}: {manifest['succeeded']}/{manifest['total']} w {manifest['elapsed']}")
+    return manifest
+
+
+def run_batch_job(data):
+    """Zadanie: partia ofert z API - postęp przez WebSocket (batch_item) i stan zadania"""
+    def progress(done, total, item):
+        send_progress(f"📦 {done}/{total}", int(100 * done / max(total, 1)))
+        send_job_event('batch_item', {**item, 'done': done, 'total': total})
+
+    manifest = run_batch(data['offers'], pdf=data.get('pdf', False),
+                         template_id=data.get('templateId', 'wolftax'), progress_callback=progress)
+    generated_retention.prune()
+    return {
+        'success': True,
+        **{key: value for key, value in manifest.items() if key != 'zip'},
+        'download_url': f"/api/batch/{manifest['batch_id']}/download"
+    }
 
-            # Wstaw produkty
-            print(f"[DOCX] Wstawiam {len(selected_products)} produktów")
-            for product_id in selected_products:
-                product_path = os.path.join(PRODUKTY_DIR, f'{product_id}.docx')
-                if os.path.exists(product_path):
-                    product_doc = Document(product_path)
 
-                    if product_id in product_custom_fields:
-                        custom_data = product_custom_fields[product_id]
-                        product_doc = replace_placeholders(product_doc, custom_data)
+def batch_cli(argv):
+    """python app.py batch oferty.jsonl [--pdf] [--workers N] [--template wolftax] - postęp jako linie JSON"""
+    import argparse
+    global BATCH_WORKERS
 
-                    docs_to_merge.append(product_doc)
+    parser = argparse.ArgumentParser(prog='app.py batch', description='Masowe generowanie ofert')
+    parser.add_argument('source', help='plik JSONL / JSON / CSV lub katalog z ofertami *.json ("-" = JSONL ze stdin)')
+    parser.add_argument('--pdf', action='store_true', help='dodatkowo PDF każdej oferty')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='liczba procesów')
+    parser.add_argument('--template', default='wolftax', help='szablon dla ofert bez templateId')
+    args = parser.parse_args(argv)
 
-    # Połącz wszystkie dokumenty
-    merged_doc = merge_documents(docs_to_merge)
+    BATCH_WORKERS = args.workers
+    if args.source == '-':
+        payloads = iter_batch_payloads(sys.stdin.read(), 'jsonl')
+    else:
+        payloads = iter_batch_payloads(args.source)
 
-    # Zapisz
-    client_name = form_data.get('NazwaFirmyKlienta') or form_data.get('klient') or 'Klient'
-    # Sanitize filename
-    client_name = "".join(c for c in client_name if c.isalnum() or c in (' ', '-', '_')).strip()
-    output_filename = f"Oferta_WolfTax_{client_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
-    output_path = os.path.join(GENERATED_OFFERS_DIR, output_filename)
+    if args.pdf:
+        converter_pool.start()
 
-    merged_doc.save(output_path)
-    print(f"[DOCX] ✓ Zapisano: {output_filename}")
+    def progress(done, total, item):
+        print(json.dumps({'done': done, 'total': total, **item}, ensure_ascii=False), flush=True)
 
-    return output_path, output_filename
+    manifest = run_batch(payloads, pdf=args.pdf, template_id=args.template, progress_callback=progress)
+    print(json.dumps({key: manifest[key] for key in ('batch_id', 'total', 'succeeded', 'failed', 'elapsed', 'zip')},
+                     ensure_ascii=False), flush=True)
+    reset_batch_pool()
+    converter_pool.stop()
+    return 0 if manifest['failed'] == 0 else 1
 
 
 # ============================================================
@@ -619,17 +4266,7 @@ def get_templates():
 @app.route('/api/template/<template_id>')
 def get_template_details(template_id):
     """Szczegóły szablonu z wykrytymi placeholders"""
-    templates_path = os.path.join(TEMPLATES_DIR, 'templates.json')
-
-    with open(templates_path, 'r', encoding='utf-8') as f:
-        templates_data = json.load(f)
-
-    # Znajdź szablon
-    template = None
-    for t in templates_data['templates']:
-        if t['id'] == template_id:
-            template = t
-            break
+    template = find_template(template_id)
 
     if not template:
         return jsonify({'error': 'Szablon nie znaleziony'}), 404
@@ -709,37 +4346,121 @@ def get_saved_offers():
     return jsonify(offers)
 
 
-@app.route('/api/generate-offer', methods=['POST'])
-def generate_offer():
-    """Generuj DOCX"""
-    import time
+def run_generate_offer(data):
+    """Zadanie: generuj DOCX i/lub PDF (format: 'docx' / 'pdf' / 'both') - zwraca dane do pobrania"""
     start_time = time.time()
-
-    data = request.json
-    form_data = data.get('formData', {})
     selected_products = data.get('selectedProducts', [])
     template_data = data.get('templateData')
+    output_format = data.get('format', 'docx')
+    usage_stats.record_offer(template_data, selected_products)
+    cache_key, cache_deps = offer_cache.key('generate', data)
 
     try:
-        send_progress("⚙️ Generowanie DOCX...", 10)
-
-        output_path, output_filename = generate_offer_docx(data, selected_products, template_data)
+        result = {'success': True}
+
+        if output_format in ('pdf', 'both'):
+            # PDF najpierw - segmenty w cache po podglądzie, DOCX skleja paczki bez konwersji
+            send_progress("⚙️ Generowanie PDF...", 10)
+            pdf_path, pdf_filename, cached, total = generate_offer_pdf(data, selected_products, template_data)
+            result.update({
+                'pdf_filename': pdf_filename,
+                'pdf_download_url': f'/api/download-offer/{pdf_filename}',
+                'pdf_segments_cached': f"{cached}/{total}"
+            })
+
+        if output_format in ('docx', 'both'):
+            send_progress("⚙️ Generowanie DOCX...", 50 if output_format == 'both' else 10)
+            output_path, output_filename = generate_offer_docx(data, selected_products, template_data)
+            result.update({'filename': output_filename, 'download_url': f'/api/download-offer/{output_filename}'})
+        else:
+            result.update({'filename': result['pdf_filename'], 'download_url': result['pdf_download_url']})
 
         elapsed = time.time() - start_time
         send_progress(f"✅ Gotowe! ({elapsed:.1f}s)", 100)
 
-        time.sleep(0.3)
-        send_progress("", 0)
-
-        return jsonify({
-            'success': True,
-            'filename': output_filename,
-            'download_url': f'/api/download-offer/{output_filename}',
-            'generation_time': f"{elapsed:.2f}s"
-        })
+        result['generation_time'] = f"{elapsed:.2f}s"
+        offer_cache.put(cache_key, cache_deps, result)
+        generated_retention.prune()
+        return result
+    except JobCancelled:
+        raise
     except Exception as e:
         send_progress(f"❌ Błąd: {str(e)}", 0)
+        raise
+
+
+@app.route('/api/generate-offer', methods=['POST'])
+def generate_offer():
+    """Generuj DOCX / PDF w tle - zwraca job_id (wynik: GET /api/jobs/<job_id>)"""
+    data = request.json
+    if not data or not data.get('templateData'):
+        return jsonify({'success': False, 'error': 'Brak danych szablonu'}), 400
+    if data.get('format', 'docx') not in ('docx', 'pdf', 'both'):
+        return jsonify({'success': False, 'error': f"Nieznany format: {data['format']}"}), 400
+    if data.get('stream') or request.args.get('stream') == '1':
+        return stream_offer(data)
+
+    return submit_offer_job('generate', data, run_generate_offer)
+
+
+def attachment_disposition(filename):
+    """Content-Disposition dla pobierania - nazwa z polskimi znakami w filename* (RFC 5987)"""
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def stream_offer(data):
+    """
+    Oferta od razu w odpowiedzi HTTP - bez zadania, pliku w generated_offers/ i drugiego żądania
+    Dokument składany w SpooledTemporaryFile (w pamięci do STREAM_SPOOL_MAX, większy w pliku
+    tymczasowym), potem wysyłany kawałkami STREAM_CHUNK_SIZE ze znanym Content-Length
+    Błąd generowania = JSON 500 (nic nie zostało jeszcze wysłane)
+    """
+    output_format = data.get('format', 'docx')
+    if output_format not in OFFER_MIMETYPES:
+        return jsonify({'success': False, 'error': 'Strumieniowo tylko jeden format: docx lub pdf'}), 400
+
+    if not stream_slots.acquire(timeout=STREAM_WAIT):
+        response = jsonify({'success': False, 'error': 'Serwer przeciążony: brak wolnego miejsca na generowanie'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    start_time = time.time()
+    selected_products = data.get('selectedProducts', [])
+    template_data = data['templateData']
+    buffer = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MAX, dir=OUT_JPG_DIR)
+    try:
+        usage_stats.record_offer(template_data, selected_products)
+        if output_format == 'pdf':
+            cached, total = write_offer_pdf(data, selected_products, template_data, buffer)
+        else:
+            write_offer_docx(data, selected_products, template_data, buffer)
+    except Exception as e:
+        buffer.close()
+        print(f"[STREAM] ❌ Błąd: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        stream_slots.release()
+
+    size = buffer.tell()
+    buffer.seek(0)
+    elapsed = time.time() - start_time
+    metrics.inc('offer_stream_total', format=output_format)
+    print(f"[STREAM] ✓ {output_format.upper()}: {size / 1024:.0f} KB w {elapsed:.2f}s")
+
+    response = Response(iter(lambda: buffer.read(STREAM_CHUNK_SIZE), b''),
+                        mimetype=OFFER_MIMETYPES[output_format], direct_passthrough=True)
+    # Zamknięcie bufora także gdy klient rozłączy się przed końcem
+    response.call_on_close(buffer.close)
+    response.headers['Content-Length'] = str(size)
+    response.headers['Content-Disposition'] = attachment_disposition(
+        offer_filename(data.get('formData', data), output_format, template_data))
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Generation-Time'] = f"{elapsed:.2f}s"
+    if output_format == 'pdf':
+        response.headers['X-Segments-Cached'] = f"{cached}/{total}"
+    return response
 
 
 @app.route('/api/download-offer/<filename>')
@@ -753,180 +4474,405 @@ def download_offer(filename):
     return send_file(filepath, as_attachment=True, download_name=filename)
 
 
-@app.route('/api/preview-full-offer', methods=['POST'])
-def preview_full_offer():
-    """Generuj podgląd JPG"""
-    data = request.json
-    template_data = data.get('templateData')
-    form_data = data.get('formData', {})
-    selected_products = data.get('selectedProducts', [])
-    product_custom_fields = data.get('productCustomFields', {})
-
-    print(f"[PREVIEW] Template: {template_data['id']}, Produkty: {selected_products}")
-
-    send_progress("Generuję podgląd...", 5)
-
-        # Spis treści
-        if file_info.get('is_toc') and len(selected_products) > 0:
-            toc_config = template_data.get('toc', {})
-            start_page = toc_config.get('start_page', 5)
-            toc_text = generate_table_of_contents(selected_products, product_custom_fields, start_page)
-            doc = inject_toc_into_doc(doc, toc_text)
-
-    # WolfTax multi-file
-    template_folder = os.path.join(TEMPLATES_DIR, template_data['folder'])
-    files = sorted(template_data['files'], key=lambda x: x['order'])
-    injection_point = template_data.get('injection_point', {})
-
-    # Przetwórz każdy plik
-    for file_info in files:
-        file_name = file_info['file']
-        file_path = os.path.join(template_folder, file_name)
-
-        if not os.path.exists(file_path):
-            continue
+@app.route('/api/page/<page_hash>.jpg')
+def get_page_image(page_hash):
+    """Strona podglądu JPEG - adres = hash treści, więc cache na zawsze"""
+    if not PAGE_HASH_RE.fullmatch(page_hash):
+        return jsonify({'error': 'Nieprawidłowy hash'}), 404
 
-        print(f"[PREVIEW] Przetwarzam: {file_name}")
-        send_progress(f"📄 {file_info.get('name', file_name)}...", 10 + page_counter * 2)
+    blob_path = render_cache.blob_path(page_hash)
+    if not os.path.exists(blob_path):
+        return jsonify({'error': 'Strona nie istnieje'}), 404
 
-        # Załaduj i wypełnij placeholders
-        doc = Document(file_path)
-        doc = replace_placeholders(doc, form_data)
+    response = send_file(blob_path, mimetype='image/jpeg', etag=page_hash, conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
-        # Spis treści
-        if file_info.get('is_toc') and len(selected_products) > 0:
-            toc_config = template_data.get('toc', {})
-            start_page = toc_config.get('start_page', 5)
-            toc_text = generate_table_of_contents(selected_products, product_custom_fields, start_page)
-            doc = inject_toc_into_doc(doc, toc_text)
 
-        # Konwertuj na JPG
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.docx', dir=OUT_JPG_DIR) as temp_file:
-            doc.save(temp_file.name)
-            temp_path = temp_file.name
+@app.route('/api/load-page', methods=['POST'])
+def load_single_page():
+    """
+    Lazy loading: URL pojedynczej strony (po fingerprincie segmentu lub ID produktu)
+    Renderowana tylko ta strona (PDF segmentu z cache lub jedna konwersja segmentu)
+    - priority='prefetch': w kolejce za stronami z widoku
+    - prefetch: [{fingerprint, page_index}] sąsiednie strony do przygotowania w tle
+      (bez listy - sąsiednie strony tego samego segmentu)
+    tier='full' renderuje pełną jakość z PDF w cache - bez ponownej konwersji DOCX
+    """
+    data = request.json or {}
+    page_index = data.get('page_index')
+    fingerprint = data.get('fingerprint')
+    product_id = data.get('product_id')
+    tier = data.get('tier', DEFAULT_TIER)
+    priority = PageLoader.PREFETCH if data.get('priority') == 'prefetch' else PageLoader.VIEWPORT
 
-        file_images = convert_docx_to_images(temp_path, use_cache=False)
+    if tier not in RENDER_TIERS:
+        return jsonify({'success': False, 'error': f'Nieznany poziom jakości: {tier}'}), 400
 
-        try:
-            os.unlink(temp_path)
-        except:
-            pass
+    try:
+        if not fingerprint and data.get('type') == 'product' and product_id:
+            segment = make_product_segment(str(product_id), {})
+            if segment is not None:
+                page_loader.register([segment])
+                fingerprint = segment['fingerprint']
+
+        if not fingerprint or not isinstance(page_index, int) or page_index < 0:
+            return jsonify({'success': False, 'error': 'Strona nie znaleziona'}), 404
+
+        future = page_loader.request(fingerprint, page_index, (tier,), priority)
+        if priority == PageLoader.VIEWPORT:
+            neighbours = data.get('prefetch')
+            if isinstance(neighbours, list):
+                for distance, item in enumerate(neighbours, 1):
+                    if isinstance(item, dict) and item.get('fingerprint') and isinstance(item.get('page_index'), int):
+                        page_loader.request(item['fingerprint'], item['page_index'], (tier,),
+                                            PageLoader.PREFETCH + distance)
+            else:
+                page_loader.prefetch(fingerprint, page_index, (tier,))
 
-        # Wyślij strony
-        for idx, img_data in enumerate(file_images):
-            page_counter += 1
-            page_data = {
-                'type': 'template',
-                'number': page_counter,
-                'image': img_data,
-                'has_image': True,
-                'page_index': idx,
-                'status': 'ready',
-                'source_file': file_name
-            }
-            pages_metadata.append(page_data)
-            send_page_ready(page_data)
+        page_hash = future.result(timeout=PAGE_LOAD_TIMEOUT)[tier]
+        return jsonify({
+            'success': True,
+            'image': page_url(page_hash),
+            'image_hash': page_hash,
+            'tier': tier
+        })
+    except (LookupError, IndexError):
+        return jsonify({'success': False, 'error': 'Strona nie znaleziona'}), 404
+    except Exception as e:
+        print(f"[ERROR] Błąd lazy loading: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # Injection point - produkty
-        if (injection_point.get('type') == 'between_files' and
-            file_info['file'] == injection_point.get('after')):
 
-            print(f"[PREVIEW] Injection point - wstawiam {len(selected_products)} produktów")
-            send_progress("Dodaję produkty...", 50)
+@app.route('/api/preview-full-offer', methods=['POST'])
+def preview_full_offer():
+    """Generuj podgląd JPG w tle - zwraca job_id, strony przychodzą przez WebSocket"""
+    data = request.json
+    if not data or not data.get('templateData'):
+        return jsonify({'success': False, 'error': 'Brak danych szablonu'}), 400
+    if data.get('previewMode', PREVIEW_DEFAULT_MODE) not in preview_timings:
+        return jsonify({'success': False, 'error': f"Nieznany tryb podglądu: {data['previewMode']}"}), 400
+    if data.get('tier', DEFAULT_TIER) not in RENDER_TIERS:
+        return jsonify({'success': False, 'error': f"Nieznany poziom jakości: {data['tier']}"}), 400
+    viewport = data.get('viewport')
+    if viewport is not None and not (isinstance(viewport, list) and len(viewport) == 2 and
+                                     all(isinstance(n, int) and n >= 0 for n in viewport) and viewport[0] <= viewport[1]):
+        return jsonify({'success': False, 'error': 'viewport: [pierwsza, ostatnia] strona (od 0)'}), 400
 
-            for product_id in selected_products:
-                product_path = os.path.join(PRODUKTY_DIR, f'{product_id}.docx')
+    return submit_offer_job('preview', data, run_preview)
 
-                if not os.path.exists(product_path):
-                    continue
 
-                # Custom fields
-                path_to_convert = product_path
-                temp_file = None
+def run_preview(data):
+    """
+    Zadanie: podgląd JPG (single_pass: jedna konwersja całej oferty, per_file: konwersja per plik,
+    lazy: tylko strony z widoku klienta, reszta na żądanie)
+    """
+    start_time = time.time()
 
-                if product_id in product_custom_fields and product_custom_fields[product_id]:
-                    custom_data = product_custom_fields[product_id]
-                    product_doc = Document(product_path)
-                    product_doc = replace_placeholders(product_doc, custom_data)
+    template_data = data.get('templateData')
+    selected_products = data.get('selectedProducts', [])
+    mode = data.get('previewMode', PREVIEW_DEFAULT_MODE)
+    tier = data.get('tier', DEFAULT_TIER)
+    tiers = preview_tiers(tier)
+    usage_stats.record_offer(template_data, selected_products)
+    cache_key, cache_deps = offer_cache.key('preview', data)
 
-                    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.docx', dir=OUT_JPG_DIR)
-                    product_doc.save(temp_file.name)
-                    temp_file.close()
-                    path_to_convert = temp_file.name
+    print(f"[PREVIEW] Template: {template_data['id']}, Produkty: {selected_products}, Tryb: {mode}")
 
-                # Konwertuj
-                use_cache = (temp_file is None)
-                product_images = convert_docx_to_images(path_to_convert, use_cache=use_cache)
+    send_progress("Generuję podgląd...", 5)
 
-                if temp_file:
+    pages_metadata = []
+    segments = build_offer_segments(data, selected_products, template_data)
+
+    if mode == 'lazy' and not HAS_PYMUPDF:
+        # Bez PyMuPDF nie da się rasteryzować pojedynczej strony
+        mode = 'per_file'
+
+    if mode == 'lazy':
+        cached_count = sum(1 for segment in segments if get_segment_page_hashes(segment, tiers) is not None)
+        print(f"[PREVIEW] Z cache: {cached_count}/{len(segments)} segmentów (lazy)")
+        stream_lazy(segments, pages_metadata, tier, data.get('viewport'))
+    else:
+        # Segmenty z niezmienionym fingerprintem - prosto z cache
+        rendered = {}  # {fingerprint: [{poziom: hash}]}
+        for segment in segments:
+            pages = get_segment_page_hashes(segment, tiers)
+            if pages is not None:
+                rendered[segment['fingerprint']] = pages
+        cached_count = sum(1 for seg in segments if seg['fingerprint'] in rendered)
+        print(f"[PREVIEW] Z cache: {cached_count}/{len(segments)} segmentów")
+
+        pos = 0
+        while pos < len(segments):
+            segment = segments[pos]
+
+            if segment['fingerprint'] in rendered:
+                emit_segment_pages(segment, rendered[segment['fingerprint']], pages_metadata, tier)
+                pos += 1
+                continue
+
+            print(f"[PREVIEW] Przetwarzam: {segment['name']}")
+            send_progress(f"📄 {segment['name']}...", 10 + int(80 * pos / max(len(segments), 1)))
+
+            if mode == 'single_pass':
+                # Wszystkie pozostałe zmienione segmenty w jednej konwersji
+                batch = []
+                for seg in segments[pos:]:
+                    if seg['fingerprint'] not in rendered and all(b['fingerprint'] != seg['fingerprint'] for b in batch):
+                        batch.append(seg)
+
+                if len(batch) > 1:
                     try:
-                        os.unlink(temp_file.name)
-                    except:
-                        pass
-
-                # Wyślij strony produktu
-                for idx, img_data in enumerate(product_images):
-                    page_counter += 1
-                    page_data = {
-                        'type': 'product',
-                        'number': page_counter,
-                        'product_id': product_id,
-                        'image': img_data,
-                        'has_image': True,
-                        'page_index': idx,
-                        'status': 'ready'
-                    }
-                    pages_metadata.append(page_data)
-                    send_page_ready(page_data)
+                        pos = stream_single_pass(segments, pos, batch, rendered, pages_metadata, tier)
+                        continue
+                    except SinglePassUnavailable as e:
+                        print(f"[PREVIEW] ⚠️ Single-pass niedostępny ({e}) - fallback do per_file")
+                        mode = 'per_file'
+
+            # Pojedynczy segment - strony wysyłane w miarę rasteryzacji
+            pages = []
+            for page_hashes in iter_segment_pages(segment, tiers):
+                emit_page(segment, len(pages), page_hashes, pages_metadata, tier)
+                pages.append(page_hashes)
+            rendered[segment['fingerprint']] = pages
+            pos += 1
+
+    elapsed = time.time() - start_time
+    record_preview_timing(mode, elapsed)
+    timings = preview_timing_summary()
+    print(f"[PREVIEW] ⏱️ {mode}: {elapsed:.2f}s | średnio: " +
+          ", ".join(f"{m}={t['avg']}s" for m, t in timings.items() if t['count']))
 
     send_progress("✅ Gotowe!", 100)
 
-    import time
-    time.sleep(0.3)
-    send_progress("", 0)
-
-    # Usuń obrazy z metadanych (są już wysłane przez WebSocket)
+    # Usuń URL obrazów z metadanych (są już wysłane przez WebSocket)
     metadata_without_images = []
     for meta in pages_metadata:
-        meta_copy = {k: v for k, v in meta.items() if k != 'image'}
+        meta_copy = {k: v for k, v in meta.items() if k not in ('image', 'thumbnail')}
         meta_copy['has_image'] = meta.get('status') == 'ready'
         metadata_without_images.append(meta_copy)
 
-    return jsonify({
+    result = {
         'success': True,
         'total_pages': len(pages_metadata),
-        'pages_metadata': metadata_without_images
-    })
+        'pages_metadata': metadata_without_images,
+        'mode': mode,
+        'tier': tier,
+        'cached_segments': cached_count,
+        'rendered_segments': len(segments) - cached_count,
+        'render_time': f"{elapsed:.2f}s",
+        'timings': timings,
+        'template_cache': template_cache.stats(),
+        'file_hashes': file_fingerprints.stats()
+    }
+    offer_cache.put(cache_key, cache_deps, result)
+    return result
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_offers():
+    """
+    Partia ofert w tle - zwraca job_id (wynik: manifest + download_url)
+    Body: JSON {offers: [...], pdf, templateId} lub surowy strumień JSONL / CSV
+    """
+    content_type = request.mimetype or ''
+    if content_type in ('text/csv', 'application/x-ndjson', 'application/jsonl'):
+        fmt = 'csv' if content_type == 'text/csv' else 'jsonl'
+        data = {
+            'offers': list(iter_batch_payloads(request.get_data(as_text=True), fmt)),
+            'pdf': request.args.get('pdf') in ('1', 'true'),
+            'templateId': request.args.get('templateId', 'wolftax'),
+        }
+    else:
+        data = request.json or {}
+
+    if not data.get('offers'):
+        return jsonify({'success': False, 'error': 'Brak ofert w partii'}), 400
+
+    return submit_job('batch', data, run_batch_job)
+
+
+@app.route('/api/batch/<batch_id>/download')
+def download_batch(batch_id):
+    """Pobierz archiwum ZIP partii (oferty + manifest.json)"""
+    zip_path = os.path.join(BATCH_DIR, f'{batch_id}.zip')
+    if not BATCH_ID_RE.fullmatch(batch_id) or not os.path.exists(zip_path):
+        return jsonify({'error': 'Partia nie istnieje'}), 404
+
+    return send_file(zip_path, as_attachment=True, download_name=f'oferty_{batch_id}.zip')
+
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    if request.headers.get(DEBUG_TRACE_HEADER):
+        metrics.start_trace()
+
+
+@app.after_request
+def finish_request_timing(response):
+    """Czas żądania do metryk; z nagłówkiem X-Debug-Trace - etapy w Server-Timing"""
+    trace = metrics.stop_trace()
+    start = g.pop('request_start', None)
+    if start is not None:
+        metrics.observe('http_request_seconds', time.perf_counter() - start,
+                        endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    if trace and 'Server-Timing' not in response.headers:
+        response.headers['Server-Timing'] = Metrics.server_timing(trace)
+    return response
+
+
+def converter_utilisation():
+    workers = converter_pool.status()
+    return [({'state': 'busy'}, sum(w['active'] for w in workers)),
+            ({'state': 'healthy'}, sum(1 for w in workers if w['healthy'])),
+            ({'state': 'total'}, len(workers))]
+
+
+def job_counts():
+    counts = job_manager.status()['jobs']
+    return [({'status': status}, counts.get(status, 0))
+            for status in ('queued', 'running', 'done', 'failed', 'cancelled')]
+
+
+metrics.gauge('job_queue_depth', 'Zadania czekające w kolejce', job_manager.queue_depth)
+metrics.gauge('jobs', 'Zadania wg stanu (zakończone - do wygaśnięcia wyniku)', job_counts)
+metrics.gauge('converter_workers', 'Workery unoserver: zajęte / sprawne / wszystkie', converter_utilisation)
+metrics.gauge('render_cache_entries', 'Wpisy w cache renderów', lambda: render_cache._totals()[0])
+metrics.gauge('render_cache_bytes', 'Rozmiar blobów cache renderów', lambda: render_cache._totals()[1])
+metrics.gauge('template_cache_lookups_total', 'Odczyty cache sparsowanych szablonów', lambda: [
+    ({'result': 'hit'}, template_cache.stats()['hits']), ({'result': 'miss'}, template_cache.stats()['misses'])],
+    kind='counter')
+metrics.gauge('file_hash_lookups_total', 'Odczyty memo hashy plików', lambda: [
+    ({'result': 'hit'}, file_fingerprints.stats()['hits']), ({'result': 'miss'}, file_fingerprints.stats()['misses'])],
+    kind='counter')
+metrics.gauge('offer_cache_entries', 'Gotowe oferty w cache', lambda: len(offer_cache))
+metrics.gauge('generated_offers_bytes', 'Rozmiar plików w generated_offers/', generated_retention.usage)
+metrics.gauge('page_loader_queue_depth', 'Strony czekające na render na żądanie', page_loader.queue_depth)
+metrics.gauge('socket_clients', 'Połączeni klienci WebSocket', lambda: len(client_channels))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metryki procesu w formacie Prometheus"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/ready')
+def ready():
+    """Gotowość instancji (rozgrzany cache) - 200 gdy gotowa, 503 w trakcie rozgrzewania"""
+    status = warmup.status()
+    status['converter_pool'] = converter_pool.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Stan zadania (wynik gdy status == 'done')"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Zadanie nie istnieje'}), 404
+    info = job.to_dict()
+    if not request.headers.get(DEBUG_TRACE_HEADER):
+        return jsonify({'success': True, **info})
+
+    # Ślad etapów zadania (praca działa w wątku kolejki, nie w tym żądaniu)
+    trace = list(job.trace)
+    response = jsonify({'success': True, **info, 'trace': trace})
+    response.headers['Server-Timing'] = Metrics.server_timing(trace)
+    return response
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Anuluj zadanie"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Zadanie nie istnieje'}), 404
+    return jsonify({'success': True, **job.to_dict()})
+
+
+@app.route('/api/jobs')
+def list_jobs():
+    """Stan kolejki zadań"""
+    return jsonify({'success': True, **job_manager.status()})
 
 
 # WebSocket
 @socketio.on('connect')
 def handle_connect():
     print(f'[WebSocket] ✅ Połączony: {request.sid}')
+    with client_channels_lock:
+        client_channels[request.sid] = ClientChannel(request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print(f'[WebSocket] ❌ Rozłączony: {request.sid}')
+    with client_channels_lock:
+        channel = client_channels.pop(request.sid, None)
+    if channel is not None:
+        channel.close()
+
+
+@socketio.on('subscribe_job')
+def handle_subscribe_job(data):
+    """Dołącz do zdarzeń trwającego zadania (np. druga karta / ponowne połączenie)"""
+    job = job_manager.get((data or {}).get('job_id', ''))
+    if job is None or not job.active:
+        return {'success': False}
+    job.clients.add(request.sid)
+    return {'success': True, 'status': job.status}
 
 
 # ============================================================
 # STARTUP
 # ============================================================
 
-print("\n" + "="*80)
-print("🚀 ZOPTYMALIZOWANY GENERATOR OFERT")
-print("="*80)
-print(f"Unoserver: {'✓ TAK' if check_unoserver_running() else '✗ NIE'}")
-print(f"LibreOffice: {find_libreoffice() or 'NIE ZNALEZIONO'}")
-print(f"PyMuPDF: {'✓ TAK' if HAS_PYMUPDF else '✗ NIE (używam pdf2image)'}")
-print("="*80)
+def startup():
+    """Start puli konwerterów i pre-renderingu (tylko proces główny)"""
+    print("\n" + "="*80)
+    print("🚀 ZOPTYMALIZOWANY GENERATOR OFERT")
+    print("="*80)
+    print(f"Unoserver: {'✓ TAK' if converter_pool.available else '✗ NIE'} ({CONVERTER_WORKERS} workerów)")
+    print(f"LibreOffice: {find_libreoffice() or 'NIE ZNALEZIONO'}")
+    print(f"PyMuPDF: {'✓ TAK' if HAS_PYMUPDF else '✗ NIE (używam pdf2image)'}")
+    print(f"Watchdog: {'✓ TAK' if HAS_WATCHDOG else '✗ NIE (odpytywanie co ' + str(WATCH_INTERVAL) + 's)'}")
+    print(f"Rasteryzacja: {RASTER_WORKERS} procesów")
+    print("="*80)
+
+    # Uruchom pulę workerów unoserver
+    converter_pool.start()
+
+    # Rozgrzej pulę rasteryzacji (spawn procesów trwa kilka sekund)
+    pool = get_raster_pool()
+    if pool is not None:
+        pool.submit(int)
+
+    # Rozgrzewanie cache w tle (jedno na grupę procesów)
+    warmup.start()
+
+    # Zmienione pliki przerenderowane w tle, klienci dostają 'templates_changed'
+    template_watcher.start()
+
+    # Stare wygenerowane oferty z poprzednich uruchomień
+    generated_retention.prune()
+
+
+# Tryb wsadowy z linii poleceń - bez serwera i pre-renderingu
+BATCH_CLI = __name__ == '__main__' and sys.argv[1:2] == ['batch']
+
+# Tryb debug uruchamia reloader: proces nadzorujący tylko restartuje serwer - bez startu pul
+SERVER_DEBUG = True
+RELOADER_MONITOR = __name__ == '__main__' and SERVER_DEBUG and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
 
-# Uruchom unoserver jeśli nie działa
-if not check_unoserver_running():
-    start_unoserver()
+# Import z narzędzi (np. benchmark.py) bez startu w tle: OFERTA_AUTOSTART=0
+AUTOSTART = os.environ.get('OFERTA_AUTOSTART', '1') != '0'
 
-# Uruchom pre-rendering w tle
-preload_async()
+# Procesy pul (rasteryzacja, partie) importują ten moduł ponownie - nie startuj w nich niczego
+if multiprocessing.parent_process() is None and not BATCH_CLI and not RELOADER_MONITOR and AUTOSTART:
+    startup()
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=40207, allow_unsafe_werkzeug=True)
+    if BATCH_CLI:
+        sys.exit(batch_cli(sys.argv[2:]))
+    socketio.run(app, debug=SERVER_DEBUG, host='0.0.0.0', port=40207, allow_unsafe_werkzeug=True)
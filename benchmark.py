@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Benchmark potoku renderowania i generowania ofert
+
+Przypadki (fixtures: produkty/*.docx + templates/wolftax-oferta):
+- convert_docx       - convert_docx_to_images dla każdego produktu
+- replace_placeholders - podstawianie wartości w plikach szablonu
+- merge_documents    - sklejenie paczek DOCX szablonu i produktów (merge_docx_packages)
+- generate_small / generate_large   - generate_offer_docx (3 produkty / syntetyczna oferta 50+ produktów)
+- preview_small / preview_large     - pełny przepływ POST /api/preview-full-offer → zadanie → wynik
+
+Każdy przypadek mierzony "na zimno" (świeży cache na dysku i w pamięci) i "na ciepło" (powtórzenia
+z wypełnionym cache) - percentyle czasów, szczytowe RSS i sumy czasów etapów z metryk aplikacji.
+Wynik w JSON - porównanie z zapisanym baseline:
+
+    python benchmark.py --output wynik.json
+    python benchmark.py --baseline wynik.json --threshold 0.15
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, 'benchmark_results')
+
+# Benchmark nigdy nie dotyka produkcyjnego cache ani wygenerowanych ofert
+WORK_DIR = tempfile.mkdtemp(prefix='oferta_bench_')
+os.environ['RENDER_CACHE_DIR'] = os.path.join(WORK_DIR, 'cache_import')
+os.environ['OFERTA_AUTOSTART'] = '0'  # bez rozgrzewania cache i obserwatora plików - start puli ręcznie
+
+sys.path.insert(0, BASE_DIR)
+import app  # noqa: E402
+
+PERCENTILES = (50, 90, 95, 99)
+TEMPLATE_ID = 'wolftax'
+FORM_DATA = {
+    'NazwaFirmyKlienta': 'Benchmark Sp. z o.o.',
+    'Temat': 'Oferta testowa',
+    'DataOferty': '2024-01-01',
+}
+
+
+# ============================================================
+# POMIARY
+# ============================================================
+
+def percentile(values, pct):
+    """Percentyl z interpolacją liniową (jak numpy.percentile)"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    pos = (len(ordered) - 1) * pct / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def summarize(samples):
+    """Statystyki czasów (ms)"""
+    if not samples:
+        return None
+    ms = [s * 1000 for s in samples]
+    summary = {'runs': len(ms), 'min': min(ms), 'max': max(ms), 'mean': sum(ms) / len(ms)}
+    for pct in PERCENTILES:
+        summary[f'p{pct}'] = percentile(ms, pct)
+    return {key: round(value, 2) if isinstance(value, float) else value for key, value in summary.items()}
+
+
+def reset_peak_rss():
+    """Wyzeruj szczytowe RSS procesu (Linux: /proc/self/clear_refs) - False gdy nieobsługiwane"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Szczytowe RSS procesu (VmHWM od ostatniego resetu, inaczej ru_maxrss całego życia procesu)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KB, macOS: bajty
+    return round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def stage_totals():
+    """Suma czasów i liczba spanów per etap z metryk aplikacji"""
+    with app.metrics.lock:
+        return {dict(labels).get('stage'): (hist[1], hist[2])
+                for (name, labels), hist in app.metrics.histograms.items() if name == 'stage_seconds'}
+
+
+def stage_delta(before, after):
+    delta = {}
+    for stage, (total, count) in after.items():
+        prev_total, prev_count = before.get(stage, (0.0, 0))
+        if count > prev_count:
+            delta[stage] = {'ms': round((total - prev_total) * 1000, 2), 'spans': count - prev_count}
+    return delta
+
+
+# ============================================================
+# ŚRODOWISKO
+# ============================================================
+
+def reset_caches(label):
+    """Świeży cache renderów (nowy katalog) i puste cache w pamięci - pomiar na zimno"""
+    cache_dir = os.path.join(WORK_DIR, f'cache_{label}_{time.time_ns()}')
+    app.render_cache = app.RenderCache(cache_dir, app.RENDER_CACHE_MAX_BYTES)
+    app.page_count_index = app.PageCountIndex(app.render_cache)
+    app.usage_stats = app.UsageStats(os.path.join(cache_dir, 'usage.json'))
+    app.template_cache = app.TemplateCache(app.TEMPLATE_CACHE_MAX_ENTRIES)
+    app.file_fingerprints = app.FileFingerprints()
+    app.placeholder_index.clear()
+
+
+def load_template():
+    template = app.find_template(TEMPLATE_ID)
+    if template is None:
+        raise SystemExit(f"Brak szablonu {TEMPLATE_ID} w templates/templates.json")
+    return template
+
+
+def product_ids():
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(app.PRODUKTY_DIR)
+                  if f.endswith('.docx') and not f.startswith('~$'))
+
+
+def large_selection(count):
+    """Syntetyczna duża oferta: produkty z fixtures powtarzane do `count` pozycji"""
+    ids = product_ids()
+    return [ids[i % len(ids)] for i in range(count)]
+
+
+def template_paths(template):
+    folder = os.path.join(app.TEMPLATES_DIR, template['folder'])
+    return [os.path.join(folder, f['file']) for f in sorted(template['files'], key=lambda x: x['order'])]
+
+
+# ============================================================
+# PRZYPADKI
+# ============================================================
+
+def case_convert_docx(ctx):
+    for product_id in product_ids():
+        app.convert_docx_to_images(os.path.join(app.PRODUKTY_DIR, f'{product_id}.docx'), tier=app.DEFAULT_TIER)
+
+
+def case_replace_placeholders(ctx):
+    data = {**FORM_DATA, 'produkty': ''}
+    for path in template_paths(ctx['template']):
+        app.replace_placeholders(app.template_cache.load(path), data)
+
+
+def case_merge_documents(ctx):
+    paths = template_paths(ctx['template'])
+    paths += [os.path.join(app.PRODUKTY_DIR, f'{product_id}.docx') for product_id in product_ids()]
+    output = os.path.join(ctx['output_dir'], f'bench_merge_{time.time_ns()}.docx')
+    app.merge_docx_packages(paths, output)
+    os.remove(output)
+
+
+def generate(ctx, selected):
+    data = {'formData': FORM_DATA, 'selectedProducts': selected, 'productCustomFields': {}}
+    app.generate_offer_docx(data, selected, ctx['template'], output_dir=ctx['output_dir'],
+                            output_filename=f'bench_{time.time_ns()}.docx')
+
+
+def preview(ctx, selected):
+    """Pełny przepływ HTTP: POST → zadanie w tle → wynik"""
+    client = app.app.test_client()
+    response = client.post('/api/preview-full-offer', json={
+        'templateData': ctx['template'],
+        'formData': FORM_DATA,
+        'selectedProducts': selected,
+        'productCustomFields': {},
+    })
+    if response.status_code != 202:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.get_json()}")
+
+    job_id = response.get_json()['job_id']
+    while True:
+        job = client.get(f'/api/jobs/{job_id}').get_json()
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.01)
+    if job['status'] != 'done':
+        raise RuntimeError(f"Zadanie {job['status']}: {job.get('error')}")
+
+
+CASES = {
+    'convert_docx': case_convert_docx,
+    'replace_placeholders': case_replace_placeholders,
+    'merge_documents': case_merge_documents,
+    'generate_small': lambda ctx: generate(ctx, product_ids()[:3]),
+    'generate_large': lambda ctx: generate(ctx, ctx['large']),
+    'preview_small': lambda ctx: preview(ctx, product_ids()[:3]),
+    'preview_large': lambda ctx: preview(ctx, ctx['large']),
+}
+
+
+def run_case(name, fn, ctx, cold_runs, warm_runs):
+    """Pomiar jednego przypadku: cold_runs × (świeży cache + 1 wywołanie), potem warm_runs na ciepło"""
+    print(f"\n[BENCH] ▶ {name}")
+    rss_reset = reset_peak_rss()
+    stages_before = stage_totals()
+    cold, warm = [], []
+
+    try:
+        for _ in range(cold_runs):
+            reset_caches(name)
+            start = time.perf_counter()
+            fn(ctx)
+            cold.append(time.perf_counter() - start)
+
+        if not cold:
+            reset_caches(name)
+            fn(ctx)  # rozgrzanie bez pomiaru
+
+        for _ in range(warm_runs):
+            start = time.perf_counter()
+            fn(ctx)
+            warm.append(time.perf_counter() - start)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"[BENCH] ✗ {name}: {error}")
+
+    result = {
+        'cold': summarize(cold),
+        'warm': summarize(warm),
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_scope': 'case' if rss_reset else 'process',
+        'stages': stage_delta(stages_before, stage_totals()),
+    }
+    if error:
+        result['error'] = error
+
+    for phase in ('cold', 'warm'):
+        if result[phase]:
+            print(f"[BENCH]   {phase:4}: p50 {result[phase]['p50']:.1f} ms, p95 {result[phase]['p95']:.1f} ms "
+                  f"({result[phase]['runs']} przebiegów)")
+    print(f"[BENCH]   peak RSS: {result['peak_rss_mb']} MB")
+    return result
+
+
+# ============================================================
+# BASELINE
+# ============================================================
+
+def compare(results, baseline, threshold):
+    """Porównaj p50 / p95 z baseline - zwraca listę regresji powyżej progu"""
+    regressions = []
+    print(f"\n[BENCH] Porównanie z baseline ({baseline['meta'].get('timestamp')}, próg {threshold:.0%})")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        for phase in ('cold', 'warm'):
+            for stat in ('p50', 'p95'):
+                now = (result.get(phase) or {}).get(stat)
+                before = (base.get(phase) or {}).get(stat)
+                if not now or not before:
+                    continue
+                change = (now - before) / before
+                flag = '❌' if change > threshold else ('✅' if change < -threshold else '  ')
+                print(f"[BENCH] {flag} {name:22} {phase:4} {stat}: {before:9.1f} → {now:9.1f} ms ({change:+.1%})")
+                if change > threshold:
+                    regressions.append({'case': name, 'phase': phase, 'stat': stat,
+                                        'baseline_ms': before, 'ms': now, 'change': round(change, 4)})
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark renderowania i generowania ofert')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=list(CASES), help='Przypadki do uruchomienia')
+    parser.add_argument('--cold', type=int, default=3, help='Przebiegi na zimno (świeży cache)')
+    parser.add_argument('--warm', type=int, default=10, help='Przebiegi na ciepło')
+    parser.add_argument('--products', type=int, default=60, help='Liczba produktów w dużej ofercie')
+    parser.add_argument('--output', help='Plik wynikowy JSON (domyślnie benchmark_results/bench_<czas>.json)')
+    parser.add_argument('--baseline', help='JSON poprzedniego przebiegu do porównania')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Próg regresji (ułamek, domyślnie 0.10)')
+    args = parser.parse_args(argv)
+
+    print("=" * 80)
+    print(f"[BENCH] Przypadki: {', '.join(args.cases)} | zimno: {args.cold} | ciepło: {args.warm} | "
+          f"duża oferta: {args.products} produktów")
+    print("=" * 80)
+
+    # Pule jak w serwerze (bez rozgrzewania cache - ono zafałszowałoby pomiar na zimno)
+    app.converter_pool.start()
+    pool = app.get_raster_pool()
+    if pool is not None:
+        pool.submit(int).result()
+
+    ctx = {
+        'template': load_template(),
+        'large': large_selection(args.products),
+        'output_dir': os.path.join(WORK_DIR, 'offers'),
+    }
+    os.makedirs(ctx['output_dir'], exist_ok=True)
+
+    results = {}
+    try:
+        for name in args.cases:
+            results[name] = run_case(name, CASES[name], ctx, args.cold, args.warm)
+    finally:
+        app.reset_raster_pool()
+        app.reset_batch_pool()
+        app.converter_pool.stop()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'converter_workers': app.CONVERTER_WORKERS,
+            'raster_workers': app.RASTER_WORKERS,
+            'renderer': app.RENDERER_VERSION,
+            'unoserver': app.converter_pool.available,
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            report['regressions'] = compare(results, json.load(f), args.threshold)
+        exit_code = 1 if report['regressions'] else 0
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n[BENCH] ✓ Wynik: {output}")
+
+    if any('error' in result for result in results.values()):
+        exit_code = exit_code or 2
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,8 @@ let previewPages = [];
 let currentPageIndex = 0;
 let previewDebounceTimer = null;
 let socket = null;
+let currentPreviewJobId = null;  // Zadanie podglądu w toku (anulowane przy nowym)
+const cancelledJobIds = new Set();  // Spóźnione strony anulowanych zadań są ignorowane
 
 // Cache dla selektywnej regeneracji
 let lastFormData = {};
@@ -185,16 +187,29 @@ function connectWebSocket() {
         updateProgressBar(data.message, data.percent);
     });
 
-    socket.on('page_ready', (pageData) => {
+    socket.on('page_ready', (pageData, ack) => {
+        // Potwierdzenie odbioru - serwer wysyła kolejne strony dopiero gdy nadążamy
+        if (ack) ack();
+
+        if (cancelledJobIds.has(pageData.job_id)) {
+            console.log('[WebSocket] Pomijam stronę anulowanego podglądu', pageData.job_id);
+            return;
+        }
+
         console.log('='.repeat(80));
         console.log('[WebSocket] 🎉 ODEBRANO EVENT: page_ready');
         console.log('[WebSocket] Strona numer:', pageData.number);
         console.log('[WebSocket] Ma obraz:', !!pageData.image);
-        console.log('[WebSocket] Rozmiar obrazu:', pageData.image ? pageData.image.length : 0, 'znaków');
+        console.log('[WebSocket] URL obrazu:', pageData.image);
         console.log('='.repeat(80));
         handlePageReady(pageData);
     });
 
+    socket.on('templates_changed', (data) => {
+        console.log('[WebSocket] Zmienione pliki na serwerze:', data);
+        handleTemplatesChanged(data);
+    });
+
     socket.on('product_status', (data) => {
         console.log('[WebSocket] Status produktu:', data);
         updateProductStatus(data.product_id, data.status);
@@ -205,6 +220,89 @@ function connectWebSocket() {
     });
 }
 
+// Pliki produktów / szablonu zmienione na serwerze (już przerenderowane) - odśwież listę i podgląd
+async function handleTemplatesChanged(data) {
+    if (!selectedTemplate) return;
+
+    const folder = selectedTemplate.folder === '.' ? 'templates' : `templates/${selectedTemplate.folder}`;
+    const templateFiles = (selectedTemplate.files || []).map(f => `${folder}/${f.file}`);
+    if (selectedTemplate.main_file) templateFiles.push(`${folder}/${selectedTemplate.main_file}`);
+
+    const touched = [...data.added, ...data.changed, ...data.removed];
+    const templateAffected = touched.some(path => templateFiles.includes(path));
+    const productsAffected = data.products.some(id => selectedProducts.includes(id));
+
+    if (data.products.length) {
+        await loadProducts();
+        // Usunięte produkty wypadają z wyboru, pozostałe zostają zaznaczone
+        selectedProducts = selectedProducts.filter(id => availableProducts.some(p => p.id === id));
+        selectedProducts.forEach(id => {
+            const card = document.querySelector(`.product-card[data-product-id="${id}"]`);
+            if (card) {
+                card.classList.add('selected');
+                card.querySelector('input[type="checkbox"]').checked = true;
+            }
+        });
+    }
+
+    if (templateAffected || productsAffected) {
+        showNotification('Pliki oferty zmieniły się na serwerze - odświeżam podgląd', 'info');
+        markPreviewOutdated();
+    }
+}
+
+// Czekaj na zakończenie zadania w tle (praca na serwerze nie blokuje requestu)
+async function waitForJob(jobId, interval = 500) {
+    while (true) {
+        const response = await fetch(`/api/jobs/${jobId}`);
+        const job = await response.json();
+
+        if (!job.success || !['queued', 'running'].includes(job.status)) {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
+
+// Zleć zadanie (POST) i poczekaj na wynik
+async function runJob(url, data, onStarted = null) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        // clientId = adresat zdarzeń postępu i stron (tylko ta karta)
+        body: JSON.stringify({...data, clientId: socket?.id})
+    });
+
+    const started = await response.json();
+    if (!started.success) {
+        return started;
+    }
+    if (started.status === 'done') {
+        // Identyczna oferta policzona wcześniej - wynik od razu, bez zadania
+        return started.result;
+    }
+    if (onStarted) onStarted(started.job_id);
+
+    const job = await waitForJob(started.job_id);
+    updateProgressBar('', 0);
+
+    if (job.status === 'done') {
+        return job.result;
+    }
+    return {success: false, status: job.status, error: job.error || 'Zadanie anulowane'};
+}
+
+// Anuluj zadanie podglądu w toku (nowe zmiany = stary podgląd niepotrzebny)
+function cancelPreviewJob() {
+    if (currentPreviewJobId) {
+        cancelledJobIds.add(currentPreviewJobId);
+        fetch(`/api/jobs/${currentPreviewJobId}`, {method: 'DELETE'}).catch(() => {});
+        currentPreviewJobId = null;
+    }
+}
+
 // Aktualizuj pasek postępu
 function updateProgressBar(message, percent) {
     const progressContainer = document.getElementById('progress-container');
@@ -236,6 +334,7 @@ function handlePageReady(pageData) {
         console.log('[WebSocket] Aktualizuję istniejącą stronę');
         // Aktualizuj istniejącą stronę
         existingPage.image = pageData.image;
+        existingPage.thumbnail = pageData.thumbnail;
         existingPage.status = 'ready';
         existingPage.has_image = true;
     } else {
@@ -640,6 +739,8 @@ async function updatePreview(force = false) {
         selectedProducts: selectedProducts,
         productCustomFields: productCustomFields,
         streaming: true,
+        // Serwer renderuje tylko pierwsze strony, resztę dociąga showPage() przez /api/load-page
+        previewMode: 'lazy',
         changes: {
             templateChanged: changes.templateChanged,
             productsChanged: changes.productsChanged,
@@ -649,6 +750,7 @@ async function updatePreview(force = false) {
     };
 
     console.log('[DEBUG] Wysyłam request do /api/preview-full-offer (STREAMING)');
+    cancelPreviewJob();
 
     // Wyczyść poprzednie strony
     previewPages = [];
@@ -669,37 +771,43 @@ async function updatePreview(force = false) {
     document.getElementById('pages-tabs').innerHTML = '<div class="hint">Ładowanie stron...</div>';
 
     try {
-        const response = await fetch('/api/preview-full-offer', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(data)
+        let jobId = null;
+        const result = await runJob('/api/preview-full-offer', data, id => {
+            jobId = id;
+            currentPreviewJobId = id;
         });
-
-        const result = await response.json();
         console.log('[DEBUG] Streaming response:', result);
 
+        if (result.status === 'cancelled' || (jobId && jobId !== currentPreviewJobId)) {
+            // Zastąpione nowszym podglądem
+            return;
+        }
+        currentPreviewJobId = null;
+
         if (result.success) {
-            // Metadane otrzymane - strony będą przychodzić przez WebSocket
-            console.log(`[DEBUG] Oczekuję na ${result.total_pages} stron przez WebSocket`);
+            // Zadanie zakończone - strony przyszły już przez WebSocket
+            console.log(`[DEBUG] Podgląd gotowy: ${result.total_pages} stron`);
 
             // Inicjalizuj WSZYSTKIE strony z metadanych
             if (result.pages_metadata) {
-                previewPages = result.pages_metadata.map(meta => ({
-                    ...meta,
-                    // WAŻNE: Metadane nie mają obrazów! Obrazy przyjdą przez WebSocket
-                    has_image: false,
-                    image: null,
-                    status: 'pending'  // Ustaw jako pending - zaktualizuje się jak przyjdzie WebSocket
-                }));
+                previewPages = result.pages_metadata.map(meta => {
+                    // Strony już odebrane przez WebSocket zachowują obraz
+                    const received = previewPages.find(p => p.number === meta.number && p.image);
+                    // Pozostałe (pominięte dla wolnego klienta) - dociągnie je lazy loading
+                    return received ? {...meta, ...received} : {
+                        ...meta,
+                        image: null
+                    };
+                });
 
-                console.log('[DEBUG] Zainicjowano', previewPages.length, 'stron (czekam na WebSocket)');
+                console.log('[DEBUG] Zainicjowano', previewPages.length, 'stron');
 
-                // Renderuj zakładki (będą wyszarzone - pending)
+                // Renderuj zakładki
                 renderPagesTabs();
 
-                // NIE POKAZUJ jeszcze - poczekaj na WebSocket!
+                if (previewPages.length > 0 && !previewPages[currentPageIndex]?.image) {
+                    showPage(currentPageIndex);
+                }
             }
 
             // Zaktualizuj cache dla kolejnych porównań
@@ -710,6 +818,8 @@ async function updatePreview(force = false) {
             // Ukryj warning i oznacz że to już nie initial load
             hideOutdatedWarning();
             isInitialLoad = false;
+        } else {
+            throw new Error(result.error);
         }
     } catch (error) {
         console.error('[ERROR] Błąd aktualizacji podglądu:', error);
@@ -805,7 +915,10 @@ async function showPage(index) {
                     type: page.type,
                     page_index: page.page_index,
                     product_id: page.product_id,
-                    formData: formData
+                    fingerprint: page.fingerprint,
+                    formData: formData,
+                    // Sąsiednie strony serwer renderuje w tle, za stroną z widoku
+                    prefetch: adjacentPages(index).map(p => ({fingerprint: p.fingerprint, page_index: p.page_index}))
                 })
             });
 
@@ -823,7 +936,8 @@ async function showPage(index) {
     // Wyświetl obraz zamiast HTML
     if (page.image) {
         console.log('[DEBUG] Pokazuję obraz strony', page.number);
-        previewPage.innerHTML = `<img src="${page.image}" alt="Strona ${page.number}" style="width: 100%; height: auto; display: block; margin: 0 auto;">`;
+        previewPage.innerHTML = `<img src="${page.image}" alt="Strona ${page.number}" title="Kliknij, aby otworzyć w pełnej jakości" style="width: 100%; height: auto; display: block; margin: 0 auto; cursor: zoom-in;">`;
+        previewPage.querySelector('img').addEventListener('click', () => zoomPage(page));
     } else if (page.status === 'pending' || page.status === 'generating') {
         // Strona jeszcze się generuje - pokaż spinner
         console.log('[DEBUG] Strona', page.number, 'jeszcze się generuje');
@@ -861,41 +975,77 @@ async function showPage(index) {
     prefetchAdjacentPages(index);
 }
 
-// Pre-ładuj sąsiednie strony dla płynnej nawigacji
-async function prefetchAdjacentPages(currentIndex) {
-    const toPreload = [currentIndex - 1, currentIndex + 1];
+// Zoom: pełna jakość renderowana dopiero na żądanie (z PDF w cache serwera)
+async function zoomPage(page) {
+    if (!page.full_image) {
+        try {
+            const response = await fetch('/api/load-page', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    type: page.type,
+                    page_index: page.page_index,
+                    product_id: page.product_id,
+                    fingerprint: page.fingerprint,
+                    tier: 'full'
+                })
+            });
 
-    for (const idx of toPreload) {
-        if (idx >= 0 && idx < previewPages.length) {
-            const page = previewPages[idx];
+            const result = await response.json();
 
-            if (page.has_image && !page.image) {
-                console.log('[DEBUG] Prefetch strony', idx);
-
-                try {
-                    const response = await fetch('/api/load-page', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            type: page.type,
-                            page_index: page.page_index,
-                            product_id: page.product_id,
-                            formData: formData
-                        })
-                    });
-
-                    const result = await response.json();
-
-                    if (result.success && result.image) {
-                        page.image = result.image;
-                        console.log('[DEBUG] Prefetch OK dla strony', idx);
-                    }
-                } catch (error) {
-                    console.error('[ERROR] Błąd prefetch:', error);
-                }
+            if (result.success && result.image) {
+                page.full_image = result.image;
             }
+        } catch (error) {
+            console.error('[ERROR] Błąd ładowania pełnej jakości:', error);
         }
     }
+
+    window.open(page.full_image || page.image, '_blank');
+}
+
+// Sąsiednie strony bez obrazu (najbliższe najpierw)
+function adjacentPages(currentIndex, distance = 2) {
+    const pages = [];
+    for (let offset = 1; offset <= distance; offset++) {
+        for (const idx of [currentIndex + offset, currentIndex - offset]) {
+            const page = previewPages[idx];
+            if (page && page.has_image && !page.image && page.fingerprint) {
+                pages.push(page);
+            }
+        }
+    }
+    return pages;
+}
+
+// Pre-ładuj sąsiednie strony dla płynnej nawigacji (niski priorytet - strona z widoku pierwsza)
+async function prefetchAdjacentPages(currentIndex) {
+    await Promise.all(adjacentPages(currentIndex, 1).map(async page => {
+        console.log('[DEBUG] Prefetch strony', page.number);
+
+        try {
+            const response = await fetch('/api/load-page', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    type: page.type,
+                    page_index: page.page_index,
+                    product_id: page.product_id,
+                    fingerprint: page.fingerprint,
+                    priority: 'prefetch'
+                })
+            });
+
+            const result = await response.json();
+
+            if (result.success && result.image) {
+                page.image = result.image;
+                console.log('[DEBUG] Prefetch OK dla strony', page.number);
+            }
+        } catch (error) {
+            console.error('[ERROR] Błąd prefetch:', error);
+        }
+    }));
 }
 
 // Aktualizuj licznik stron
@@ -940,6 +1090,11 @@ function setupEventListeners() {
         await generateOffer();
     });
 
+    // Generuj PDF (z PDF-ów segmentów w cache podglądu)
+    document.getElementById('btn-generate-pdf').addEventListener('click', async () => {
+        await generateOffer('pdf');
+    });
+
     // Modal save
     const saveModal = document.getElementById('save-modal');
     const saveClose = saveModal.querySelector('.close');
@@ -1109,7 +1264,7 @@ async function loadOffer(filename) {
 }
 
 // Generuj ofertę
-async function generateOffer() {
+async function generateOffer(format = 'docx') {
     formData = collectFormData();
 
     const form = document.getElementById('offer-form');
@@ -1130,26 +1285,22 @@ async function generateOffer() {
         templateData: selectedTemplate,
         formData: formData,
         selectedProducts: selectedProducts,
-        productCustomFields: productCustomFields
+        productCustomFields: productCustomFields,
+        format: format
     };
 
     try {
         // Progress bar obsługiwany przez WebSocket automatycznie!
-        console.log('[DEBUG] Generowanie dokumentu DOCX...');
-
-        const response = await fetch('/api/generate-offer', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(data)
-        });
+        console.log(`[DEBUG] Generowanie dokumentu ${format.toUpperCase()}...`);
 
-        const result = await response.json();
+        const result = await runJob('/api/generate-offer', data);
 
         if (result.success) {
-            const time = result.generation_time || '?';
-            showNotification(`✅ Dokument wygenerowany w ${time}!`, 'success');
+            if (result.cached) {
+                showNotification('✅ Dokument gotowy (z cache)!', 'success');
+            } else {
+                showNotification(`✅ Dokument wygenerowany w ${result.generation_time || '?'}!`, 'success');
+            }
 
             // Poczekaj chwilę aby użytkownik zobaczył notyfikację
             setTimeout(() => {
@@ -1359,9 +1510,9 @@ function createKanbanCard(page, index) {
     const thumbnail = document.createElement('div');
     thumbnail.className = 'kanban-card-thumbnail';
 
-    if (page.image) {
+    if (page.thumbnail || page.image) {
         const img = document.createElement('img');
-        img.src = page.image;
+        img.src = page.thumbnail || page.image;
         thumbnail.appendChild(img);
     } else {
         thumbnail.innerHTML = '<div class="placeholder">Ładowanie...</div>';
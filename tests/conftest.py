@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Import app bez startu pul / rozgrzewania i z osobnym cache renderów
+os.environ.setdefault('OFERTA_AUTOSTART', '0')
+os.environ.setdefault('RENDER_CACHE_DIR', tempfile.mkdtemp(prefix='oferta_test_cache_'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def make_docx(tmp_path):
+    """make_docx(nazwa, akapity, image=None) -> ścieżka do prostego DOCX z nagłówkiem (i obrazem)"""
+    from docx import Document
+
+    def make(name, paragraphs, image=None):
+        doc = Document()
+        for text in paragraphs:
+            doc.add_paragraph(text)
+        if image is not None:
+            doc.add_picture(str(image))
+        doc.sections[0].header.paragraphs[0].text = f'Nagłówek {name}'
+        path = tmp_path / name
+        doc.save(path)
+        return str(path)
+
+    return make
+
+
+@pytest.fixture
+def png(tmp_path):
+    from PIL import Image
+
+    path = tmp_path / 'logo.png'
+    Image.new('RGB', (8, 8), (200, 20, 20)).save(path)
+    return path
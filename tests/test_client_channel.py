@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import app
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timeout'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    """Zdarzenia wysłane przez socketio.emit - potwierdzenie (callback) wywołuje test"""
+    sent = []
+    monkeypatch.setattr(app.socketio, 'emit', lambda event, data, to=None, callback=None: sent.append(
+        {'event': event, 'data': data, 'to': to, 'ack': callback}))
+    monkeypatch.setattr(app, 'SOCKET_MAX_IN_FLIGHT', 2)
+    monkeypatch.setattr(app, 'SOCKET_ACK_TIMEOUT', 0.2)
+    return sent
+
+
+def test_in_flight_cap_drops_until_ack(emitted):
+    channel = app.ClientChannel('sid')
+    assert channel.send('page_ready', {'n': 1}, wait=False)
+    assert channel.send('page_ready', {'n': 2}, wait=False)
+    assert not channel.send('page_ready', {'n': 3}, wait=False)
+    assert channel.dropped == 1
+    assert [e['data']['n'] for e in emitted] == [1, 2]
+    assert {e['to'] for e in emitted} == {'sid'}
+
+    emitted[0]['ack']()
+    assert channel.send('page_ready', {'n': 4}, wait=False)
+    assert len(channel.in_flight) == 2
+
+
+def test_unacked_events_expire_after_ack_timeout(emitted):
+    channel = app.ClientChannel('sid')
+    channel.send('page_ready', {'n': 1})
+    channel.send('page_ready', {'n': 2})
+
+    # Pełny kanał: wysyłka czeka, aż brak potwierdzeń przekroczy SOCKET_ACK_TIMEOUT
+    start = time.time()
+    assert channel.send('page_ready', {'n': 3})
+    assert time.time() - start >= 0.15
+    assert len(channel.in_flight) == 1
+
+
+def test_closed_channel_drops_events(emitted):
+    channel = app.ClientChannel('sid')
+    channel.close()
+    assert not channel.send('page_ready', {'n': 1})
+    assert emitted == []
+
+
+def test_cancel_stops_job_at_send_progress(emitted, monkeypatch):
+    manager = app.JobManager(workers=1, max_queue=4, result_ttl=60)
+    monkeypatch.setattr(app, 'job_manager', manager)
+    monkeypatch.setitem(app.client_channels, 'sid', app.ClientChannel('sid'))
+    reached = []
+
+    def job(payload):
+        for percent in range(10 ** 6):
+            app.send_progress('⚙️', percent)
+            reached.append(percent)
+            emitted[-1]['ack']()
+            time.sleep(0.01)
+
+    running, _ = manager.submit('preview', {}, job, client='sid')
+    wait_for(lambda: len(reached) >= 3)
+
+    manager.cancel(running.id)
+    wait_for(lambda: not running.active)
+    sent = len(emitted)
+    time.sleep(0.05)
+
+    assert running.status == 'cancelled'
+    assert len(emitted) == sent
+    assert all(e['event'] == 'conversion_progress' and e['to'] == 'sid' for e in emitted)
+    manager.executor.shutdown(wait=True, cancel_futures=True)
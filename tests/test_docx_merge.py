@@ -0,0 +1,75 @@
+import zipfile
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.shared import Pt
+from lxml import etree
+
+import app
+
+
+def read_xml(z, name):
+    return etree.fromstring(z.read(name))
+
+
+def test_merge_keeps_relationships_and_drawing_ids_unique(tmp_path, make_docx, png):
+    sources = [
+        make_docx('a.docx', ['Pierwszy'], image=png),
+        make_docx('b.docx', ['Drugi'], image=png),
+        make_docx('c.docx', ['Trzeci'], image=png),
+    ]
+    output = str(tmp_path / 'out.docx')
+    app.merge_docx_packages(sources, output, segment_markers=True)
+
+    with zipfile.ZipFile(output) as z:
+        assert z.testzip() is None
+        document = read_xml(z, 'word/document.xml')
+        rels = read_xml(z, 'word/_rels/document.xml.rels')
+        rel_ids = [rel.get('Id') for rel in rels]
+        media = [name for name in z.namelist() if name.startswith('word/media/')]
+
+    assert len(rel_ids) == len(set(rel_ids))
+    used = {str(attr) for attr in app.R_ATTRIBUTES(document)}
+    assert used <= set(rel_ids)
+
+    doc_pr_ids = [el.get('id') for el in document.iter(app.WP_DOCPR)]
+    assert len(doc_pr_ids) == 3
+    assert len(set(doc_pr_ids)) == 3
+
+    # Ten sam obraz w trzech dokumentach zapisany raz
+    assert len(media) == 1
+
+    text = ''.join(t.text or '' for t in document.iter(app.W_T))
+    assert 'Pierwszy' in text and 'Drugi' in text and 'Trzeci' in text
+    assert app.SEGMENT_MARKER_RE.findall(text) == ['0001', '0002']
+
+
+def test_merge_renames_conflicting_styles(tmp_path):
+    paths = []
+    for name, size in (('a.docx', 10), ('b.docx', 20)):
+        doc = Document()
+        style = doc.styles.add_style('Oferta', WD_STYLE_TYPE.PARAGRAPH)
+        style.font.size = Pt(size)
+        doc.add_paragraph(name, style='Oferta')
+        path = tmp_path / name
+        doc.save(path)
+        paths.append(str(path))
+
+    output = str(tmp_path / 'out.docx')
+    app.merge_docx_packages(paths, output)
+
+    with zipfile.ZipFile(output) as z:
+        styles = read_xml(z, 'word/styles.xml')
+        document = read_xml(z, 'word/document.xml')
+
+    style_ids = {el.get(app.W_STYLE_ID) for el in styles.iter(app.W_STYLE)}
+    used = [el.get(app.W_VAL) for el in document.iter(app.W_PSTYLE)]
+    assert len(set(used)) == 2
+    assert set(used) <= style_ids
+
+
+def test_merge_without_sources_writes_empty_document(tmp_path):
+    output = str(tmp_path / 'empty.docx')
+    app.merge_docx_packages([], output)
+    with zipfile.ZipFile(output) as z:
+        assert 'word/document.xml' in z.namelist()
@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def fingerprints(monkeypatch):
+    """FileFingerprints liczący faktyczne odczyty plików"""
+    fingerprints = app.FileFingerprints(max_entries=2)
+    fingerprints.reads = []
+    hash_file = app.FileFingerprints.hash_file
+
+    def counting(path):
+        fingerprints.reads.append(os.path.basename(path))
+        return hash_file(path)
+
+    monkeypatch.setattr(fingerprints, 'hash_file', counting)
+    return fingerprints
+
+
+def write(path, content, age=None):
+    """Zapisz plik - age (s) cofa mtime poza okno RACY_NS"""
+    with open(path, 'wb') as f:
+        f.write(content)
+    if age is not None:
+        mtime_ns = time.time_ns() - int(age * 10 ** 9)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+
+def test_unchanged_file_hashed_once(tmp_path, fingerprints):
+    path = write(tmp_path / 'a.docx', b'first', age=60)
+
+    first = fingerprints.get(path)
+    assert fingerprints.get(path) == first
+    assert fingerprints.reads == ['a.docx']
+    assert (fingerprints.hits, fingerprints.misses) == (1, 1)
+
+    # Ta sama długość, inny mtime → nowy stat, ponowny hash
+    write(path, b'other', age=30)
+    assert fingerprints.get(path) != first
+    assert fingerprints.reads == ['a.docx', 'a.docx']
+
+
+def test_recent_file_rehashed_until_outside_racy_window(tmp_path, fingerprints):
+    path = write(tmp_path / 'a.docx', b'first')
+    mtime_ns = os.stat(path).st_mtime_ns
+
+    first = fingerprints.get(path)
+    assert fingerprints.entries == {}
+
+    # Zapis w tym samym ticku mtime (ta sama długość i mtime) - memo zwróciłoby stary hash
+    write(path, b'other')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    second = fingerprints.get(path)
+    assert second != first
+    assert fingerprints.reads == ['a.docx', 'a.docx']
+
+    old_ns = time.time_ns() - 2 * app.FileFingerprints.RACY_NS
+    os.utime(path, ns=(old_ns, old_ns))
+    assert fingerprints.get(path) == second
+    assert fingerprints.get(path) == second
+    assert fingerprints.reads == ['a.docx'] * 3
+    assert list(fingerprints.entries) == [os.path.abspath(path)]
+
+
+def test_memo_bounded_and_missing_file(tmp_path, fingerprints):
+    paths = [write(tmp_path / f'{name}.docx', name.encode(), age=60) for name in 'abc']
+    for path in paths:
+        fingerprints.get(path)
+
+    assert list(fingerprints.entries) == [os.path.abspath(path) for path in paths[1:]]
+    assert fingerprints.get(tmp_path / 'missing.docx') is None
+
+    fingerprints.invalidate(paths[2])
+    fingerprints.get(paths[2])
+    assert fingerprints.reads == ['a.docx', 'b.docx', 'c.docx', 'c.docx']
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timeout'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """Jeden worker, w kolejce najwyżej jedno zadanie - podstawiony jako app.job_manager"""
+    manager = app.JobManager(workers=1, max_queue=1, result_ttl=60)
+    monkeypatch.setattr(app, 'job_manager', manager)
+    yield manager
+    for job in list(manager.jobs.values()):
+        manager.cancel(job.id)
+    manager.executor.shutdown(wait=True, cancel_futures=True)
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def blocking(release):
+    def fn(payload):
+        release.wait(5)
+        return {'payload': payload}
+    return fn
+
+
+def cooperative(payload):
+    """Zadanie, które regularnie sprawdza anulowanie (jak send_progress)"""
+    while True:
+        app.job_manager.current().check_cancelled()
+        time.sleep(0.01)
+
+
+def test_same_payload_in_flight_is_deduplicated(manager, release):
+    fn = blocking(release)
+    job, created = manager.submit('preview', {'a': 1}, fn, client='sid-1')
+    wait_for(lambda: job.status == 'running')
+    same, created_again = manager.submit('preview', {'a': 1}, fn, client='sid-2')
+    other, _ = manager.submit('preview', {'a': 2}, fn)
+
+    assert created and not created_again
+    assert same is job and other is not job
+    assert job.clients == {'sid-1', 'sid-2'}
+
+    release.set()
+    wait_for(lambda: job.status == 'done' and other.status == 'done')
+    # Zakończone zadanie nie jest już deduplikowane
+    assert manager.submit('preview', {'a': 1}, fn)[1]
+
+
+def test_queue_limit_rejects_with_503(manager, release):
+    fn = blocking(release)
+    running, _ = manager.submit('generate', {'n': 1}, fn)
+    wait_for(lambda: running.status == 'running')
+    manager.submit('generate', {'n': 2}, fn)  # czeka w kolejce (max_queue=1)
+
+    with pytest.raises(app.JobQueueFull):
+        manager.submit('generate', {'n': 3}, fn)
+
+    with app.app.test_request_context():
+        response = app.submit_job('generate', {'n': 4, 'clientId': 'sid'}, fn)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+
+def test_cancel_running_and_queued_jobs_via_delete(manager):
+    client = app.app.test_client()
+    running, _ = manager.submit('preview', {'n': 1}, cooperative)
+    wait_for(lambda: running.status == 'running')
+    queued, _ = manager.submit('preview', {'n': 2}, cooperative)
+
+    response = client.delete(f'/api/jobs/{queued.id}')
+    assert response.status_code == 200 and response.json['status'] == 'cancelled'
+
+    assert client.delete(f'/api/jobs/{running.id}').status_code == 200
+    wait_for(lambda: running.status == 'cancelled')
+    assert client.get(f'/api/jobs/{running.id}').json['status'] == 'cancelled'
+
+    assert client.delete('/api/jobs/nieistniejace').status_code == 404
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def wolftax():
+    return next(template for template in app.load_templates() if template['id'] == 'wolftax')
+
+
+def offer(template, **form):
+    return {'templateData': template, 'formData': form or {'NazwaFirmyKlienta': 'ACME'},
+            'selectedProducts': ['1', '2'], 'productCustomFields': {'3': {'cena': '100'}}}
+
+
+def test_offer_cache_key_is_canonical(wolftax):
+    offer_cache = app.OfferResultCache(16, 60)
+    key, deps = offer_cache.key('generate', offer(wolftax))
+
+    # Pola własne niewybranych produktów i kolejność kluczy nie zmieniają klucza
+    same = offer(wolftax)
+    same['productCustomFields'] = {'9': {'x': 'y'}}
+    assert offer_cache.key('generate', same)[0] == key
+    assert os.path.join(app.PRODUKTY_DIR, '1.docx') in deps
+
+    assert offer_cache.key('generate', offer(wolftax, NazwaFirmyKlienta='Inna'))[0] != key
+    assert offer_cache.key('preview', offer(wolftax))[0] != key
+    assert offer_cache.key('generate', dict(offer(wolftax), format='pdf'))[0] != key
+    reordered = dict(offer(wolftax), selectedProducts=['2', '1'])
+    assert offer_cache.key('generate', reordered)[0] != key
+
+
+def test_offer_cache_missing_file_disables_caching(wolftax):
+    data = dict(offer(wolftax), selectedProducts=['brak-takiego-produktu'])
+    assert app.OfferResultCache(16, 60).key('generate', data) == (None, None)
+
+
+def test_offer_cache_get_put_invalidate(wolftax):
+    offer_cache = app.OfferResultCache(16, 60)
+    data = offer(wolftax)
+    key, deps = offer_cache.key('preview', data)
+    offer_cache.put(key, deps, {'success': True, 'total_pages': 3, 'timings': {'x': 1}, 'render_time': '1s'})
+
+    hit = offer_cache.get('preview', data)
+    assert hit['cached'] and hit['total_pages'] == 3
+    # Statystyki przebiegu nie trafiają do cache
+    assert 'timings' not in hit and 'render_time' not in hit
+
+    assert offer_cache.invalidate([os.path.join(app.TEMPLATES_DIR, 'nieużywany.docx')]) == 0
+    assert offer_cache.invalidate([os.path.join(app.PRODUKTY_DIR, '2.docx')]) == 1
+    assert offer_cache.get('preview', data) is None
+    assert len(offer_cache) == 0
+
+
+def test_offer_cache_drops_entry_with_missing_page_blobs(wolftax):
+    offer_cache = app.OfferResultCache(16, 60)
+    data = offer(wolftax)
+    key, deps = offer_cache.key('preview', data)
+    offer_cache.put(key, deps, {'success': True, 'pages_metadata': [{'image_hash': 'f' * 64}]})
+    assert offer_cache.get('preview', data) is None
+    assert len(offer_cache) == 0
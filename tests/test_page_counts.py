@@ -0,0 +1,39 @@
+import threading
+import uuid
+
+import app
+
+
+def segment(fingerprint):
+    return {'fingerprint': fingerprint, 'path': f'/brak/{fingerprint}.docx', 'type': 'product'}
+
+
+def test_segment_page_counts_converts_each_fingerprint_once(monkeypatch):
+    ok, broken = uuid.uuid4().hex, uuid.uuid4().hex
+    calls = []
+    lock = threading.Lock()
+
+    def fake_ensure(seg):
+        with lock:
+            calls.append(seg['fingerprint'])
+        if seg['fingerprint'] == broken:
+            raise RuntimeError('LibreOffice nie znalezione')
+        app.page_count_index.put(seg['fingerprint'], 3)
+        return b'%PDF', False
+
+    monkeypatch.setattr(app, 'ensure_segment_pdf', fake_ensure)
+    counts = app.segment_page_counts([segment(ok), segment(broken), segment(ok), segment(broken)])
+
+    assert counts == [3, None, 3, None]
+    # Nieudana konwersja nie jest powtarzana, ten sam fingerprint konwertowany raz
+    assert sorted(calls) == sorted([ok, broken])
+
+
+def test_table_of_contents_falls_back_to_one_page(monkeypatch):
+    def fail(seg):
+        raise RuntimeError('LibreOffice nie znalezione')
+
+    monkeypatch.setattr(app, 'ensure_segment_pdf', fail)
+    products = [dict(segment(uuid.uuid4().hex), product_id=product_id) for product_id in ('1', '2')]
+    toc = app.generate_table_of_contents(['1', '2'], {}, 5, product_segments=products)
+    assert [line.rsplit(' ', 1)[-1] for line in toc.split('\n')] == ['05', '06']
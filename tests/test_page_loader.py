@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timeout'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    """Jeden worker; _load zapisuje kolejność, pierwsze zadanie czeka na gate"""
+    loader = app.PageLoader(workers=1, max_segments=4)
+    loader.loaded = []
+    loader.gate = threading.Event()
+
+    def load(fingerprint, page_index, tiers):
+        if fingerprint == 'busy':
+            loader.gate.wait(5)
+        loader.loaded.append((fingerprint, page_index))
+        return {tier: f'{fingerprint}-{page_index}-{tier}' for tier in tiers}
+
+    monkeypatch.setattr(loader, '_load', load)
+    yield loader
+    loader.gate.set()
+
+
+def occupy(loader):
+    """Zajmij jedynego workera - kolejne żądania czekają w kolejce"""
+    busy = loader.request('busy', 0, ('preview',))
+    wait_for(lambda: ('busy', 0, ('preview',)) in loader.running)
+    return busy
+
+
+def test_viewport_before_prefetch(loader):
+    busy = occupy(loader)
+    far = loader.request('seg', 3, ('preview',), app.PageLoader.PREFETCH + 2)
+    near = loader.request('seg', 2, ('preview',), app.PageLoader.PREFETCH + 1)
+    visible = loader.request('seg', 0, ('preview',))
+
+    loader.gate.set()
+    for future in (busy, far, near, visible):
+        future.result(timeout=5)
+
+    assert loader.loaded == [('busy', 0), ('seg', 0), ('seg', 2), ('seg', 3)]
+    assert visible.result() == {'preview': 'seg-0-preview'}
+
+
+def test_identical_requests_share_one_load(loader):
+    busy = occupy(loader)
+    first = loader.request('seg', 1, ('preview', 'thumb'))
+    second = loader.request('seg', 1, ('preview', 'thumb'))
+    other_tiers = loader.request('seg', 1, ('preview',))
+
+    assert first is second
+    assert first is not other_tiers
+
+    loader.gate.set()
+    busy.result(timeout=5)
+    assert first.result(timeout=5) == {'preview': 'seg-1-preview', 'thumb': 'seg-1-thumb'}
+    other_tiers.result(timeout=5)
+    assert loader.loaded.count(('seg', 1)) == 2
+    assert loader.pending == {}
+
+
+def test_prefetch_promoted_to_viewport_loads_once(loader):
+    busy = occupy(loader)
+    other = loader.request('seg', 5, ('preview',), app.PageLoader.PREFETCH + 1)
+    prefetched = loader.request('seg', 4, ('preview',), app.PageLoader.PREFETCH + 2)
+    promoted = loader.request('seg', 4, ('preview',))
+
+    assert promoted is prefetched
+    assert promoted.priority == app.PageLoader.VIEWPORT
+
+    loader.gate.set()
+    for future in (busy, other, promoted):
+        future.result(timeout=5)
+    # Stary wpis prefetchu zostaje w kolejce - worker go pomija
+    wait_for(loader.queue.empty)
+
+    assert loader.loaded == [('busy', 0), ('seg', 4), ('seg', 5)]
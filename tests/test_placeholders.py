@@ -0,0 +1,63 @@
+import copy
+import os
+
+from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+import app
+
+
+def split_runs(paragraph, pieces):
+    """Zastąp runy paragrafu kopiami pierwszego runu z kolejnymi kawałkami tekstu"""
+    template = paragraph.runs[0]._r
+    for run in list(paragraph.runs):
+        paragraph._p.remove(run._r)
+    for piece in pieces:
+        run = copy.deepcopy(template)
+        run.find(qn('w:t')).text = piece
+        paragraph._p.append(run)
+
+
+def test_fill_paragraph_placeholder_split_across_runs():
+    doc = Document()
+    paragraph = doc.add_paragraph('x')
+    split_runs(paragraph, ['Klient: {{Na', 'zwa', 'Firmy}}, temat: {', '{Temat}}!'])
+    bold = OxmlElement('w:b')
+    paragraph.runs[0]._r.get_or_add_rPr().append(bold)
+
+    assert app.fill_paragraph(paragraph._p, {'NazwaFirmy': 'ACME', 'Temat': 'Audyt'}) == 2
+    assert paragraph.text == 'Klient: ACME, temat: Audyt!'
+    # Wartość w runie, w którym zaczynał się placeholder - z jego formatowaniem
+    assert paragraph.runs[0].text == 'Klient: ACME'
+    assert paragraph.runs[0].bold
+
+
+def test_fill_paragraph_leaves_unknown_placeholders():
+    doc = Document()
+    paragraph = doc.add_paragraph('{{A}} i {{B}}')
+    assert app.fill_paragraph(paragraph._p, {'A': '1\t2'}) == 1
+    assert paragraph.text == '1\t2 i {{B}}'
+
+
+def test_fill_placeholders_uses_plan():
+    doc = Document()
+    doc.add_paragraph('Bez placeholdera')
+    doc.add_paragraph('Dla {{klient}}')
+    plan = app.compile_placeholder_plan(doc)
+    assert plan['names'] == {'klient'}
+
+    app.fill_placeholders(doc, plan, {'klient': 'ACME', 'produkty': 'pomijane'})
+    assert [p.text for p in doc.paragraphs] == ['Bez placeholdera', 'Dla ACME']
+
+
+def test_placeholder_plan_replaced_when_file_changes(make_docx):
+    path = make_docx('plan.docx', ['{{a}}'])
+    assert app.get_placeholder_plan(path)['names'] == {'a'}
+    entries = len(app.placeholder_index)
+
+    # Nowa treść pod tą samą ścieżką zastępuje wpis zamiast dokładać kolejny
+    make_docx('plan.docx', ['{{b}}'])
+    assert app.get_placeholder_plan(path)['names'] == {'b'}
+    assert len(app.placeholder_index) == entries
+    assert app.placeholder_index[os.path.abspath(path)][0] == app.get_file_hash(path)
@@ -0,0 +1,54 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+def age(path, seconds):
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return app.RenderCache(str(tmp_path / 'cache'), 10 ** 9)
+
+
+def test_render_cache_shared_blob_refcounts(cache):
+    shared = cache.put_pages('a', [b'wspolna', b'tylko-a'])[0]
+    cache.put_pages('b', [b'wspolna'])
+    age(cache.blob_path(shared), 10 ** 5)
+
+    cache._drop('a')
+    # Blob nadal używany przez wpis 'b'
+    assert os.path.exists(cache.blob_path(shared))
+    assert cache.get_page_hashes('b') == [shared]
+
+    cache._drop('b')
+    assert not os.path.exists(cache.blob_path(shared))
+    assert cache._totals() == (0, 0)
+
+
+def test_render_cache_overwrite_releases_old_blobs(cache):
+    old = cache.put_pages('k', [b'stara'])[0]
+    age(cache.blob_path(old), 10 ** 5)
+
+    new = cache.put_pages('k', [b'nowa'])
+    assert cache.get_page_hashes('k') == new
+    assert not os.path.exists(cache.blob_path(old))
+    assert cache._totals() == (1, len(b'nowa'))
+
+
+def test_render_cache_evicts_least_recently_used(cache):
+    cache.max_bytes = 25
+    for key in ('a', 'b', 'c'):
+        hashes = cache.put_pages(key, [key.encode() * 10])
+        age(cache.blob_path(hashes[0]), 10 ** 5)
+        time.sleep(0.01)
+
+    assert cache.get_page_hashes('a') is None
+    assert cache.get_page_hashes('b') is not None
+    assert cache.get_page_hashes('c') is not None
+    assert cache._totals() == (2, 20)
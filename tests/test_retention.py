@@ -0,0 +1,45 @@
+import os
+import time
+
+import app
+
+
+def age(path, seconds):
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+def write(path, size, seconds_old):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    age(path, seconds_old)
+
+
+def test_retention_prunes_by_age_then_quota(tmp_path):
+    offers_dir, batch_dir = tmp_path / 'generated', tmp_path / 'generated' / 'batches'
+    batch_dir.mkdir(parents=True)
+    for i, seconds_old in enumerate((5000, 3000, 2000, 1000)):
+        write(offers_dir / f'o{i}.docx', 1000, seconds_old)
+    write(offers_dir / 'fresh.docx', 5000, 0)
+
+    retention = app.GeneratedRetention(str(offers_dir), str(batch_dir), max_bytes=6500, max_age=4000, keep_recent=600)
+    assert retention.usage() == 9000
+
+    # o0 - za stary, o1 i o2 - najstarsze ponad limit; fresh.docx młodszy niż keep_recent
+    assert retention.prune() == (3, 3000)
+    assert sorted(os.listdir(offers_dir)) == ['batches', 'fresh.docx', 'o3.docx']
+
+
+def test_retention_treats_batch_dir_and_zip_as_one_unit(tmp_path):
+    offers_dir, batch_dir = tmp_path / 'generated', tmp_path / 'generated' / 'batches'
+    (batch_dir / 'stara').mkdir(parents=True)
+    (batch_dir / 'nowa').mkdir()
+    write(batch_dir / 'stara' / 'a.docx', 100, 10 ** 6)
+    age(batch_dir / 'stara', 10 ** 6)
+    write(batch_dir / 'stara.zip', 100, 10 ** 6)
+    write(batch_dir / 'nowa' / 'a.docx', 100, 10 ** 6)
+    write(batch_dir / 'nowa.zip', 100, 0)  # archiwum świeże - cała partia zostaje
+
+    retention = app.GeneratedRetention(str(offers_dir), str(batch_dir), max_bytes=10 ** 9, max_age=3600, keep_recent=600)
+    assert retention.prune() == (1, 200)
+    assert sorted(os.listdir(batch_dir)) == ['nowa', 'nowa.zip']
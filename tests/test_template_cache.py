@@ -0,0 +1,13 @@
+import app
+
+
+def test_template_cache_averages_clone_time_over_all_clones(make_docx):
+    cache = app.TemplateCache(4)
+    path = make_docx('szablon.docx', ['{{klient}}'])
+    cache.load(path)   # chybienie + kopia
+    cache.load(path)   # trafienie + kopia
+    cache.parsed(path)  # trafienie bez kopii
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], cache.clones) == (2, 1, 2)
+    assert stats['avg_clone_ms'] == round(1000 * cache.clone_time / 2, 2)
@@ -0,0 +1,53 @@
+import os
+
+from docx import Document
+
+import app
+
+MARKER = 'Opis: \t\t{{opis}}'
+
+
+def body_texts(path):
+    return [paragraph.text for paragraph in Document(path).paragraphs]
+
+
+def test_split_at_marker(tmp_path, make_docx):
+    source = make_docx('single.docx', ['Wstęp', 'Opis: \t\t{{opis}}', 'Zakończenie', 'Kontakt'])
+    pre, post = str(tmp_path / 'pre.docx'), str(tmp_path / 'post.docx')
+
+    assert app.split_docx_at_marker(source, MARKER, pre, post) == (pre, post)
+    assert body_texts(pre) == ['Wstęp', 'Opis: \t\t{{opis}}']
+    assert body_texts(post) == ['Zakończenie', 'Kontakt']
+    # Obie części to pełne paczki z sekcją (nagłówek zostaje)
+    assert Document(post).sections[0].header.paragraphs[0].text == 'Nagłówek single.docx'
+
+
+def test_split_marker_in_last_paragraph(tmp_path, make_docx):
+    source = make_docx('single.docx', ['Wstęp', 'Opis: {{opis}}'])
+    pre, post = str(tmp_path / 'pre.docx'), str(tmp_path / 'post.docx')
+    assert app.split_docx_at_marker(source, MARKER, pre, post) == (pre, None)
+    assert body_texts(pre) == ['Wstęp', 'Opis: {{opis}}']
+
+
+def test_split_without_marker(tmp_path, make_docx):
+    source = make_docx('single.docx', ['Wstęp', 'Zakończenie'])
+    assert app.split_docx_at_marker(source, MARKER, str(tmp_path / 'pre.docx'), str(tmp_path / 'post.docx')) is None
+
+
+def test_split_memo_replaced_and_old_parts_removed(make_docx):
+    source = make_docx('jednoplikowy.docx', ['Wstęp', 'Opis: {{opis}}', 'Koniec'])
+    first = app.split_single_file_template(source, MARKER)
+    assert all(os.path.exists(part) for part in first)
+    entries = len(app.template_splits)
+
+    make_docx('jednoplikowy.docx', ['Inny wstęp', 'Opis: {{opis}}', 'Inny koniec'])
+    second = app.split_single_file_template(source, MARKER)
+    assert second != first
+    assert len(app.template_splits) == entries
+    assert not any(os.path.exists(part) for part in first)
+    assert body_texts(second[1]) == ['Inny koniec']
+
+    os.remove(source)
+    assert app.split_single_file_template(source, MARKER) is None
+    assert len(app.template_splits) == entries - 1
+    assert not any(os.path.exists(part) for part in second)
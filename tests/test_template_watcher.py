@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def watched(tmp_path, monkeypatch):
+    """Katalogi produktów i szablonów w tmp; rozgrzewanie, unieważnianie i emit zapisywane"""
+    produkty = tmp_path / 'produkty'
+    templates = tmp_path / 'templates'
+    (templates / 'oferta').mkdir(parents=True)
+    produkty.mkdir()
+    monkeypatch.setattr(app, 'BASE_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'PRODUKTY_DIR', str(produkty))
+    monkeypatch.setattr(app, 'TEMPLATES_DIR', str(templates))
+    monkeypatch.setattr(app, 'load_templates', lambda: [])
+
+    calls = {'warm': [], 'invalidate': [], 'emit': []}
+
+    def warm(kind, fail=False):
+        def fn(path):
+            calls['warm'].append((kind, os.path.relpath(path, tmp_path)))
+            if fail:
+                raise RuntimeError('konwersja')
+        return fn
+
+    monkeypatch.setattr(app, 'warm_docx', warm('docx', fail=False))
+    monkeypatch.setattr(app, 'warm_template', warm('template', fail=True))
+    monkeypatch.setattr(app.offer_cache, 'invalidate', lambda paths=None: calls['invalidate'].append(paths) or 0)
+    monkeypatch.setattr(app.socketio, 'emit', lambda event, data, **kwargs: calls['emit'].append((event, data)))
+
+    watcher = app.TemplateWatcher([str(produkty), str(templates)], interval=60, workers=2)
+    return watcher, tmp_path, calls
+
+
+def test_diff_added_changed_removed(watched):
+    watcher, root, _ = watched
+    for name in ('a', 'b'):
+        (root / 'produkty' / f'{name}.docx').write_bytes(name.encode())
+    (root / 'produkty' / '~$a.docx').write_bytes(b'lock')
+    (root / 'produkty' / 'notes.txt').write_bytes(b'-')
+    watcher.snapshot = watcher.scan()
+    assert sorted(os.path.basename(path) for path in watcher.snapshot) == ['a.docx', 'b.docx']
+
+    (root / 'produkty' / 'a.docx').write_bytes(b'a, nowa wersja')
+    (root / 'produkty' / 'b.docx').unlink()
+    (root / 'produkty' / 'c.docx').write_bytes(b'c')
+
+    added, changed, removed = watcher.diff(watcher.scan())
+    assert [os.path.basename(path) for path in added] == ['c.docx']
+    assert [os.path.basename(path) for path in changed] == ['a.docx']
+    assert [os.path.basename(path) for path in removed] == ['b.docx']
+
+
+def test_templates_changed_payload(watched):
+    watcher, root, calls = watched
+    product = str(root / 'produkty' / 'a.docx')
+    removed = str(root / 'produkty' / 'b.docx')
+    template = str(root / 'templates' / 'oferta' / 'header.docx')
+
+    watcher.handle([template], [product], [removed])
+
+    assert sorted(calls['warm']) == [('docx', 'produkty/a.docx'), ('template', 'templates/oferta/header.docx')]
+    assert calls['invalidate'] == [[template, product, removed]]
+    assert calls['emit'] == [('templates_changed', {
+        'added': ['templates/oferta/header.docx'],
+        'changed': ['produkty/a.docx'],
+        'removed': ['produkty/b.docx'],
+        'products': ['a', 'b'],
+        'failed': ['templates/oferta/header.docx'],
+    })]
+
+
+def test_config_change_invalidates_all_offers_without_render(watched):
+    watcher, root, calls = watched
+    config = str(root / 'templates' / 'oferta' / 'config.json')
+
+    watcher.handle([], [config], [])
+
+    assert calls['warm'] == []
+    assert calls['invalidate'] == [None]
+    event, payload = calls['emit'][0]
+    assert event == 'templates_changed'
+    assert payload['changed'] == ['templates/oferta/config.json']
+    assert payload['products'] == [] and payload['failed'] == []
@@ -0,0 +1,23 @@
+import json
+import os
+
+import app
+
+
+def test_usage_stats_flush_is_deferred(tmp_path):
+    path = tmp_path / 'usage.json'
+    stats = app.UsageStats(str(path), flush_interval=3600)
+    product = os.path.join(app.PRODUKTY_DIR, '1.docx')
+
+    stats.record_offer(None, ['1'])
+    stats.record_offer(None, ['1'])
+    # Nic na dysku w ścieżce żądania
+    assert not path.exists()
+    assert stats.get(product) == 2
+
+    stats.flush()
+    assert json.loads(path.read_text())[stats.item_id(product)] == 2
+    assert stats.timer is None
+
+    reloaded = app.UsageStats(str(path), flush_interval=3600)
+    assert reloaded.get(product) == 2